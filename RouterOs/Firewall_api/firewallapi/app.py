@@ -10,6 +10,9 @@ from firewallapi import hooks
 from firewallapi import cfg
 from firewallapi import config as api_config
 from firewallapi import middleware
+from firewallapi.common import backpressure
+from firewallapi.common import tracing
+from firewallapi import rpc
 
 
 __author__ = 'hardy.Zheng'
@@ -26,16 +29,49 @@ def get_pecan_config():
     return pecan.configuration.conf_from_file(filename)
 
 
+def probe_queues(conf, db_connection):
+    """the rosmanager queues: the topic and its lanes, with route sharding
+    a callable adding the server queue of every live rosmanager to them
+    """
+    rabbit = conf.oslo_messaging_rabbit
+    topics = [rabbit.topic] + ['%s.%s' % (rabbit.topic, lane.split(':')[0].strip())
+                               for lane in rabbit.rpc_lanes]
+    if not conf.route_sharding or db_connection is None:
+        return topics
+
+    def _queues():
+        hosts = db_connection.list_live_manager(rabbit.topic, None,
+                                                conf.manager_heartbeat_timeout)
+        return topics + ['%s.%s' % (topic, host) for topic in topics for host in hosts]
+    return _queues
+
+
 def setup_app(pecan_config=None):
     if not pecan_config:
         pecan_config = get_pecan_config()
 
     # pecan.configuration.set_config(dict(pecan_config), overwrite=True)
     # Replace DBHook with a hooks.TransactionHook
+    db_hook = hooks.DBHook(conf)
     app_hooks = [
-        hooks.DBHook(conf.mysql.engine),
-        hooks.MessageHook(conf)
+        db_hook,
+        hooks.MessageHook(conf, db_hook.db_connection)
     ]
+    rabbit = conf.oslo_messaging_rabbit
+    if rabbit.backpressure_soft_limit > 0:
+        probe = backpressure.QueueDepthProbe(
+            rpc.get_amqp_url(conf),
+            rabbit.backpressure_queues or probe_queues(conf, db_hook.db_connection),
+            interval=rabbit.backpressure_probe_interval)
+        probe.start()
+        # after MessageHook, it wraps request.lanes
+        app_hooks.append(hooks.BackpressureHook(backpressure.Backpressure(
+            probe, rabbit.backpressure_soft_limit,
+            rabbit.backpressure_hard_limit or rabbit.backpressure_soft_limit * 4,
+            rabbit.backpressure_retry_after)))
+    if conf.trace_enabled:
+        tracing.setup(conf.trace_file, 'firewallapi')
+        app_hooks.insert(0, hooks.TraceHook(conf))
 
     app = pecan.make_app(
         pecan_config.app.root,
@@ -0,0 +1,121 @@
+"""
+    Shed mutating api requests while the rosmanager queues are backed up.
+
+    QueueDepthProbe polls the depth of the rpc queues with passive
+    queue_declare calls every interval seconds, Backpressure turns the
+    depth of the queue a request sends to into a verdict: at soft_limit
+    messages new mutating requests get 429, at hard_limit 503, both with a
+    Retry-After. A backed up rosmanager only sheds the requests for its
+    routes. Reads are never shed. When the broker or the queue can not be
+    probed nothing is shed, the casts fail on their own then.
+"""
+
+__author__ = 'hardy.Zheng'
+
+import logging
+import threading
+import time
+
+import kombu
+
+
+LOG = logging.getLogger(__name__)
+
+
+class QueueDepthProbe(object):
+
+    def __init__(self, url, queues, interval=5):
+        """queues: the queue names, or a callable returning them before
+        every probe (queues that come and go with the rosmanagers)
+        """
+        self.url = url
+        self.queues = queues if callable(queues) else list(queues)
+        self.interval = interval
+        # queue -> messages waiting, None when the last probe failed
+        self.depths = {}
+        self.probed_at = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='queue-depth-probe')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def probe(self):
+        depths = {}
+        queues = []
+        try:
+            queues = self.queues() if callable(self.queues) else self.queues
+            with kombu.Connection(self.url, connect_timeout=self.interval) as conn:
+                channel = conn.channel()
+                for queue in queues:
+                    try:
+                        depths[queue] = channel.queue_declare(
+                            queue=queue, passive=True).message_count
+                    except conn.channel_errors:
+                        # passive declare of a missing queue closes the channel
+                        depths[queue] = None
+                        channel = conn.channel()
+        except Exception as e:
+            LOG.warning('probe rpc queue depth failed: %s' % e)
+            depths = dict((queue, None) for queue in queues)
+        self.depths = depths
+        self.probed_at = time.time()
+        return depths
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self.probe()
+            self._stopped.wait(self.interval)
+
+    def depth(self, queues=None):
+        """deepest probed queue of queues (all when None), None if nothing
+        is known
+        """
+        depths = self.depths
+        if queues is not None:
+            depths = dict((queue, depths.get(queue)) for queue in queues)
+        known = [d for d in depths.values() if d is not None]
+        if not known:
+            return None
+        return max(known)
+
+
+class Backpressure(object):
+
+    MUTATING = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+    def __init__(self, probe, soft_limit, hard_limit, retry_after=10):
+        self.probe = probe
+        self.soft_limit = soft_limit
+        self.hard_limit = hard_limit
+        self.retry_after = retry_after
+        self.shed = {429: 0, 503: 0}
+
+    def check(self, method, queues=None):
+        """return (status, retry_after seconds) to shed the request sending
+        to queues (any probed queue when None) with, None to let it through
+        """
+        if method.upper() not in self.MUTATING:
+            return None
+        depth = self.probe.depth(queues)
+        if depth is None or depth < self.soft_limit:
+            return None
+        status = 503 if depth >= self.hard_limit else 429
+        # deeper queues take longer to drain, ask to come back later
+        scale = min(10.0, max(1.0, float(depth) / self.soft_limit))
+        retry_after = int(self.retry_after * scale)
+        self.shed[status] += 1
+        return status, retry_after
+
+    def stats(self):
+        return {
+            'depths': dict(self.probe.depths),
+            'probed_at': self.probe.probed_at,
+            'soft_limit': self.soft_limit,
+            'hard_limit': self.hard_limit,
+            'shed': dict(self.shed),
+        }
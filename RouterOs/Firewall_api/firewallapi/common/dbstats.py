@@ -0,0 +1,179 @@
+"""
+    Statement timing for session.Connection.
+
+    StatementStats listens to the cursor events of an engine, it times every
+    statement, attributes it to the Connection method that issued it and
+    keeps a latency histogram per method. Statements slower than the
+    threshold are written with their parameters and EXPLAIN plan to the
+    slow query log.
+"""
+
+__author__ = 'hardy.Zheng'
+
+import logging
+import logging.handlers
+import sys
+import threading
+import time
+
+import sqlalchemy
+
+
+LOG = logging.getLogger(__name__)
+
+# histogram upper bounds in milliseconds, the last bucket is unbounded
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+_EXPLAIN = {
+    'mysql': 'EXPLAIN ',
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+}
+
+
+def get_slow_logger(path, max_size=10, back_count=5):
+    """return the 'firewallapi.slow_query' logger writing to path,
+    max_size is in MB like the [log] options
+    """
+    logger = logging.getLogger('firewallapi.slow_query')
+    if path and not logger.handlers:
+        handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=max_size * 1024 * 1024, backupCount=back_count)
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
+
+
+class _Histogram(object):
+
+    def __init__(self):
+        self.count = 0
+        self.slow = 0
+        self.rows = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, elapsed, rows, slow):
+        self.count += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        if rows > 0:
+            self.rows += rows
+        if slow:
+            self.slow += 1
+        for i, bound in enumerate(BUCKETS):
+            if elapsed <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def to_dict(self):
+        labels = ['<=%dms' % b for b in BUCKETS] + ['>%dms' % BUCKETS[-1]]
+        return {
+            'count': self.count,
+            'slow': self.slow,
+            'rows': self.rows,
+            'total_ms': round(self.total, 3),
+            'avg_ms': round(self.total / self.count, 3) if self.count else 0.0,
+            'max_ms': round(self.max, 3),
+            'buckets': dict(zip(labels, self.buckets)),
+        }
+
+
+class StatementStats(object):
+
+    def __init__(self, owner, threshold=500, slow_logger=None):
+        """
+        owner: the class whose public methods statements are attributed to
+        threshold: slow query threshold in milliseconds, 0 logs everything
+        """
+        self.owner = owner
+        self.threshold = threshold
+        self.slow_logger = slow_logger
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._module = sys.modules[owner.__module__].__dict__
+
+    def attach(self, engine):
+        sqlalchemy.event.listen(engine, 'before_cursor_execute', self._before)
+        sqlalchemy.event.listen(engine, 'after_cursor_execute', self._after)
+
+    def detach(self, engine):
+        sqlalchemy.event.remove(engine, 'before_cursor_execute', self._before)
+        sqlalchemy.event.remove(engine, 'after_cursor_execute', self._after)
+
+    def caller(self):
+        """name of the innermost public owner method on the stack"""
+        frame = sys._getframe(2)
+        while frame is not None:
+            name = frame.f_code.co_name
+            if (frame.f_globals is self._module and not name.startswith('_')
+                    and name in self.owner.__dict__):
+                return name
+            frame = frame.f_back
+        return '-'
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        context._stats_start = time.time()
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, '_stats_start', None)
+        if start is None:
+            return
+        elapsed = (time.time() - start) * 1000
+        method = self.caller()
+        rows = cursor.rowcount
+        slow = elapsed >= self.threshold
+        with self._lock:
+            histogram = self._histograms.get(method)
+            if histogram is None:
+                histogram = self._histograms[method] = _Histogram()
+            histogram.add(elapsed, rows, slow)
+        if slow and self.slow_logger is not None:
+            self._log_slow(conn, method, elapsed, rows, statement, parameters,
+                           executemany)
+
+    def _explain(self, conn, statement, parameters):
+        prefix = _EXPLAIN.get(conn.engine.name)
+        if prefix is None or not statement.lstrip().upper().startswith('SELECT'):
+            return None
+        cursor = conn.connection.cursor()
+        try:
+            cursor.execute(prefix + statement, parameters)
+            columns = [c[0] for c in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+
+    def _log_slow(self, conn, method, elapsed, rows, statement, parameters,
+                  executemany):
+        plan = None
+        if not executemany:
+            try:
+                plan = self._explain(conn, statement, parameters)
+            except Exception as e:
+                plan = 'explain failed: %s' % e
+        lines = ['method=%s elapsed=%.3fms rows=%s' % (method, elapsed, rows),
+                 'statement: %s' % ' '.join(statement.split()),
+                 'parameters: %r' % (parameters,)]
+        if isinstance(plan, list):
+            lines.extend('explain: %s' % row for row in plan)
+        elif plan:
+            lines.append('explain: %s' % plan)
+        try:
+            self.slow_logger.info('\n'.join(lines))
+        except Exception as e:
+            LOG.warning('write slow query log failed: %s' % e)
+
+    def snapshot(self):
+        """return {method: histogram dict}, see _Histogram.to_dict()"""
+        with self._lock:
+            return dict((method, histogram.to_dict())
+                        for method, histogram in self._histograms.items())
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
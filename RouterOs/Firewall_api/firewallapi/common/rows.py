@@ -0,0 +1,48 @@
+"""
+    Lightweight row types for the Core read path.
+
+    The list_*_rows() methods of session.Connection return these namedtuples
+    instead of ORM objects, they carry only the columns needed by read-only
+    listings and are never attached to a session.
+"""
+
+__author__ = 'hardy.Zheng'
+
+import collections
+
+from firewallapi.common import db_models as models
+
+
+def _row_type(name, table, columns):
+    row_cls = collections.namedtuple(name, columns)
+    row_cls.columns = tuple(table.c[column] for column in columns)
+    return row_cls
+
+
+VmRow = _row_type('VmRow', models.Vm.__table__,
+                  ('vm_id',
+                   'vm_name',
+                   'app_id',
+                   'customer_id',
+                   'site_name',
+                   'status',
+                   'configure_step'))
+
+SubinterfaceRow = _row_type('SubinterfaceRow', models.Subinterface.__table__,
+                            ('subinterface_id',
+                             'subinterface_name',
+                             'vlan_id',
+                             'vlan_type',
+                             'qos',
+                             'app_id',
+                             'gic_id',
+                             'status'))
+
+ActionRow = _row_type('ActionRow', models.Action.__table__,
+                      ('action_id',
+                       'app_id',
+                       'vm_id',
+                       'nic_id',
+                       'action',
+                       'status',
+                       'trigger_time'))
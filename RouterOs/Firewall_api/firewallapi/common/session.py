@@ -7,6 +7,7 @@
 __author__ = 'hardy.Zheng'
 
 import uuid
+import datetime
 import functools
 import logging
 import re
@@ -16,18 +17,51 @@ import six
 import sqlalchemy.orm
 
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.orm.exc import StaleDataError
 from sqlalchemy import exc as sqla_exc
 from sqlalchemy import or_
+from sqlalchemy import and_
+from sqlalchemy import select
+from sqlalchemy import union_all
+from sqlalchemy import bindparam
+from sqlalchemy import literal
+from sqlalchemy import DateTime
+from sqlalchemy.ext import baked
 from sqlalchemy.sql.expression import literal_column
 from sqlalchemy.orm import joinedload_all
 from sqlalchemy.orm import subqueryload_all
+from sqlalchemy.orm.attributes import flag_modified
 from firewallapi.common.utils import utcnow
 from firewallapi.common import db_models as models
+from firewallapi.common import rows
+from firewallapi.common import dbstats
 from firewallapi import exc
 
 
 LOG = logging.getLogger(__name__)
 
+
+def _subinterface_change(subinterface_id):
+    return {'subinterfaces': models.Subinterface.subinterface_id == subinterface_id}
+
+
+def _ipv4_change(ipv4_id):
+    return {'subinterfaces': models.Subinterface.subinterface_id.in_(
+        select([models.Network_Ipv4.subinterface_id]).
+        where(models.Network_Ipv4.id == ipv4_id))}
+
+
+def _gicextension_change(gicextension_id):
+    return {'subinterfaces': models.Subinterface.subinterface_id.in_(
+        select([models.GicExtension.subinterface_id]).
+        where(models.GicExtension.gicextension_id == gicextension_id))}
+
+
+def _nic_change(nic_id):
+    return {'site_name': select([models.Vm.site_name]).
+            where(models.Vm.vm_id == models.Vm_Network_Info.vm_id).
+            where(models.Vm_Network_Info.nic_id == nic_id).as_scalar()}
+
 _DUP_KEY_RE_DB = {
     "mysql": (re.compile(r"^.*\(1062,.*'([^\']+)'\"\)$"),),
 }
@@ -133,6 +167,10 @@ def _wrap_db_error(f):
             # unique constraint, from error message.
             _raise_if_duplicate_entry_error(e, self.bind.dialect.name)
             raise exc.DBError(e)
+        # NOTE: raised by the ORM when the 'WHERE version = :old' of a
+        # versioned row (see db_models) matched nothing at flush time.
+        except StaleDataError as e:
+            raise exc.DBConflict(e)
         except Exception as e:
             # LOG.exception(_LE('DB exception wrapped.'))
             raise exc.DBError(e)
@@ -376,6 +414,41 @@ def get_maker(engine, autocommit=False, expire_on_commit=False):
                                        query_cls=Query)
 
 
+_BAKERY = baked.bakery()
+
+
+def _baked_get(entity, column, profile, *options):
+    """Return a pre-built single row lookup on ``column == :ident``.
+
+    The Query construction and the compiled SQL are cached in _BAKERY, keyed
+    on the entity, the lookup column and the load profile name, so only the
+    bound ident changes between calls.
+    """
+    bq = _BAKERY(lambda session: session.query(entity),
+                 entity, column.key, profile)
+    if options:
+        bq += lambda q: q.options(*options)
+    bq += lambda q: q.filter(column == bindparam('ident'))
+    return bq
+
+
+_GET_APP = _baked_get(models.App, models.App.app_id, 'joined',
+                      joinedload_all('*'))
+_GET_NIC = _baked_get(models.Vm_Network_Info, models.Vm_Network_Info.nic_id, 'vm',
+                      joinedload_all(models.Vm_Network_Info.vm))
+_GET_SUBINTERFACE = _baked_get(models.Subinterface,
+                               models.Subinterface.subinterface_id, 'joined',
+                               joinedload_all('*'))
+_GET_GIC = _baked_get(models.Gic, models.Gic.gic_id, 'joined',
+                      joinedload_all('*'))
+_GET_ACTION = _baked_get(models.Action, models.Action.action_id, 'joined',
+                         joinedload_all('*'))
+_GET_TEMPLATE = _baked_get(models.Templates, models.Templates.template_id, 'joined',
+                           joinedload_all('*'))
+_GET_VM = _baked_get(models.Vm, models.Vm.vm_id, 'subquery',
+                     subqueryload_all('*'))
+
+
 class EngineFacade(object):
     """A helper class for removing of global engine instances from ceilometer.db.
 
@@ -532,9 +605,33 @@ class EngineFacade(object):
 
 
 class Connection(EngineFacade):
+    # dbstats.StatementStats, set by instrument()
+    stats = None
+
     def __init__(self, engine_url):
         self.engine = EngineFacade.from_config(engine_url)
 
+    def instrument(self, threshold=500, slow_log=None, max_size=10, back_count=5):
+        """
+        time every statement per calling method, statements slower than
+        threshold(ms) go with their EXPLAIN plan to the rotating slow_log
+        """
+        if self.stats is not None:
+            self.stats.detach(self.engine.get_engine())
+        slow_logger = dbstats.get_slow_logger(slow_log, max_size, back_count) \
+            if slow_log else None
+        self.stats = dbstats.StatementStats(Connection, threshold, slow_logger)
+        self.stats.attach(self.engine.get_engine())
+        return self.stats
+
+    def get_query_stats(self):
+        """
+        return per method latency histograms, empty without instrument()
+        """
+        if self.stats is None:
+            return {}
+        return self.stats.snapshot()
+
     def list_zone(self):
         """
         return list object, include zone and site as follow:
@@ -654,12 +751,12 @@ class Connection(EngineFacade):
             pass
 
     def get_app(self, app_id):
+        if not models.is_uuid(app_id):
+            return None
         try:
             app = None
             session = self.engine.get_session()
-            app = session.query(models.App).\
-                options(joinedload_all('*')).\
-                filter(models.App.app_id == app_id).one()
+            app = _GET_APP(session).params(ident=app_id).one()
             return app
         except NoResultFound:
             return None
@@ -681,6 +778,8 @@ class Connection(EngineFacade):
             session.close()
 
     def get_site_from_app(self, app_id):
+        if not models.is_uuid(app_id):
+            return None
         try:
             session = self.engine.get_session()
             app = session.query(models.App).\
@@ -711,17 +810,9 @@ class Connection(EngineFacade):
             raise exc.DBError('add_app error message: %s' % str(e))
 
     def delete_app(self, app_id):
-        try:
-            session = self.engine.get_session()
-            kwargs = {'status': 'delete'}
-            q = session.query(models.App).filter(models.App.app_id == app_id)
-            q.one()
-            q.update(kwargs)
-            session.commit()
-        except NoResultFound:
-            raise exc.NoResultFound('not found app')
-        except Exception, e:
-            raise exc.DBError('delete_app error message: %s' % str(e))
+        kwargs = {'status': 'delete'}
+        self._write_one(models.App, models.App.app_id == app_id,
+                        'not found app', values=kwargs)
 
     def list_nicing_from_site(self, site_name):
         nics = []
@@ -763,13 +854,12 @@ class Connection(EngineFacade):
             session.close()
 
     def get_nic(self, nic_id):
+        if not models.is_uuid(nic_id):
+            return None
         try:
             nic = None
             session = self.engine.get_session()
-            nic = session.query(models.Vm_Network_Info).\
-                options(joinedload_all(models.Vm_Network_Info.vm)).\
-                filter(models.Vm_Network_Info.nic_id == nic_id).\
-                one()
+            nic = _GET_NIC(session).params(ident=nic_id).one()
             return nic
         except NoResultFound:
             return None
@@ -797,6 +887,7 @@ class Connection(EngineFacade):
                                          kwargs['network_connect'],
                                          kwargs['vm_id'])
             session.add(nic)
+            self._add_change(session, 'nic', kwargs['nic_id'], site_name=vm.site_name)
             session.commit()
         except NoResultFound:
             raise exc.NoResultFound(message)
@@ -816,28 +907,25 @@ class Connection(EngineFacade):
                 nic.mac = kwargs['mac']
             if kwargs.get("network_connect", None):
                 nic.network_connect = kwargs['network_connect']
+            self._add_change(session, 'nic', nic_id, **_nic_change(nic_id))
             session.commit()
         except NoResultFound:
             raise exc.NoResultFound('not found nic')
 
     def delete_nic(self, nic_id):
-        try:
-            session = self.engine.get_session()
-            q = session.query(models.Vm_Network_Info).\
-                filter(models.Vm_Network_Info.nic_id == nic_id)
-            q.one()
-            q.delete()
-            session.commit()
-        except NoResultFound:
-            raise exc.NoResultFound('not found nic')
+        self._write_one(models.Vm_Network_Info,
+                        models.Vm_Network_Info.nic_id == nic_id,
+                        'not found nic', change=dict(_nic_change(nic_id),
+                                                     object_type='nic', object_id=nic_id))
 
     def get_subinterface(self, subinterface_id):
+        if not models.is_uuid(subinterface_id):
+            return None
         try:
             subinterface = None
             session = self.engine.get_session()
-            subinterface = session.query(models.Subinterface).\
-                options(joinedload_all('*')).\
-                filter(models.Subinterface.subinterface_id == subinterface_id).one()
+            subinterface = _GET_SUBINTERFACE(session).\
+                params(ident=subinterface_id).one()
             if not subinterface.app_id or not subinterface.vlan_type:
                 return None
             return subinterface
@@ -925,31 +1013,34 @@ class Connection(EngineFacade):
                                            sub_net['level'],
                                            sub_net['step'])
                 ipv4.subinterface = subinterface
+            self._add_change(session, 'subinterface', subinterface.subinterface_id,
+                             **_subinterface_change(subinterface.subinterface_id))
             session.commit()
             return subinterface.subinterface_id
         except NoResultFound:
             raise exc.NoResultFound('not found app')
 
     def free_vlan(self, subinterface_id):
+        kwargs = {'vlan_type': None,
+                  'alloc_time': None,
+                  'qos': None,
+                  'app_id': None,
+                  'gic_id': None,
+                  'status': None}
+        session = self.engine.get_session()
         try:
-            kwargs = {'vlan_type': None,
-                      'alloc_time': None,
-                      'qos': None,
-                      'app_id': None,
-                      'gic_id': None,
-                      'status': None}
-            session = self.engine.get_session()
+            self._add_change(session, 'subinterface', subinterface_id,
+                             **_subinterface_change(subinterface_id))
             session.query(models.Network_Ipv4).\
                 filter(models.Network_Ipv4.subinterface_id == subinterface_id).delete()
             session.query(models.Network_Ipv6).\
                 filter(models.Network_Ipv6.subinterface_id == subinterface_id).delete()
-            q = session.query(models.Subinterface).\
-                filter(models.Subinterface.subinterface_id == subinterface_id)
-            q.one()
-            q.update(kwargs)
+            self._write_row(session, models.Subinterface,
+                            models.Subinterface.subinterface_id == subinterface_id,
+                            'not found subinterface', values=kwargs)
             session.commit()
-        except NoResultFound:
-            raise exc.NoResultFound('not found subinterface')
+        finally:
+            session.close()
 
     def update_vlan(self, subinterface_id, **kwargs):
         """
@@ -974,6 +1065,11 @@ class Connection(EngineFacade):
                 filter(models.Subinterface.subinterface_id == subinterface_id).one()
             if subinterface.status != 'ok':
                 raise exc.NotAllowUpdate('pipe status is not ok')
+            # always write the row so the status check above is compared
+            # and swapped through its version even if only sub_net changes
+            flag_modified(subinterface, 'status')
+            self._add_change(session, 'subinterface', subinterface_id,
+                             **_subinterface_change(subinterface_id))
             if kwargs.get('qos', None):
                 subinterface.qos = kwargs['qos']
             if kwargs.get('status', None):
@@ -998,46 +1094,32 @@ class Connection(EngineFacade):
             raise exc.NoResultFound('not found subinterface')
 
     def update_network_ipv4(self, id, **kwargs):
-        try:
-            session = self.engine.get_session()
-            session.query(models.Network_Ipv4).\
-                filter(models.Network_Ipv4.id == id).update(kwargs)
-            session.commit()
-        except NoResultFound:
-            raise exc.NoResultFound('not found subinterface network_ipv4')
+        self._write_one(models.Network_Ipv4, models.Network_Ipv4.id == id,
+                        'not found subinterface network_ipv4', values=kwargs,
+                        change=dict(_ipv4_change(id), object_type='ipv4', object_id=id))
 
     def delete_network_ipv4(self, id):
-        try:
-            session = self.engine.get_session()
-            session.query(models.Network_Ipv4).\
-                filter(models.Network_Ipv4.id == id).delete()
-            session.commit()
-        except NoResultFound:
-            raise exc.NoResultFound('not found subinterface network_ipv4')
+        self._write_one(models.Network_Ipv4, models.Network_Ipv4.id == id,
+                        'not found subinterface network_ipv4',
+                        change=dict(_ipv4_change(id), object_type='ipv4', object_id=id))
 
     def deleting_vlan(self, subinterface_id):
-        try:
-            session = self.engine.get_session()
-            subinterface = session.query(models.Subinterface).\
-                filter(models.Subinterface.subinterface_id == subinterface_id).one()
-            if not subinterface.app_id or not subinterface.vlan_type:
-                raise exc.NoResultFound('not found subinterface')
-            if subinterface.status != 'ok':
-                raise exc.NotAllowDelete('pipe status is not ok')
-            subinterface.status = 'deleting'
-            session.commit()
-        except NoResultFound:
-            raise exc.NoResultFound('not found subinterface')
+        kwargs = {'status': 'deleting'}
+        self._write_one(models.Subinterface,
+                        and_(models.Subinterface.subinterface_id == subinterface_id,
+                             models.Subinterface.app_id.isnot(None),
+                             models.Subinterface.vlan_type.isnot(None)),
+                        'not found subinterface', values=kwargs, status='ok',
+                        conflict=exc.NotAllowDelete('pipe status is not ok'),
+                        change=dict(_subinterface_change(subinterface_id),
+                                    object_type='subinterface',
+                                    object_id=subinterface_id))
 
     def delete_vlan_ipv4(self, ipv4_id):
-        try:
-            session = self.engine.get_session()
-            q = session.query(models.Network_Ipv4).filter(models.Network_Ipv4.id == ipv4_id)
-            q.one()
-            q.delete()
-            session.commit()
-        except NoResultFound:
-            raise exc.NoResultFound('not found ipv4')
+        self._write_one(models.Network_Ipv4, models.Network_Ipv4.id == ipv4_id,
+                        'not found ipv4',
+                        change=dict(_ipv4_change(ipv4_id), object_type='ipv4',
+                                    object_id=ipv4_id))
 
     def update_vlan_netlevel(self, subinterface_id):
         """
@@ -1071,12 +1153,12 @@ class Connection(EngineFacade):
             raise exc.DBError(str(e))
 
     def get_gic(self, gic_id):
+        if not models.is_uuid(gic_id):
+            return None
         try:
             gic = None
             session = self.engine.get_session()
-            gic = session.query(models.Gic).\
-                options(joinedload_all('*')).\
-                filter(models.Gic.gic_id == gic_id).one()
+            gic = _GET_GIC(session).params(ident=gic_id).one()
             return gic
         except NoResultFound:
             return None
@@ -1084,27 +1166,17 @@ class Connection(EngineFacade):
             session.close()
 
     def free_gic(self, gic_id):
-        try:
-            kwargs = {'alloc_time': None, 'qos': None, 'customer_id': None}
-            session = self.engine.get_session()
-            q = session.query(models.Gic).\
-                filter(models.Gic.gic_id == gic_id)
-            q.one()
-            q.update(kwargs)
-            session.commit()
-        except NoResultFound:
-            raise exc.NoResultFound('not found gic')
+        kwargs = {'alloc_time': None, 'qos': None, 'customer_id': None}
+        self._write_one(models.Gic, models.Gic.gic_id == gic_id,
+                        'not found gic', values=kwargs,
+                        change={'object_type': 'gic', 'object_id': gic_id,
+                                'subinterfaces': models.Subinterface.gic_id == gic_id})
 
     def update_gic(self, gic_id, **kwargs):
-        try:
-            session = self.engine.get_session()
-            q = session.query(models.Gic).\
-                filter(models.Gic.gic_id == gic_id)
-            q.one()
-            q.update(kwargs)
-            session.commit()
-        except NoResultFound:
-            raise exc.NoResultFound('not found gic')
+        self._write_one(models.Gic, models.Gic.gic_id == gic_id,
+                        'not found gic', values=kwargs,
+                        change={'object_type': 'gic', 'object_id': gic_id,
+                                'subinterfaces': models.Subinterface.gic_id == gic_id})
 
     def join_app_gic(self, **kwargs):
         message = 'not found app'
@@ -1132,11 +1204,15 @@ class Connection(EngineFacade):
                                          kwargs['subinterface_id'],
                                          kwargs['status'])
             session.add(gic_ex)
+            self._add_change(session, 'gicextension', kwargs['gicextension_id'],
+                             **_subinterface_change(kwargs['subinterface_id']))
             session.commit()
         except NoResultFound:
             raise exc.NoResultFound(message)
 
     def get_gicextension(self, gicextension_id):
+        if not models.is_uuid(gicextension_id):
+            return None
         try:
             gicextension = None
             session = self.engine.get_session()
@@ -1256,48 +1332,38 @@ class Connection(EngineFacade):
             session.close()
 
     def update_gicextension(self, gicextension_id, **kwargs):
-        try:
-            session = self.engine.get_session()
-            q = session.query(models.GicExtension).\
-                filter(models.GicExtension.gicextension_id == gicextension_id)
-            q.one()
-            q.update(kwargs)
-            session.commit()
-        except NoResultFound:
-            raise exc.NoResultFound('not found gicid in gicextension')
+        self._write_one(models.GicExtension,
+                        models.GicExtension.gicextension_id == gicextension_id,
+                        'not found gicid in gicextension', values=kwargs,
+                        change=dict(_gicextension_change(gicextension_id),
+                                    object_type='gicextension',
+                                    object_id=gicextension_id))
 
     def deleting_gicextension(self, gicextension_id):
-        try:
-            message = 'not found gicid in gicextension'
-            session = self.engine.get_session()
-            gicextension = session.query(models.GicExtension).\
-                filter(models.GicExtension.gicextension_id == gicextension_id).one()
-            if gicextension.status != 'ok':
-                raise exc.NotAllowDelete('not allow delete app from gic')
-            message = 'not found type of gic subinterface in gic'
-            gicextension.status = 'deleting'
-            session.commit()
-        except NoResultFound:
-            raise exc.NoResultFound(message)
+        kwargs = {'status': 'deleting'}
+        self._write_one(models.GicExtension,
+                        models.GicExtension.gicextension_id == gicextension_id,
+                        'not found gicid in gicextension', values=kwargs, status='ok',
+                        conflict=exc.NotAllowDelete('not allow delete app from gic'),
+                        change=dict(_gicextension_change(gicextension_id),
+                                    object_type='gicextension',
+                                    object_id=gicextension_id))
 
     def delete_gicextension(self, gicextension_id):
-        try:
-            session = self.engine.get_session()
-            q = session.query(models.GicExtension).\
-                filter(models.GicExtension.gicextension_id == gicextension_id)
-            q.one()
-            q.delete()
-            session.commit()
-        except NoResultFound:
-            raise exc.NoResultFound('not found gicextension_id')
+        self._write_one(models.GicExtension,
+                        models.GicExtension.gicextension_id == gicextension_id,
+                        'not found gicextension_id',
+                        change=dict(_gicextension_change(gicextension_id),
+                                    object_type='gicextension',
+                                    object_id=gicextension_id))
 
     def get_action(self, action_id):
+        if not models.is_uuid(action_id):
+            return None
         try:
             action = None
             session = self.engine.get_session()
-            action = session.query(models.Action).\
-                options(joinedload_all('*')).\
-                filter(models.Action.action_id == action_id).one()
+            action = _GET_ACTION(session).params(ident=action_id).one()
             return action
         except NoResultFound:
             return None
@@ -1376,22 +1442,71 @@ class Connection(EngineFacade):
             raise exc.DBError(str(e))
 
     def update_action(self, action_id, **kwargs):
+        self._write_one(models.Action, models.Action.action_id == action_id,
+                        'not found action', values=kwargs)
+
+    def archive_action(self, before, status, batch_size=500):
+        """
+        move actions whose status is one of 'status' triggered before
+        'before' from action to action_history, batch_size rows per
+        transaction so the hot table is never locked for long. return number
+        of moved rows. nothing here sets the final status of an action, the
+        caller names the values it knows to be final
+        """
+        action = models.Action.__table__
+        history = models.ActionHistory.__table__
+        columns = [action.c[column.name] for column in history.columns]
+        moved = 0
         try:
-            session = self.engine.get_session()
-            q = session.query(models.Action).filter(models.Action.action_id == action_id)
-            q.one()
-            q.update(kwargs)
-            session.commit()
-        except NoResultFound:
-            raise exc.NoResultFound('not found action')
+            conn = self.engine.get_engine().connect()
+            try:
+                while True:
+                    with conn.begin():
+                        ids = [row[0] for row in conn.execute(
+                            select([action.c.action_id]).
+                            where(action.c.status.in_(status)).
+                            where(action.c.trigger_time < before).
+                            limit(batch_size).
+                            with_for_update())]
+                        if not ids:
+                            return moved
+                        conn.execute(history.insert().from_select(
+                            [column.name for column in history.columns],
+                            select(columns).where(action.c.action_id.in_(ids))))
+                        conn.execute(action.delete().where(action.c.action_id.in_(ids)))
+                    moved += len(ids)
+                    LOG.debug('archived %d actions' % moved)
+            finally:
+                conn.close()
+        except sqla_exc.SQLAlchemyError as e:
+            raise exc.DBError(e)
+
+    def list_action_rows_between(self, start, end, **kwargs):
+        """
+        actions triggered in [start, end) from both action and action_history,
+        ordered by trigger_time, return list of rows.ActionRow
+            kwargs = {'app_id': xx, 'vm_id': xx, 'status': xx}
+        """
+        _support = ('app_id', 'vm_id', 'status')
+        for key in kwargs.keys():
+            if key not in _support:
+                raise exc.ErrorKwargs('kwargs error in list_action_rows_between')
+        selects = []
+        for table in (models.Action.__table__, models.ActionHistory.__table__):
+            stmt = select([table.c[name] for name in rows.ActionRow._fields]).\
+                where(table.c.trigger_time >= start).\
+                where(table.c.trigger_time < end)
+            for key, value in kwargs.items():
+                stmt = stmt.where(table.c[key] == value)
+            selects.append(stmt)
+        stmt = union_all(*selects).order_by('trigger_time')
+        return self._select_rows(rows.ActionRow, stmt)
 
     def get_template(self, template_id):
         try:
             template = None
             session = self.engine.get_session()
-            template = session.query(models.Templates).\
-                options(joinedload_all('*')).\
-                filter(models.Templates.template_id == template_id).one()
+            template = _GET_TEMPLATE(session).params(ident=template_id).one()
             return template
         except NoResultFound:
             return None
@@ -1438,6 +1553,8 @@ class Connection(EngineFacade):
             raise exc.DBError(str(e))
 
     def get_vspc(self, vspc_id):
+        if not models.is_uuid(vspc_id):
+            return None
         try:
             vspc = None
             session = self.engine.get_session()
@@ -1490,15 +1607,8 @@ class Connection(EngineFacade):
             raise exc.DBError(str(e))
 
     def update_vspc(self, vspc_id, **kwargs):
-        try:
-            session = self.engine.get_session()
-            q = session.query(models.Vspc_Info).\
-                filter(models.Vspc_Info.vspc_id == vspc_id)
-            q.one()
-            q.update(kwargs)
-            session.commit()
-        except NoResultFound:
-            raise exc.NoResultFound('not found vspc')
+        self._write_one(models.Vspc_Info, models.Vspc_Info.vspc_id == vspc_id,
+                        'not found vspc', values=kwargs)
 
     def list_vm_from_serial(self, **kwargs):
         _support = ('vm_name', 'vspc_id', 'site_id', 'cluster_id')
@@ -1549,34 +1659,22 @@ class Connection(EngineFacade):
 
     def delete_vm_serial(self, vm_name):
         LOG.debug('db Instance delete name :%s' % vm_name)
-        try:
-            session = self.engine.get_session()
-            q = session.query(models.Serial_Connection).\
-                filter(models.Serial_Connection.vm_name == vm_name)
-            q.one()
-            q.delete()
-            session.commit()
-        except NoResultFound:
-            raise exc.NoResultFound('not found vm')
+        self._write_one(models.Serial_Connection,
+                        models.Serial_Connection.vm_name == vm_name,
+                        'not found vm')
 
     def update_vm_serial(self, vm_name, **kwargs):
-        try:
-            session = self.engine.get_session()
-            q = session.query(models.Serial_Connection).\
-                filter(models.Serial_Connection.vm_name == vm_name)
-            q.one()
-            q.update(kwargs)
-            session.commit()
-        except NoResultFound:
-            raise exc.NoResultFound('not found vm')
+        self._write_one(models.Serial_Connection,
+                        models.Serial_Connection.vm_name == vm_name,
+                        'not found vm', values=kwargs)
 
     def get_vm(self, vm_id):
+        if not models.is_uuid(vm_id):
+            return None
         try:
             vm = None
             session = self.engine.get_session()
-            vm = session.query(models.Vm).\
-                options(subqueryload_all('*')).\
-                filter(models.Vm.vm_id == vm_id).one()
+            vm = _GET_VM(session).params(ident=vm_id).one()
             return vm
         except NoResultFound:
             return None
@@ -1756,6 +1854,7 @@ class Connection(EngineFacade):
                 options(joinedload_all('*')).\
                 filter(models.Vm.vm_id == vm_id).one()
             vm.configure_step = kwargs['configure_step']
+            flag_modified(vm, 'configure_step')
             for disk in vm.flavor_info[0].disk:
                 if disk.is_load == 0:
                     disk.is_load = 1
@@ -1785,6 +1884,8 @@ class Connection(EngineFacade):
 
             session = self.engine.get_session()
             vm = session.query(models.Vm).filter(models.Vm.vm_id == vm_id).one()
+            # flavor, disk and nic changes go through the vm version as well
+            flag_modified(vm, 'status')
             if kwargs.get('cpu', None):
                 vm.flavor_info[0].cpu = kwargs['cpu']
             if kwargs.get('ram', None):
@@ -1808,12 +1909,192 @@ class Connection(EngineFacade):
             raise exc.NoResultFound('not found vm')
 
     def deleting_vm(self, vm_id, **kwargs):
+        LOG.debug('db Instance delete id: %s' % vm_id)
+        self._write_one(models.Vm, models.Vm.vm_id == vm_id,
+                        'not found vm', values=kwargs)
+
+    def _write_row(self, session, entity, criterion, message, values=None,
+                   status=None, conflict=None):
+        """
+        issue one UPDATE (values given) or DELETE (values is None) of the
+        rows matching criterion, the matched row count replaces a separate
+        q.one() existence check. versioned rows get version + 1 so ORM
+        writers holding the old version fail with exc.DBConflict.
+        the caller commits
+            status: only write rows whose entity.status == status
+            conflict: exception raised when the row exists with another
+                      status, only looked up when nothing was written
+        raise exc.NoResultFound(message) when no row matched
+        """
+        q = session.query(entity).filter(criterion)
+        if status is not None:
+            q = q.filter(entity.status == status)
+        if values is None:
+            count = q.delete(synchronize_session=False)
+        else:
+            if 'version' in entity.__table__.c:
+                values = dict(values, version=entity.version + 1)
+            count = q.update(values, synchronize_session=False)
+        if count:
+            return count
+        if conflict is not None and \
+                session.query(entity).filter(criterion).count():
+            raise conflict
+        raise exc.NoResultFound(message)
+
+    def _write_one(self, entity, criterion, message, change=None, **kwargs):
+        """
+        _write_row in its own session and transaction, change: the
+        _add_change kwargs of the write, added in the same transaction
+        """
+        session = self.engine.get_session()
         try:
-            LOG.debug('db Instance delete id: %s' % vm_id)
-            session = self.engine.get_session()
-            q = session.query(models.Vm).filter(models.Vm.vm_id == vm_id)
-            q.one()
-            q.update(kwargs)
+            if change is not None:
+                # first: a deleted row is no longer there to find its routes
+                self._add_change(session, **change)
+            count = self._write_row(session, entity, criterion, message, **kwargs)
             session.commit()
-        except NoResultFound:
-            raise exc.NoResultFound('not found vm')
+            return count
+        finally:
+            session.close()
+
+    def _add_change(self, session, object_type, object_id, subinterfaces=None,
+                    site_name=None):
+        """
+        add the change of an object to the outbox (models.Change) in the
+        caller's transaction, one row per route of the subinterfaces that
+        criterion matches, or one site wide row for site_name (a value or
+        a scalar select), in one INSERT
+        """
+        change = models.Change.__table__
+        if subinterfaces is None:
+            session.execute(change.insert().values(
+                object_type=object_type, object_id=str(object_id),
+                route_id=None, site_name=site_name,
+                created_at=datetime.datetime.utcnow()))
+            return
+        sub = models.Subinterface.__table__
+        interface = models.Interface.__table__
+        route = models.Route.__table__
+        site = models.Site.__table__
+        stmt = select([literal(object_type), literal(str(object_id)),
+                       interface.c.route_id, site.c.site_name,
+                       literal(datetime.datetime.utcnow(), DateTime)]).\
+            select_from(sub.join(interface).
+                        join(route, interface.c.route_id == route.c.route_id).
+                        join(site, route.c.site_id == site.c.site_id)).\
+            where(subinterfaces).distinct()
+        session.execute(change.insert().from_select(
+            ['object_type', 'object_id', 'route_id', 'site_name', 'created_at'],
+            stmt))
+
+    def _select_rows(self, row_cls, stmt):
+        """
+        run a Core select on a raw connection and build row_cls tuples,
+        nothing is loaded into a session or identity map
+        """
+        try:
+            conn = self.engine.get_engine().connect()
+            try:
+                return [row_cls(*row) for row in conn.execute(stmt)]
+            finally:
+                conn.close()
+        except sqla_exc.SQLAlchemyError as e:
+            raise exc.DBError(e)
+
+    def list_vm_rows(self, app_id, **kwargs):
+        """
+        read-only variant of list_vm(app_id=xx), return list of rows.VmRow
+            kwargs = {'status': xx}
+        """
+        vm = models.Vm.__table__
+        stmt = select(rows.VmRow.columns).where(vm.c.app_id == app_id)
+        if kwargs.get('status', None):
+            stmt = stmt.where(vm.c.status == kwargs['status'])
+        return self._select_rows(rows.VmRow, stmt)
+
+    def list_subinterface_rows_from_route(self, route_id, **kwargs):
+        """
+        read-only variant of list_subinterface_from_route, the route is
+        matched in sql instead of walking subinterface.interface
+            kwargs = {'status': xx}
+        return list of rows.SubinterfaceRow
+        """
+        if 'status' not in kwargs:
+            raise exc.NotFoundKey("not support status in subinterface")
+        subinterface = models.Subinterface.__table__
+        interface = models.Interface.__table__
+        stmt = select(rows.SubinterfaceRow.columns).\
+            select_from(subinterface.join(interface)).\
+            where(interface.c.route_id == route_id).\
+            where(subinterface.c.status == kwargs['status'])
+        return self._select_rows(rows.SubinterfaceRow, stmt)
+
+    def list_action_rows(self, status, **kwargs):
+        """
+        read-only variant of list_action(status=xx), return list of rows.ActionRow
+            kwargs = {'action': xx}
+        """
+        action = models.Action.__table__
+        stmt = select(rows.ActionRow.columns).where(action.c.status == status)
+        if kwargs.get('action', None):
+            stmt = stmt.where(action.c.action == kwargs['action'])
+        return self._select_rows(rows.ActionRow, stmt)
+
+    def report_manager(self, host, topic, site_name):
+        """
+        refresh the heartbeat of a rosmanager instance, see
+        models.ManagerHeartbeat
+        """
+        session = self.engine.get_session()
+        try:
+            values = {'site_name': site_name,
+                      'updated_at': datetime.datetime.utcnow()}
+            count = session.query(models.ManagerHeartbeat).\
+                filter(models.ManagerHeartbeat.host == host).\
+                filter(models.ManagerHeartbeat.topic == topic).\
+                update(values, synchronize_session=False)
+            if not count:
+                session.add(models.ManagerHeartbeat(host, topic, site_name,
+                                                    values['updated_at']))
+            session.commit()
+        except sqla_exc.SQLAlchemyError as e:
+            raise exc.DBError(e)
+        finally:
+            session.close()
+
+    def list_live_manager(self, topic, site_name, timeout):
+        """
+        hosts of the rosmanager instances of topic and site_name (None: of
+        every site) which reported in the last timeout seconds, sorted
+        """
+        since = datetime.datetime.utcnow() - datetime.timedelta(seconds=timeout)
+        session = self.engine.get_session()
+        try:
+            query = session.query(models.ManagerHeartbeat.host).\
+                filter(models.ManagerHeartbeat.topic == topic).\
+                filter(models.ManagerHeartbeat.updated_at >= since)
+            if site_name is not None:
+                query = query.filter(models.ManagerHeartbeat.site_name == site_name)
+            return sorted(set(row.host for row in query))
+        except sqla_exc.SQLAlchemyError as e:
+            raise exc.DBError(e)
+        finally:
+            session.close()
+
+    def get_route_site_name(self, route_id):
+        """
+        return the site_name of route_id, None if unknown
+        """
+        if not models.is_uuid(route_id):
+            return None
+        try:
+            session = self.engine.get_session()
+            row = session.query(models.Site.site_name).\
+                join(models.Route, models.Route.site_id == models.Site.site_id).\
+                filter(models.Route.route_id == route_id).first()
+            return row.site_name if row else None
+        except sqla_exc.SQLAlchemyError as e:
+            raise exc.DBError(e)
+        finally:
+            session.close()
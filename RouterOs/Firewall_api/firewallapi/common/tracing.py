@@ -0,0 +1,100 @@
+"""
+    Distributed tracing on osprofiler.
+
+    With tracing on, TraceHook starts a trace per http request, the trace
+    ids travel in the rpc context (stamp_context) and the manager
+    continues them (rosmanager.common.tracing), the dao methods and their
+    sql statements are traced as 'db' spans. Every span start and stop is
+    appended as a json line to a local file, tools/trace_report.py
+    rebuilds the span trees from the files of all processes.
+"""
+
+__author__ = 'hardy.Zheng'
+
+import inspect
+import json
+import logging
+import logging.handlers
+import os
+import socket
+import time
+
+from osprofiler import notifier
+from osprofiler import profiler
+
+
+class FileCollector(object):
+    """osprofiler notifier appending json lines to a rotating file"""
+
+    def __init__(self, path, service, max_size=10, back_count=5):
+        self.service = service
+        self.host = socket.gethostname()
+        self.pid = os.getpid()
+        self.logger = logging.getLogger('%s.trace' % service)
+        if not self.logger.handlers:
+            handler = logging.handlers.RotatingFileHandler(
+                path, maxBytes=max_size * 1024 * 1024, backupCount=back_count)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self.logger.addHandler(handler)
+            self.logger.setLevel(logging.INFO)
+            self.logger.propagate = False
+
+    def __call__(self, info):
+        record = dict(info)
+        record['time'] = time.time()
+        record['service'] = self.service
+        record['host'] = self.host
+        record['pid'] = self.pid
+        self.logger.info(json.dumps(record, default=str))
+
+
+def setup(path, service, max_size=10, back_count=5):
+    notifier.set(FileCollector(path, service, max_size, back_count))
+
+
+def trace_methods(cls, name):
+    """trace the public methods defined on cls as name spans, arguments
+    are left out of the spans (they hold router passwords)
+    """
+    for attr, func in list(vars(cls).items()):
+        if attr.startswith('_') or not inspect.isfunction(func):
+            continue
+        if getattr(func, '_traced', False):
+            continue
+        traced = profiler.trace(name, hide_args=True)(func)
+        traced._traced = True
+        setattr(cls, attr, traced)
+
+
+def trace_engine(engine, name='db'):
+    """trace every sql statement of engine while a trace is active"""
+    from osprofiler import sqlalchemy as profiler_sqlalchemy
+    import sqlalchemy
+    profiler_sqlalchemy.add_tracing(sqlalchemy, engine, name)
+
+
+def trace_info():
+    """ids of the active trace to put in a rpc context, None without"""
+    prof = profiler.get()
+    if not prof:
+        return None
+    return {
+        "hmac_key": prof.hmac_key,
+        "base_id": prof.get_base_id(),
+        "parent_id": prof.get_id(),
+    }
+
+
+def begin(hmac_key, name, info=None):
+    profiler.init(hmac_key)
+    profiler.start(name, info=info)
+
+
+def end(info=None):
+    """stop the span of begin() and drop the thread's profiler"""
+    if not profiler.get():
+        return
+    try:
+        profiler.stop(info=info)
+    finally:
+        profiler.clean()
@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Author: Hardy.zheng <wei.zheng@yun-idc>
+#
+
+import pecan
+from pecan import rest
+from pecan import request
+
+
+class DbStatsController(rest.RestController):
+    """per dao method statement latency, see [mysql] query_stats"""
+
+    @pecan.expose('json')
+    def get_all(self):
+        return request.db_connection.get_query_stats()
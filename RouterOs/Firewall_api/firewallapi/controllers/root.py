@@ -7,11 +7,15 @@
 import pecan
 
 from firewallapi.controllers.vm import VmController
+from firewallapi.controllers.dbstats import DbStatsController
+from firewallapi.controllers.rpcstats import RpcStatsController
 
 
 class RootController(object):
 
     vm = VmController()
+    dbstats = DbStatsController()
+    rpcstats = RpcStatsController()
 
     @pecan.expose(generic=True, template='index.html')
     def index(self):
@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Author: Hardy.zheng <wei.zheng@yun-idc>
+#
+
+import pecan
+from pecan import rest
+from pecan import request
+
+
+class RpcStatsController(rest.RestController):
+    """rpc client pool occupancy and queue depths, see rpc.ClientCache"""
+
+    @pecan.expose('json')
+    def get_all(self):
+        stats = request.client_cache.stats()
+        if getattr(request, 'backpressure', None) is not None:
+            stats['backpressure'] = request.backpressure.stats()
+        if getattr(request, 'lanes', None) is not None:
+            stats['lanes'] = dict(request.lanes.sent)
+        return stats
@@ -28,7 +28,7 @@ class VmController(rest.RestController):
         ctxt = {'ceo': 'laoqusb'}
         kwargs = {'sb': 'cds', 'eg': 'gic'}
 
-        request.client.cast(ctxt, 'add', **kwargs)
+        request.lanes.prepare('add').cast(ctxt, 'add', **kwargs)
         return vms
         # try:
             # db_vms = request.db_connection.list_vm_meter()
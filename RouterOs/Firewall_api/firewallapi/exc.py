@@ -177,6 +177,15 @@ class DBDeadlock(DBError):
         super(DBDeadlock, self).__init__(inner_exception)
 
 
+class DBConflict(DBError):
+    """A versioned row was changed by someone else since it was read.
+
+    code is used by wsmeext.pecan as the response status, API clients get
+    a 409 and should read the row again and retry.
+    """
+    code = 409
+
+
 class DBInvalidUnicodeParameter(Exception):
     message = "Invalid Parameter: Unicode is not supported by the current database."
 
@@ -4,8 +4,12 @@ __author__ = 'hardy.Zheng'
 __email__ = 'wei.zheng@yun-idc.com'
 
 
+import atexit
+
+import pecan
 from pecan import hooks
 from firewallapi.common.session import Connection
+from firewallapi.common import tracing
 from firewallapi import __version__
 from firewallapi import rpc
 
@@ -19,10 +23,80 @@ class APIHook(hooks.PecanHook):
         raise NotImplementedError('API Not Implemented')
 
 
+class TraceHook(hooks.PecanHook):
+    """one trace per request, see common/tracing.py"""
+
+    def __init__(self, conf):
+        self.hmac_key = conf.trace_hmac_key
+
+    def before(self, state):
+        tracing.begin(self.hmac_key, 'wsgi',
+                      info={'method': state.request.method,
+                            'path': state.request.path})
+
+    def after(self, state):
+        tracing.end(info={'status': state.response.status_int})
+
+    def on_error(self, state, e):
+        tracing.end(info={'error': str(e)})
+
+
+class BackpressureHook(hooks.PecanHook):
+    """shed writes while the rpc queue they send to is backed up, see
+    common/backpressure.py. runs after MessageHook, a write gets a
+    request.lanes checking the queue of each client it prepares
+    """
+
+    def __init__(self, backpressure):
+        self.backpressure = backpressure
+
+    def before(self, state):
+        state.request.backpressure = self.backpressure
+        if state.request.method.upper() in self.backpressure.MUTATING:
+            state.request.lanes = _SheddingLanes(state.request.lanes,
+                                                 self.backpressure,
+                                                 state.request.method)
+
+
+class _SheddingLanes(object):
+    """rpc.LaneRouter of a write, aborts it when the queue of its cast is
+    backed up
+    """
+
+    def __init__(self, lanes, backpressure, method):
+        self._lanes = lanes
+        self._backpressure = backpressure
+        self._method = method
+
+    def __getattr__(self, name):
+        return getattr(self._lanes, name)
+
+    def prepare(self, method, count=1, route_id=None):
+        topic, server = self._lanes.route(method, count, route_id)
+        # oslo.messaging consumes a server's casts from <topic>.<server>
+        queue = topic if server is None else '%s.%s' % (topic, server)
+        verdict = self._backpressure.check(self._method, [queue])
+        if verdict is not None:
+            status, retry_after = verdict
+            pecan.abort(status, 'router manager is overloaded, retry later',
+                        headers={'Retry-After': str(retry_after)})
+        return self._lanes.client_for(topic, server)
+
+
 class DBHook(hooks.PecanHook):
 
-    def __init__(self, engine_url):
-        self.db_connection = Connection(engine_url)
+    def __init__(self, conf):
+        mysql = conf.mysql
+        self.db_connection = Connection(mysql.engine)
+        if conf.trace_enabled:
+            tracing.trace_methods(Connection, 'db')
+            tracing.trace_engine(self.db_connection.engine.get_engine())
+        if mysql.query_stats or mysql.slow_query_log:
+            self.db_connection.instrument(
+                threshold=mysql.slow_query_threshold,
+                slow_log=mysql.slow_query_log,
+                max_size=mysql.slow_query_max_size,
+                back_count=mysql.slow_query_back_count)
 
     def before(self, state):
         state.request.db_connection = self.db_connection
@@ -30,9 +104,35 @@ class DBHook(hooks.PecanHook):
 
 class MessageHook(hooks.PecanHook):
 
-    def __init__(self, conf):
-        target = rpc.get_target(conf.oslo_messaging_rabbit.topic, __version__)
-        self.client = rpc.get_client(target)
+    def __init__(self, conf, db_connection=None):
+        rabbit = conf.oslo_messaging_rabbit
+        target = rpc.get_target(rabbit.topic, __version__)
+        self.cache = rpc.ClientCache(
+            rpc.get_client(target),
+            pool_size=rabbit.client_pool_size or None,
+            max_clients=rabbit.client_cache_size)
+        self.client = self.cache
+        if rabbit.cast_batch_window > 0:
+            self.client = rpc.CoalescingClient(
+                self.client,
+                window=rabbit.cast_batch_window / 1000.0,
+                max_messages=rabbit.cast_batch_size)
+            atexit.register(self.client.stop)
+        self.sharder = None
+        if conf.route_sharding and db_connection is not None:
+            self.sharder = rpc.RouteSharder(
+                self.client, db_connection, rabbit.topic,
+                timeout=conf.manager_heartbeat_timeout,
+                replicas=conf.shard_replicas,
+                refresh=conf.shard_refresh)
+        self.lanes = rpc.LaneRouter(
+            self.client, rabbit.topic, rabbit.rpc_lanes,
+            bulk_threshold=rabbit.lane_bulk_threshold,
+            reconcile_methods=rabbit.lane_reconcile_methods,
+            sharder=self.sharder)
 
     def before(self, state):
         state.request.client = self.client
+        state.request.lanes = self.lanes
+        state.request.client_cache = self.cache
+        state.request.sharder = self.sharder
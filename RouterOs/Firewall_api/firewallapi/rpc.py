@@ -24,13 +24,28 @@ __all__ = [
     'get_client',
     'get_server',
     'get_notifier',
+    'CoalescingClient',
+    'LaneRouter',
+    'ClientCache',
+    'RouteSharder',
+    'stamp_context',
 ]
 
 
+import collections
+import logging
+import threading
+import time
+import uuid
+
 from oslo_config import cfg
 import oslo_messaging as messaging
 from osprofiler import profiler
 
+from firewallapi.common import hashring
+from firewallapi.common import serializer as rpc_serializer
+from firewallapi.common import tracing
+
 # from trove.common.context import TroveContext
 # import trove.common.exception
 # from trove.openstack.common import jsonutils
@@ -39,6 +54,10 @@ from osprofiler import profiler
 CONF = cfg.CONF
 TRANSPORT = None
 NOTIFIER = None
+LOG = logging.getLogger(__name__)
+
+# method name of the batched cast, unpacked by rosmanager Manager.batch
+BATCH_METHOD = 'batch'
 
 
 def init(conf):
@@ -95,14 +114,45 @@ def get_transport_url(url_str=None):
     return messaging.TransportURL.parse(CONF, url_str, {})
 
 
+def get_amqp_url(conf):
+    """kombu url of the first broker, for talking to rabbitmq directly"""
+    url = get_transport_url(getattr(conf, 'transport_url', None))
+    if url.hosts:
+        host = url.hosts[0]
+        return 'amqp://%s:%s@%s:%s/%s' % (host.username or 'guest',
+                                          host.password or 'guest',
+                                          host.hostname, host.port or 5672,
+                                          url.virtual_host or '')
+    rabbit = conf.oslo_messaging_rabbit
+    return 'amqp://%s:%s@%s/%s' % (rabbit.rabbit_userid, rabbit.rabbit_password,
+                                   rabbit.rabbit_hosts[0], rabbit.rabbit_virtual_host)
+
+
 def get_client(target, version_cap=None, serializer=None):
+    """
+    serializer: payload format name, defaults to [oslo_messaging_rabbit]
+    rpc_serializer. msgpack is only sent when version_cap allows
+    MSGPACK_VERSION, json otherwise, see common/serializer.py
+    """
     assert TRANSPORT is not None
     # serializer = RequestContextSerializer(serializer)
-    serializer = messaging.JsonPayloadSerializer()
+    rabbit = CONF.oslo_messaging_rabbit
+    name = serializer or rabbit.rpc_serializer
+    version_cap = version_cap or rabbit.rpc_version_cap or None
+    client = messaging.RPCClient(TRANSPORT,
+                                 target,
+                                 version_cap=version_cap,
+                                 serializer=rpc_serializer.get_serializer(name))
+    if name != 'msgpack':
+        return client
+    if client.can_send_version(rpc_serializer.MSGPACK_VERSION):
+        return client.prepare(version=rpc_serializer.MSGPACK_VERSION)
+    LOG.warning('rpc_version_cap %s is below %s, sending json payloads'
+                % (version_cap, rpc_serializer.MSGPACK_VERSION))
     return messaging.RPCClient(TRANSPORT,
                                target,
                                version_cap=version_cap,
-                               serializer=serializer)
+                               serializer=rpc_serializer.get_serializer('json'))
 
 
 def get_server(target, endpoints, serializer=None):
@@ -142,3 +192,390 @@ def get_target(topic, version):
                             version=version)
     # return messaging.Target(topic=topic,
                             # version=version)
+
+
+def stamp_context(ctxt):
+    """return ctxt with a request_id, the manager skips a request_id it has
+    already handled (rosmanager.common.dedup), so redeliveries are no-ops.
+    The ids of the active trace go along as trace_info
+    """
+    trace_info = tracing.trace_info()
+    if isinstance(ctxt, dict):
+        if ctxt.get('request_id') and (not trace_info or 'trace_info' in ctxt):
+            return ctxt
+        ctxt = dict(ctxt)
+        ctxt.setdefault('request_id', 'req-%s' % uuid.uuid4())
+        if trace_info:
+            ctxt.setdefault('trace_info', trace_info)
+    elif getattr(ctxt, 'request_id', True) is None:
+        ctxt.request_id = 'req-%s' % uuid.uuid4()
+    return ctxt
+
+
+class ClientCache(object):
+    """RPC client facade for fanning out to many router managers.
+
+    prepare(topic=, server=, version=) returns a client cached per
+    (topic, server, version), so routing a cast to one manager does not
+    build a new prepared client per message. At most pool_size casts and
+    calls are in flight at once, which keeps the publishers within the
+    transport connection pool (rpc_conn_pool_size) instead of growing it,
+    callers beyond that wait for a free slot. stats() reports occupancy.
+    """
+
+    def __init__(self, client, pool_size=None, max_clients=256):
+        if pool_size is None:
+            pool_size = getattr(CONF, 'rpc_conn_pool_size', 30)
+        self.client = client
+        self.target = client.target
+        self.pool_size = pool_size
+        self.max_clients = max_clients
+        self._clients = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(pool_size)
+        self._in_use = 0
+        self._waiting = 0
+        self._peak = 0
+        self._hits = 0
+        self._misses = 0
+
+    def prepare(self, topic=None, server=None, version=None, **kwargs):
+        if kwargs:
+            # timeout, fanout... are rarely used, do not cache them
+            for name, value in (('topic', topic), ('server', server),
+                                ('version', version)):
+                if value is not None:
+                    kwargs[name] = value
+            return _PooledClient(self, self.client.prepare(**kwargs))
+        key = (topic or self.target.topic, server or self.target.server,
+               version or self.target.version)
+        with self._lock:
+            client = self._clients.pop(key, None)
+            if client is not None:
+                self._hits += 1
+            else:
+                self._misses += 1
+                client = _PooledClient(self, self.client.prepare(
+                    topic=key[0], server=key[1], version=key[2]))
+            self._clients[key] = client
+            while len(self._clients) > self.max_clients:
+                self._clients.popitem(last=False)
+        return client
+
+    def cast(self, ctxt, method, **kwargs):
+        return self._invoke(self.client.cast, ctxt, method, kwargs)
+
+    def call(self, ctxt, method, **kwargs):
+        return self._invoke(self.client.call, ctxt, method, kwargs)
+
+    def _invoke(self, func, ctxt, method, kwargs):
+        ctxt = stamp_context(ctxt)
+        with self._lock:
+            self._waiting += 1
+        self._slots.acquire()
+        with self._lock:
+            self._waiting -= 1
+            self._in_use += 1
+            self._peak = max(self._peak, self._in_use)
+        try:
+            return func(ctxt, method, **kwargs)
+        finally:
+            with self._lock:
+                self._in_use -= 1
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                'pool_size': self.pool_size,
+                'in_use': self._in_use,
+                'waiting': self._waiting,
+                'peak': self._peak,
+                'clients': len(self._clients),
+                'client_hits': self._hits,
+                'client_misses': self._misses,
+            }
+        # the rabbit driver pool, only when the transport exposes it
+        pool = getattr(getattr(TRANSPORT, '_driver', None),
+                       '_connection_pool', None)
+        if pool is not None:
+            stats['connections'] = getattr(pool, '_current_size', None)
+            stats['connections_max'] = getattr(pool, '_max_size', None)
+            stats['connections_idle'] = len(getattr(pool, '_items', ()))
+        return stats
+
+
+class _PooledClient(object):
+    """a prepared client of ClientCache, publishes through its slots"""
+
+    def __init__(self, cache, client):
+        self.cache = cache
+        self.client = client
+        self.target = client.target
+
+    def prepare(self, **kwargs):
+        kwargs.setdefault('topic', self.target.topic)
+        kwargs.setdefault('server', self.target.server)
+        kwargs.setdefault('version', self.target.version)
+        return self.cache.prepare(**kwargs)
+
+    def cast(self, ctxt, method, **kwargs):
+        return self.cache._invoke(self.client.cast, ctxt, method, kwargs)
+
+    def call(self, ctxt, method, **kwargs):
+        return self.cache._invoke(self.client.call, ctxt, method, kwargs)
+
+
+class RouteSharder(object):
+    """Route casts to the rosmanager instance owning a route.
+
+    prepare(route_id) returns the client prepared for the server (host)
+    owning route_id on the ring of the route's site, see
+    common/hashring.py. With no live instance known the plain client is
+    returned and any manager consuming the topic gets the message.
+    """
+
+    def __init__(self, client, db_connection, topic, timeout=30,
+                 replicas=64, refresh=5):
+        self.client = client
+        self.db_connection = db_connection
+        self.topic = topic
+        self.timeout = timeout
+        self.replicas = replicas
+        self.refresh = refresh
+        # route_id -> site_name, routes never change site
+        self._sites = {}
+        # site_name -> hashring.ManagerRing
+        self._rings = {}
+        self._lock = threading.Lock()
+
+    def _ring(self, site_name):
+        with self._lock:
+            ring = self._rings.get(site_name)
+            if ring is None:
+                ring = self._rings[site_name] = hashring.ManagerRing(
+                    self.db_connection, self.topic, site_name,
+                    timeout=self.timeout, replicas=self.replicas,
+                    refresh=self.refresh)
+            return ring
+
+    def owner(self, route_id):
+        site_name = self._sites.get(route_id)
+        if site_name is None:
+            site_name = self.db_connection.get_route_site_name(route_id)
+            if site_name is None:
+                return None
+            self._sites[route_id] = site_name
+        return self._ring(site_name).get_host(route_id)
+
+    def prepare(self, route_id):
+        host = self.owner(route_id)
+        if host is None:
+            return self.client
+        return self.client.prepare(server=host)
+
+
+class LaneRouter(object):
+    """Pick the priority lane of an operation.
+
+    The rosmanagers consume one <topic>.<lane> queue per lane and serve
+    the interactive lane first (rosmanager rpc_lanes). Methods listed in
+    reconcile_methods go to the reconcile lane, operations on
+    bulk_threshold objects or more to the bulk lane, the rest to the
+    interactive lane. Without lanes everything goes to the plain topic.
+    """
+
+    INTERACTIVE = 'interactive'
+    BULK = 'bulk'
+    RECONCILE = 'reconcile'
+
+    def __init__(self, client, topic, lanes=(), bulk_threshold=20,
+                 reconcile_methods=(), sharder=None):
+        self.client = client
+        self.topic = topic
+        # accept the rosmanager name:weight form too
+        self.lanes = set(lane.split(':')[0].strip() for lane in lanes)
+        self.bulk_threshold = bulk_threshold
+        self.reconcile_methods = set(reconcile_methods)
+        self.sharder = sharder
+        self.sent = dict((lane, 0) for lane in self.lanes)
+
+    def pick(self, method, count=1):
+        """lane of method acting on count objects, None without lanes"""
+        if not self.lanes:
+            return None
+        if method in self.reconcile_methods and self.RECONCILE in self.lanes:
+            lane = self.RECONCILE
+        elif count >= self.bulk_threshold and self.BULK in self.lanes:
+            lane = self.BULK
+        else:
+            lane = self.INTERACTIVE
+        self.sent[lane] = self.sent.get(lane, 0) + 1
+        return lane
+
+    def lane_topic(self, lane):
+        if lane is None:
+            return self.topic
+        return '%s.%s' % (self.topic, lane)
+
+    def route(self, method, count=1, route_id=None):
+        """(topic, server) to send method on: its lane and, with route
+        sharding, the manager owning route_id, None for any manager
+        """
+        topic = self.lane_topic(self.pick(method, count))
+        server = None
+        if self.sharder is not None and route_id is not None:
+            server = self.sharder.owner(route_id)
+        return topic, server
+
+    def client_for(self, topic, server=None):
+        kwargs = {}
+        if topic != self.topic:
+            kwargs['topic'] = topic
+        if server is not None:
+            kwargs['server'] = server
+        if not kwargs:
+            return self.client
+        return self.client.prepare(**kwargs)
+
+    def prepare(self, method, count=1, route_id=None):
+        """client to send method on, see route()"""
+        return self.client_for(*self.route(method, count, route_id))
+
+
+class CoalescingClient(object):
+    """Buffer casts per (topic, server, method) and publish them together.
+
+    A buffer is flushed as one BATCH_METHOD cast carrying every buffered
+    (context, kwargs) item once it holds max_messages casts or its oldest
+    cast is window seconds old, whichever comes first. A cast of another
+    method to the same target flushes the buffer of that target first, and
+    call() is sent right away after flushing it, so the router manager
+    sees the messages in the order they were sent. The publishes to one
+    target are serialized.
+    """
+
+    def __init__(self, client, window=0.005, max_messages=100):
+        self.client = client
+        self.window = window
+        self.max_messages = max_messages
+        # (topic, server, method) -> [prepared client, deadline, items],
+        # one buffer per (topic, server) at most
+        self._buffers = {}
+        # (topic, server) -> lock held while taking and publishing its buffer
+        self._targets = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._stopped = False
+        self._flusher = threading.Thread(target=self._run,
+                                         name='rpc-coalescer')
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def prepare(self, **kwargs):
+        return _PreparedCoalescer(self, self.client.prepare(**kwargs))
+
+    def cast(self, ctxt, method, **kwargs):
+        self._cast(self.client, ctxt, method, kwargs)
+
+    def call(self, ctxt, method, **kwargs):
+        return self._call(self.client, ctxt, method, kwargs)
+
+    def _key(self, client, method):
+        return (client.target.topic, client.target.server, method)
+
+    def _target_lock(self, target):
+        with self._lock:
+            lock = self._targets.get(target)
+            if lock is None:
+                lock = self._targets[target] = threading.Lock()
+            return lock
+
+    def _cast(self, client, ctxt, method, kwargs):
+        key = self._key(client, method)
+        item = {'context': stamp_context(ctxt), 'kwargs': kwargs}
+        with self._target_lock(key[:2]):
+            with self._lock:
+                # what is buffered for another method goes out first
+                before = [(other, self._buffers.pop(other)) for other in list(self._buffers)
+                          if other[:2] == key[:2] and other != key]
+                buf = self._buffers.get(key)
+                if buf is None:
+                    buf = self._buffers[key] = [client, time.time() + self.window, []]
+                    self._wakeup.notify()
+                buf[2].append(item)
+                full = len(buf[2]) >= self.max_messages
+                if full:
+                    del self._buffers[key]
+            for other, (other_client, _, items) in before:
+                self._publish(other, other_client, items)
+            if full:
+                self._publish(key, buf[0], buf[2])
+
+    def _call(self, client, ctxt, method, kwargs):
+        target = (client.target.topic, client.target.server)
+        self._flush(lambda key: key[:2] == target)
+        return client.call(ctxt, method, **kwargs)
+
+    def _publish(self, key, client, items):
+        try:
+            if len(items) == 1:
+                client.cast(items[0]['context'], key[2], **items[0]['kwargs'])
+            else:
+                client.cast({}, BATCH_METHOD, cast_method=key[2], items=items)
+        except Exception as e:
+            LOG.error('publish %d %s casts to %s.%s failed: %s'
+                      % (len(items), key[2], key[0], key[1], e))
+
+    def _flush(self, match=None, now=None):
+        with self._lock:
+            keys = [key for key, buf in self._buffers.items()
+                    if (match is None or match(key))
+                    and (now is None or buf[1] <= now)]
+        for key in keys:
+            with self._target_lock(key[:2]):
+                with self._lock:
+                    # published by a cast meanwhile
+                    buf = self._buffers.pop(key, None)
+                if buf is not None:
+                    self._publish(key, buf[0], buf[2])
+
+    def flush(self):
+        """publish everything buffered now"""
+        self._flush()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._buffers and not self._stopped:
+                    self._wakeup.wait()
+                if self._stopped:
+                    return
+                delay = min(buf[1] for buf in self._buffers.values()) - time.time()
+                if delay > 0:
+                    self._wakeup.wait(delay)
+            self._flush(now=time.time())
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            self._wakeup.notify()
+        self._flusher.join()
+        self.flush()
+
+
+class _PreparedCoalescer(object):
+    """CoalescingClient.prepare(), shares the buffers of its parent"""
+
+    def __init__(self, parent, client):
+        self.parent = parent
+        self.client = client
+
+    def prepare(self, **kwargs):
+        return _PreparedCoalescer(self.parent, self.client.prepare(**kwargs))
+
+    def cast(self, ctxt, method, **kwargs):
+        self.parent._cast(self.client, ctxt, method, kwargs)
+
+    def call(self, ctxt, method, **kwargs):
+        return self.parent._call(self.client, ctxt, method, kwargs)
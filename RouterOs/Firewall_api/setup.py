@@ -49,7 +49,9 @@ setup(
         'jsonschema>=2.0.0,<3.0.0',
         'jsonpath-rw>=1.2.0,<2.0',
         'anyjson>=0.3.3',
-        'sqlalchemy>=0.7'],
+        'sqlalchemy>=1.0',
+        'msgpack>=0.5.2',
+        'kombu>=3.0.7'],
 
     packages=find_packages(),
     namespace_packages=['firewallapi'],
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+#
+# Move finished actions into action_history and keep its monthly
+# partitions ahead of time, meant to run from cron.
+#
+#   python tools/action_archive.py --engine mysql+mysqldb://... archive --days 30 --status ok,error
+#   python tools/action_archive.py --engine mysql+mysqldb://... partition --months 3
+#
+# archive needs --status, the action status values that no longer change:
+# this tree only ever writes 'processing', the final ones are set elsewhere.
+#
+# partition is optional and mysql only: the first run switches action_history
+# to RANGE partitioning on TO_DAYS(trigger_time), later runs split the
+# catch-all 'pmax' partition so the next --months months have their own.
+
+__author__ = 'hardy.Zheng'
+
+import datetime
+import sys
+from optparse import OptionParser
+
+from firewallapi.common import db_models as models
+from firewallapi.common.session import Connection
+
+
+parser = OptionParser(usage='%prog [options] archive|partition')
+parser.add_option("-e", "--engine", dest="engine",
+                  help="sqlalchemy engine url")
+parser.add_option("-d", "--days", dest="days", type="int", default=30,
+                  help="archive finished actions older than days")
+parser.add_option("-s", "--status", dest="status", default="",
+                  help="comma separated status values of finished actions")
+parser.add_option("-b", "--batch", dest="batch", type="int", default=500,
+                  help="rows moved per transaction")
+parser.add_option("-m", "--months", dest="months", type="int", default=3,
+                  help="months of partitions created ahead")
+
+
+def _month_start(day, offset=0):
+    month = day.month - 1 + offset
+    return datetime.date(day.year + month / 12, month % 12 + 1, 1)
+
+
+def _partition(start):
+    end = _month_start(start, 1)
+    return ("PARTITION p%s VALUES LESS THAN (TO_DAYS('%s'))"
+            % (start.strftime('%Y%m'), end.isoformat()))
+
+
+def partition(engine, months):
+    if engine.name != 'mysql':
+        print 'partitioning is only supported on mysql'
+        return 1
+    existing = [row[0] for row in engine.execute(
+        "SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'action_history' "
+        "AND PARTITION_NAME IS NOT NULL")]
+    today = datetime.date.today()
+    if not existing:
+        oldest = engine.execute('SELECT MIN(trigger_time) FROM action_history').scalar()
+        first = _month_start(oldest.date() if oldest else today)
+        wanted = []
+        while first <= _month_start(today, months):
+            wanted.append(_partition(first))
+            first = _month_start(first, 1)
+        wanted.append('PARTITION pmax VALUES LESS THAN MAXVALUE')
+        engine.execute('ALTER TABLE action_history PARTITION BY RANGE '
+                       '(TO_DAYS(trigger_time)) (%s)' % ', '.join(wanted))
+        print 'partitioned action_history: %d partitions' % len(wanted)
+        return 0
+    wanted = []
+    for offset in range(months + 1):
+        start = _month_start(today, offset)
+        if 'p%s' % start.strftime('%Y%m') not in existing:
+            wanted.append(_partition(start))
+    if not wanted:
+        print 'partitions are up to date'
+        return 0
+    wanted.append('PARTITION pmax VALUES LESS THAN MAXVALUE')
+    engine.execute('ALTER TABLE action_history REORGANIZE PARTITION pmax INTO (%s)'
+                   % ', '.join(wanted))
+    print 'added %d partitions' % (len(wanted) - 1)
+    return 0
+
+
+def main():
+    (options, args) = parser.parse_args()
+    if not options.engine or len(args) != 1 or args[0] not in ('archive', 'partition'):
+        parser.error('usage: %s --engine=url archive|partition' % sys.argv[0])
+    conn = Connection(options.engine)
+    engine = conn.engine.get_engine()
+    models.ActionHistory.__table__.create(engine, checkfirst=True)
+    if args[0] == 'partition':
+        return partition(engine, options.months)
+    status = [value.strip() for value in options.status.split(',') if value.strip()]
+    if not status:
+        parser.error('archive needs --status, eg: --status ok,error')
+    before = datetime.datetime.now() - datetime.timedelta(days=options.days)
+    moved = conn.archive_action(before, status, batch_size=options.batch)
+    print 'archived %d actions triggered before %s' % (moved, before)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+#
+# Add the 'version' column used for optimistic concurrency to existing
+# vm, subinterface, gic and gicextension tables.
+#
+#   python tools/add_row_versions.py --engine mysql+mysqldb://...
+#
+# Tables which already have the column are left alone.
+
+__author__ = 'hardy.Zheng'
+
+import sys
+from optparse import OptionParser
+
+import sqlalchemy
+
+from firewallapi.common import db_models as models
+
+
+parser = OptionParser()
+parser.add_option("-e", "--engine", dest="engine",
+                  help="sqlalchemy engine url")
+
+_VERSIONED = (models.Vm, models.Subinterface, models.Gic, models.GicExtension)
+
+
+def main():
+    (options, args) = parser.parse_args()
+    if not options.engine:
+        parser.error('usage: %s --engine=url' % sys.argv[0])
+    engine = sqlalchemy.create_engine(options.engine)
+    inspector = sqlalchemy.inspect(engine)
+    for model in _VERSIONED:
+        table = model.__tablename__
+        if 'version' in [c['name'] for c in inspector.get_columns(table)]:
+            print '%s: already versioned' % table
+            continue
+        engine.execute('ALTER TABLE %s ADD COLUMN version INTEGER NOT NULL DEFAULT 0'
+                       % table)
+        print '%s: added version' % table
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+#
+# Compare the ORM list_* methods of session.Connection with the Core
+# list_*_rows() read path.
+#
+#   python tools/bench_read_path.py --rows 50000
+#   python tools/bench_read_path.py --engine mysql+mysqldb://... --rows 50000
+#
+# The default engine is a sqlite file under /tmp, the tables are created
+# and filled by the script, do not point it at a production database.
+
+__author__ = 'hardy.Zheng'
+
+import datetime
+import time
+import uuid
+from optparse import OptionParser
+
+from firewallapi.common import db_models as models
+from firewallapi.common.session import Connection
+from firewallapi.common.session import EngineFacade
+
+
+parser = OptionParser()
+parser.add_option("-e", "--engine", dest="engine",
+                  default='sqlite:////tmp/firewallapi_bench.db',
+                  help="sqlalchemy engine url")
+parser.add_option("-r", "--rows", dest="rows", type="int", default=50000,
+                  help="rows inserted per table")
+parser.add_option("-n", "--repeat", dest="repeat", type="int", default=3,
+                  help="runs per measurement, best run is reported")
+
+
+def get_connection(url):
+    if not url.startswith('sqlite'):
+        return Connection(url)
+    # sqlite runs on NullPool which rejects the mysql pool options
+    # of EngineFacade.from_config()
+    conn = Connection.__new__(Connection)
+    conn.engine = EngineFacade(url)
+    return conn
+
+
+def populate(engine, count):
+    models.Base.metadata.drop_all(engine)
+    models.Base.metadata.create_all(engine)
+    now = datetime.datetime.utcnow()
+    route_id = str(uuid.uuid4())
+    interface_id = str(uuid.uuid4())
+    app_id = str(uuid.uuid4())
+    engine.execute(models.Route.__table__.insert(),
+                   [dict(route_id=route_id, route_name='r1', username='admin',
+                         password='admin', ip='127.0.0.1', port=8728)])
+    engine.execute(models.Interface.__table__.insert(),
+                   [dict(interface_id=interface_id, interface_name='ether1',
+                         route_id=route_id)])
+    engine.execute(models.App.__table__.insert(),
+                   [dict(app_id=app_id, customer_id='c1', zone_id=str(uuid.uuid4()),
+                         site_id=str(uuid.uuid4()), status='ok', create_time=now)])
+    vms, subinterfaces, actions = [], [], []
+    for i in range(count):
+        vm_id = str(uuid.uuid4())
+        vms.append(dict(vm_id=vm_id, vm_name='vm-%d' % i, template_id=str(uuid.uuid4()),
+                        customer_id='c1', site_name='beijing', pod_name='p1',
+                        cluster_name='c1', datastore_name='d1', status='running',
+                        create_time=now, configure_step='ok', app_id=app_id))
+        subinterfaces.append(dict(subinterface_id=str(uuid.uuid4()),
+                                  subinterface_name='vlan%d' % i,
+                                  vlan_id=i % 4096, portgroup_name='pg%d' % i,
+                                  qos=10, app_id=app_id, status='adding',
+                                  interface_id=interface_id))
+        actions.append(dict(action_id=str(uuid.uuid4()), app_id=app_id,
+                            vm_id=vm_id, action='create', status='processing',
+                            trigger_time=now))
+    engine.execute(models.Vm.__table__.insert(), vms)
+    engine.execute(models.Subinterface.__table__.insert(), subinterfaces)
+    engine.execute(models.Action.__table__.insert(), actions)
+    return app_id, route_id
+
+
+def measure(repeat, func, *args, **kwargs):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = func(*args, **kwargs)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, len(result)
+
+
+def main():
+    (options, args) = parser.parse_args()
+    conn = get_connection(options.engine)
+    app_id, route_id = populate(conn.engine.get_engine(), options.rows)
+
+    cases = [
+        ('vms per app',
+         lambda: conn.list_vm(app_id=app_id),
+         lambda: conn.list_vm_rows(app_id)),
+        ('subinterfaces per route',
+         lambda: conn.list_subinterface_from_route(route_id, status='adding'),
+         lambda: conn.list_subinterface_rows_from_route(route_id, status='adding')),
+        ('actions by status',
+         lambda: conn.list_action(status='processing'),
+         lambda: conn.list_action_rows('processing')),
+    ]
+    print '%-26s %8s %10s %10s %8s' % ('listing', 'rows', 'orm(s)', 'core(s)', 'speedup')
+    for name, orm, core in cases:
+        orm_time, orm_rows = measure(options.repeat, orm)
+        core_time, core_rows = measure(options.repeat, core)
+        assert orm_rows == core_rows
+        print '%-26s %8d %10.3f %10.3f %7.1fx' % (name, core_rows, orm_time,
+                                                  core_time, orm_time / core_time)
+
+
+if __name__ == '__main__':
+    main()
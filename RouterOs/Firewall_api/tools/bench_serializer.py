@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+#
+# Compare the json and msgpack rpc payload formats of common/serializer.py
+# on add_vm like casts: encode and decode cost per message and the size of
+# the message as published, envelope included.
+#
+#   python tools/bench_serializer.py --messages 20000 --nics 4
+#
+# The envelope mimics the rabbit driver: the message is json encoded into
+# 'oslo.message' of a json encoded outer dict.
+
+__author__ = 'hardy.Zheng'
+
+import datetime
+import json
+import time
+import uuid
+from optparse import OptionParser
+
+from firewallapi.common import serializer as rpc_serializer
+
+
+parser = OptionParser()
+parser.add_option("-m", "--messages", dest="messages", type="int", default=20000,
+                  help="messages encoded and decoded per format")
+parser.add_option("-n", "--nics", dest="nics", type="int", default=4,
+                  help="nics per vm")
+
+
+def add_vm_kwargs(nics):
+    now = datetime.datetime.utcnow()
+    return {
+        'app_id': uuid.uuid4(),
+        'vm': {
+            'vm_id': uuid.uuid4(),
+            'vm_name': 'web-01',
+            'template_id': uuid.uuid4(),
+            'customer_id': 'c-10086',
+            'site_name': 'beijing',
+            'pod_name': 'pod-1',
+            'cluster_name': 'cluster-3',
+            'datastore_name': 'ds-ssd-07',
+            'create_time': now,
+            'flavor': {'cpu': 4, 'ram': 8192,
+                       'disks': [{'disk_id': uuid.uuid4(), 'size': 100, 'type': 'ssd'},
+                                 {'disk_id': uuid.uuid4(), 'size': 500, 'type': 'sata'}]},
+        },
+        'nics': [{'nic_id': uuid.uuid4(), 'subinterface_id': uuid.uuid4(),
+                  'ip': '10.0.%d.10' % i, 'netmask': '255.255.255.0',
+                  'gateway': '10.0.%d.1' % i, 'vlan_id': 100 + i,
+                  'create_time': now} for i in range(nics)],
+        'route_id': str(uuid.uuid4()),
+    }
+
+
+def publish(ser, ctxt, kwargs, version):
+    msg = {'method': 'add_vm', 'namespace': None, 'version': version,
+           'context': ser.serialize_context(ctxt),
+           'args': dict((k, ser.serialize_entity(ctxt, v)) for k, v in kwargs.items())}
+    return json.dumps({'oslo.version': '2.0', 'oslo.message': json.dumps(msg)})
+
+
+def consume(ser, data):
+    msg = json.loads(json.loads(data)['oslo.message'])
+    ctxt = ser.deserialize_context(msg['context'])
+    return dict((k, ser.deserialize_entity(ctxt, v)) for k, v in msg['args'].items())
+
+
+def measure(name, count, kwargs):
+    ser = rpc_serializer.get_serializer(name)
+    ctxt = {'request_id': str(uuid.uuid4()), 'user': 'admin'}
+    start = time.time()
+    for _ in range(count):
+        data = publish(ser, ctxt, kwargs, '1.0')
+    encode = (time.time() - start) / count
+    start = time.time()
+    for _ in range(count):
+        decoded = consume(ser, data)
+    decode = (time.time() - start) / count
+    return encode, decode, len(data), decoded
+
+
+def main():
+    (options, args) = parser.parse_args()
+    kwargs = add_vm_kwargs(options.nics)
+    print '%-8s %14s %14s %10s  %s' % ('format', 'encode(us)', 'decode(us)',
+                                        'bytes', 'create_time decoded as')
+    for name in ('json', 'msgpack'):
+        encode, decode, size, decoded = measure(name, options.messages, kwargs)
+        print '%-8s %14.1f %14.1f %10d  %s' % (
+            name, encode * 1e6, decode * 1e6, size,
+            type(decoded['vm']['create_time']).__name__)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+#
+# Convert the UUID string id columns to BINARY(16) on MySQL and report index
+# size and join latency, see db_models.CompactUUID.
+#
+#   python tools/compact_keys.py report  --engine mysql+mysqldb://...
+#   python tools/compact_keys.py migrate --engine mysql+mysqldb://...
+#   python tools/compact_keys.py report  --engine mysql+mysqldb://...
+#
+# migrate is not transactional (MySQL DDL), stop firewall-api and
+# routeros-manager and take a dump before running it. Columns that are
+# already BINARY(16) are skipped, so an interrupted run can be restarted.
+
+__author__ = 'hardy.Zheng'
+
+import sys
+import time
+from optparse import OptionParser
+
+import sqlalchemy
+
+from firewallapi.common import db_models as models
+
+
+parser = OptionParser(usage='%prog [options] report|migrate')
+parser.add_option("-e", "--engine", dest="engine",
+                  help="mysql engine url, eg: mysql+mysqldb://admin:xx@localhost/db")
+parser.add_option("-n", "--repeat", dest="repeat", type="int", default=20,
+                  help="runs per join in report, median is reported")
+
+_UUID_RE = '^[0-9a-fA-F]{8}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{12}$'
+
+_JOINS = [
+    ('vm-nic-app',
+     'SELECT COUNT(*) FROM vm '
+     'JOIN vm_network_info ON vm_network_info.vm_id = vm.vm_id '
+     'JOIN app ON app.app_id = vm.app_id'),
+    ('subinterface-route',
+     'SELECT COUNT(*) FROM subinterface '
+     'JOIN interface ON interface.interface_id = subinterface.interface_id '
+     'WHERE interface.route_id = (SELECT route_id FROM route LIMIT 1)'),
+    ('gicextension-subinterface',
+     'SELECT COUNT(*) FROM gicextension '
+     'JOIN subinterface ON subinterface.subinterface_id = gicextension.subinterface_id '
+     'JOIN gic ON gic.gic_id = gicextension.gic_id'),
+    ('vm-flavor-disk',
+     'SELECT COUNT(*) FROM vm '
+     'JOIN flavor_info ON flavor_info.vm_id = vm.vm_id '
+     'JOIN disk ON disk.flavor_id = flavor_info.flavor_id'),
+]
+
+
+def compact_columns():
+    """yield (table, [columns]) for every table holding CompactUUID columns"""
+    for table in models.Base.metadata.sorted_tables:
+        columns = [c for c in table.columns if isinstance(c.type, models.CompactUUID)]
+        if columns:
+            yield table, columns
+
+
+def existing_tables(conn):
+    return set(sqlalchemy.inspect(conn).get_table_names())
+
+
+def pending_columns(conn, table, columns):
+    rows = conn.execute(
+        "SELECT COLUMN_NAME, DATA_TYPE FROM information_schema.COLUMNS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s", table.name)
+    data_types = dict((name, data_type.lower()) for name, data_type in rows)
+    return [c for c in columns
+            if c.name in data_types and data_types[c.name] != 'binary']
+
+
+def report(conn, repeat):
+    tables = [t.name for t, _ in compact_columns() if t.name in existing_tables(conn)]
+    for name in tables:
+        conn.execute('ANALYZE TABLE `%s`' % name)
+    print '%-20s %10s %14s %16s' % ('table', 'rows', 'clustered(KB)', 'secondary(KB)')
+    total_data = total_index = 0
+    rows = conn.execute(
+        "SELECT TABLE_NAME, TABLE_ROWS, DATA_LENGTH, INDEX_LENGTH "
+        "FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() "
+        "ORDER BY TABLE_NAME")
+    for name, table_rows, data_length, index_length in rows:
+        if name not in tables:
+            continue
+        total_data += data_length
+        total_index += index_length
+        print '%-20s %10d %14d %16d' % (name, table_rows, data_length / 1024,
+                                        index_length / 1024)
+    print '%-20s %10s %14d %16d' % ('total', '', total_data / 1024, total_index / 1024)
+    print
+    print '%-26s %12s' % ('join', 'median(ms)')
+    for name, sql in _JOINS:
+        timings = []
+        for _ in range(repeat):
+            start = time.time()
+            conn.execute(sql).scalar()
+            timings.append(time.time() - start)
+        timings.sort()
+        print '%-26s %12.3f' % (name, timings[len(timings) / 2] * 1000)
+
+
+def check_values(conn, table, columns):
+    bad = 0
+    for column in columns:
+        count = conn.execute(
+            "SELECT COUNT(*) FROM `%s` WHERE `%s` IS NOT NULL AND `%s` NOT REGEXP '%s'"
+            % (table.name, column.name, column.name, _UUID_RE)).scalar()
+        if count:
+            print '%s.%s: %d values are not uuids' % (table.name, column.name, count)
+            bad += count
+    return bad
+
+
+def migrate(conn):
+    tables = existing_tables(conn)
+    work = []
+    for table, columns in compact_columns():
+        if table.name not in tables:
+            continue
+        columns = pending_columns(conn, table, columns)
+        if columns:
+            work.append((table, columns))
+    if not work:
+        print 'nothing to migrate'
+        return 0
+    if sum(check_values(conn, table, columns) for table, columns in work):
+        print 'abort, fix the rows above first'
+        return 1
+
+    inspector = sqlalchemy.inspect(conn)
+    foreign_keys = [(name, fk) for name in tables
+                    for fk in inspector.get_foreign_keys(name)]
+    conn.execute('SET FOREIGN_KEY_CHECKS = 0')
+    try:
+        for table_name, fk in foreign_keys:
+            print 'drop foreign key %s.%s' % (table_name, fk['name'])
+            conn.execute('ALTER TABLE `%s` DROP FOREIGN KEY `%s`'
+                         % (table_name, fk['name']))
+
+        for table, columns in work:
+            print 'convert %s: %s' % (table.name, ', '.join(c.name for c in columns))
+            conn.execute('ALTER TABLE `%s` %s' % (table.name, ', '.join(
+                'MODIFY `%s` VARBINARY(64) %s' % (c.name, _null(c)) for c in columns)))
+            conn.execute("UPDATE `%s` SET %s" % (table.name, ', '.join(
+                "`%s` = UNHEX(REPLACE(`%s`, '-', ''))" % (c.name, c.name)
+                for c in columns)))
+            conn.execute('ALTER TABLE `%s` %s' % (table.name, ', '.join(
+                'MODIFY `%s` BINARY(16) %s' % (c.name, _null(c)) for c in columns)))
+
+        for table_name, fk in foreign_keys:
+            print 'add foreign key %s.%s' % (table_name, fk['name'])
+            conn.execute(
+                'ALTER TABLE `%s` ADD CONSTRAINT `%s` FOREIGN KEY (%s) REFERENCES `%s` (%s)'
+                % (table_name, fk['name'],
+                   ', '.join('`%s`' % c for c in fk['constrained_columns']),
+                   fk['referred_table'],
+                   ', '.join('`%s`' % c for c in fk['referred_columns'])))
+    finally:
+        conn.execute('SET FOREIGN_KEY_CHECKS = 1')
+    return 0
+
+
+def _null(column):
+    return 'NULL' if column.nullable else 'NOT NULL'
+
+
+def main():
+    (options, args) = parser.parse_args()
+    if not options.engine or len(args) != 1 or args[0] not in ('report', 'migrate'):
+        parser.error('usage: %s --engine=url report|migrate' % sys.argv[0])
+    engine = sqlalchemy.create_engine(options.engine)
+    if engine.name != 'mysql':
+        parser.error('compact keys only apply to mysql')
+    conn = engine.connect()
+    try:
+        if args[0] == 'report':
+            report(conn, options.repeat)
+            return 0
+        return migrate(conn)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+#
+# Profile the single row get_* lookups of session.Connection, comparing the
+# original per-call ORM queries with the baked statements now used.
+#
+#   python tools/profile_lookups.py --calls 2000
+#
+# Query construction is everything cProfile attributes to the sqlalchemy
+# query building and sql compiling modules, the rest is execution, row
+# loading and session bookkeeping.
+
+__author__ = 'hardy.Zheng'
+
+import cProfile
+import datetime
+import pstats
+import uuid
+from optparse import OptionParser
+
+from sqlalchemy.orm import joinedload_all
+from sqlalchemy.orm import subqueryload_all
+
+from firewallapi.common import db_models as models
+from firewallapi.common.session import Connection
+from firewallapi.common.session import EngineFacade
+
+
+parser = OptionParser()
+parser.add_option("-e", "--engine", dest="engine",
+                  default='sqlite:////tmp/firewallapi_profile.db',
+                  help="sqlalchemy engine url")
+parser.add_option("-c", "--calls", dest="calls", type="int", default=2000,
+                  help="lookups per method")
+
+_CONSTRUCTION_MODULES = ('sqlalchemy/orm/query.py',
+                         'sqlalchemy/orm/strategy_options.py',
+                         'sqlalchemy/orm/path_registry.py',
+                         'sqlalchemy/orm/util.py',
+                         'sqlalchemy/orm/context.py',
+                         'sqlalchemy/sql/')
+
+
+def get_connection(url):
+    if not url.startswith('sqlite'):
+        return Connection(url)
+    conn = Connection.__new__(Connection)
+    conn.engine = EngineFacade(url)
+    return conn
+
+
+def populate(engine):
+    models.Base.metadata.drop_all(engine)
+    models.Base.metadata.create_all(engine)
+    now = datetime.datetime.utcnow()
+    ids = dict((name, str(uuid.uuid4())) for name in ('app', 'vm', 'nic', 'action'))
+    engine.execute(models.App.__table__.insert(),
+                   [dict(app_id=ids['app'], customer_id='c1', zone_id=str(uuid.uuid4()),
+                         site_id=str(uuid.uuid4()), status='ok', create_time=now)])
+    engine.execute(models.Vm.__table__.insert(),
+                   [dict(vm_id=ids['vm'], vm_name='vm-1', template_id=str(uuid.uuid4()),
+                         customer_id='c1', site_name='beijing', pod_name='p1',
+                         cluster_name='c1', datastore_name='d1', status='running',
+                         create_time=now, configure_step='ok', app_id=ids['app'])])
+    engine.execute(models.Vm_Network_Info.__table__.insert(),
+                   [dict(nic_id=ids['nic'], subinterface_id=str(uuid.uuid4()), status='ok',
+                         network_connect='true', vm_id=ids['vm'])])
+    engine.execute(models.Action.__table__.insert(),
+                   [dict(action_id=ids['action'], app_id=ids['app'], vm_id=ids['vm'],
+                         action='create', status='ok', trigger_time=now)])
+    return ids
+
+
+def orm_lookup(conn, entity, column, option, ident):
+    session = conn.engine.get_session()
+    try:
+        return session.query(entity).options(option).filter(column == ident).one()
+    finally:
+        session.close()
+
+
+def profile(func, calls):
+    prof = cProfile.Profile()
+    prof.enable()
+    for _ in range(calls):
+        func()
+    prof.disable()
+    stats = pstats.Stats(prof)
+    total = construction = 0.0
+    for (filename, _, _), (_, _, tottime, _, _) in stats.stats.items():
+        total += tottime
+        if any(m in filename for m in _CONSTRUCTION_MODULES):
+            construction += tottime
+    return total / calls, construction / calls
+
+
+def main():
+    (options, args) = parser.parse_args()
+    conn = get_connection(options.engine)
+    ids = populate(conn.engine.get_engine())
+
+    cases = [
+        ('get_app',
+         lambda: orm_lookup(conn, models.App, models.App.app_id,
+                            joinedload_all('*'), ids['app']),
+         lambda: conn.get_app(ids['app'])),
+        ('get_vm',
+         lambda: orm_lookup(conn, models.Vm, models.Vm.vm_id,
+                            subqueryload_all('*'), ids['vm']),
+         lambda: conn.get_vm(ids['vm'])),
+        ('get_nic',
+         lambda: orm_lookup(conn, models.Vm_Network_Info, models.Vm_Network_Info.nic_id,
+                            joinedload_all(models.Vm_Network_Info.vm), ids['nic']),
+         lambda: conn.get_nic(ids['nic'])),
+        ('get_action',
+         lambda: orm_lookup(conn, models.Action, models.Action.action_id,
+                            joinedload_all('*'), ids['action']),
+         lambda: conn.get_action(ids['action'])),
+    ]
+    print '%-12s %-7s %12s %17s %8s' % ('method', 'path', 'cpu/call(ms)',
+                                        'construction(ms)', 'share')
+    for name, before, after in cases:
+        for label, func in (('orm', before), ('baked', after)):
+            total, construction = profile(func, options.calls)
+            print '%-12s %-7s %12.3f %17.3f %7.1f%%' % (name, label, total * 1000,
+                                                       construction * 1000,
+                                                       100 * construction / total)
+
+
+if __name__ == '__main__':
+    main()
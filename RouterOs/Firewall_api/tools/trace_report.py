@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+#
+# Rebuild the span trees written by common/tracing.py (api) and
+# rosmanager/common/tracing.py (managers) and print the slowest traces.
+#
+#   python tools/trace_report.py api-trace.log manager1-trace.log --slowest 10
+#   python tools/trace_report.py trace*.log --trace <base_id>
+#
+# Copy the manager files next to the api file first, the paths are read
+# locally. Span times come from each host's clock.
+
+__author__ = 'hardy.Zheng'
+
+import json
+import sys
+from optparse import OptionParser
+
+
+parser = OptionParser(usage='%prog [options] trace_file...')
+parser.add_option("-n", "--slowest", dest="slowest", type="int", default=10,
+                  help="print the n slowest traces")
+parser.add_option("-t", "--trace", dest="trace", help="print only this base_id")
+
+
+class Span(object):
+
+    def __init__(self, trace_id, parent_id):
+        self.trace_id = trace_id
+        self.parent_id = parent_id
+        self.name = None
+        self.service = None
+        self.start = None
+        self.stop = None
+        self.info = {}
+        self.children = []
+
+    @property
+    def elapsed(self):
+        if self.start is None or self.stop is None:
+            return None
+        return (self.stop - self.start) * 1000
+
+    def label(self):
+        info = self.info.get('function', {}).get('name') or \
+            self.info.get('db', {}).get('statement') or \
+            self.info.get('path') or ''
+        return '%s:%s %s' % (self.service, self.name, ' '.join(str(info).split())[:100])
+
+
+def load(paths):
+    """return {base_id: {trace_id: Span}}"""
+    traces = {}
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                name = record.get('name', '')
+                if not name.endswith(('-start', '-stop')):
+                    continue
+                spans = traces.setdefault(record['base_id'], {})
+                span = spans.get(record['trace_id'])
+                if span is None:
+                    span = spans[record['trace_id']] = Span(record['trace_id'],
+                                                            record['parent_id'])
+                span.name, event = name.rsplit('-', 1)
+                span.service = record.get('service')
+                span.info.update(record.get('info') or {})
+                setattr(span, event, record['time'])
+    return traces
+
+
+def roots(base_id, spans):
+    top = []
+    for span in spans.values():
+        parent = spans.get(span.parent_id)
+        if parent is None or span.parent_id == base_id:
+            top.append(span)
+        else:
+            parent.children.append(span)
+    for span in spans.values():
+        span.children.sort(key=lambda s: s.start or 0)
+    return sorted(top, key=lambda s: s.start or 0)
+
+
+def show(span, depth=0):
+    elapsed = span.elapsed
+    print '%s%10s  %s' % ('  ' * depth,
+                          '%.2fms' % elapsed if elapsed is not None else 'open',
+                          span.label())
+    for child in span.children:
+        show(child, depth + 1)
+
+
+def main():
+    (options, args) = parser.parse_args()
+    if not args:
+        parser.error('no trace file given')
+    traces = load(args)
+    if options.trace:
+        traces = {options.trace: traces.get(options.trace, {})}
+    ranked = []
+    for base_id, spans in traces.items():
+        top = roots(base_id, spans)
+        starts = [s.start for s in spans.values() if s.start is not None]
+        stops = [s.stop for s in spans.values() if s.stop is not None]
+        total = (max(stops) - min(starts)) * 1000 if starts and stops else 0
+        ranked.append((total, base_id, top))
+    ranked.sort(reverse=True)
+    for total, base_id, top in ranked[:options.slowest]:
+        print 'trace %s  %.2fms' % (base_id, total)
+        for span in top:
+            show(span, 1)
+        print
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
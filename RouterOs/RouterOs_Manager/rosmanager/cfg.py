@@ -30,7 +30,17 @@ router_group = cfg.OptGroup(
 router_opts = [
     cfg.StrOpt('host', default='0.0.0.0', help='routeos ip address'),
     cfg.StrOpt('username', default='admin', help='routeos username'),
-    cfg.StrOpt('password', default='admin', help='routeos password')
+    cfg.StrOpt('password', default='admin', help='routeos password'),
+    cfg.IntOpt('api_pool_size', default=2,
+               help='max routeros api sessions kept open per router'),
+    cfg.IntOpt('api_max_inflight', default=32,
+               help='commands pipelined on one api session before another is opened'),
+    cfg.IntOpt('api_timeout', default=30,
+               help='seconds to wait for the reply of an api command'),
+    cfg.IntOpt('api_connect_timeout', default=5,
+               help='seconds to wait for an api session to open or a keepalive reply'),
+    cfg.IntOpt('api_keepalive', default=30,
+               help='ping api sessions idle for this many seconds, 0 disables')
 ]
 
 
@@ -38,8 +48,89 @@ common_opts = [
     cfg.StrOpt('site_name', default='beijing', help='routeos manager sitename'),
     cfg.IntOpt('report_interval', default=30,
                help='The interval (in seconds) which periodic tasks are run.'),
+    cfg.DictOpt('periodic_intervals', default={},
+                help='seconds between runs per periodic task, overrides '
+                     'report_interval, eg: push_config:5,reconcile_routes:600. '
+                     '0 disables a task'),
+    cfg.FloatOpt('periodic_jitter', default=0.1,
+                 help='spread periodic task runs by this share of their interval'),
+    cfg.ListOpt('periodic_wake_tasks', default=['push_config'],
+                help='periodic tasks run right after each handled rpc message'),
+    cfg.IntOpt('periodic_wake_delay', default=50,
+               help='ms to wait after a rpc message before the woken tasks run, '
+                    'coalesces bursts'),
     cfg.StrOpt('host', default='0.0.0.0', help='manager address'),
     cfg.StrOpt('taskmanager_manager', help='Router Os Manager'),
+    cfg.BoolOpt('config_push', default=False,
+                help='push the pending subinterface, address and gic changes to '
+                     'the routers every report_interval, off by default'),
+    cfg.IntOpt('reconcile_interval', default=0,
+               help='seconds between two reconciles of the routers against the db, '
+                    '0 (default) disables, periodic_intervals takes precedence'),
+    cfg.IntOpt('reconcile_max_age', default=3600,
+               help='seconds a cached router table is trusted while its item '
+                    'count does not change'),
+    cfg.BoolOpt('outbox_enabled', default=False,
+                help='push_config reads the routes to push from the outbox the '
+                     'api writes instead of the status columns of all routes'),
+    cfg.IntOpt('outbox_full_scan', default=300,
+               help='seconds between two reads of the status columns of all the '
+                    'routes when outbox_enabled'),
+    cfg.IntOpt('outbox_settle', default=30,
+               help='seconds an outbox transaction may take to commit, its rows '
+                    'are read again for as long'),
+    cfg.IntOpt('outbox_retention', default=86400,
+               help='seconds outbox rows are kept, 0 keeps them'),
+    cfg.StrOpt('journal_dir', default='',
+               help='keep a write-ahead journal of the router operations in this '
+                    'directory and verify the unfinished ones at start, empty '
+                    'disables'),
+    cfg.IntOpt('journal_segment_size', default=64,
+               help='MB of a journal segment, older segments are deleted once '
+                    'their operations are done'),
+    cfg.IntOpt('router_workers', default=8,
+               help='threads running per router push and reconcile jobs, one '
+                    'router at a time each'),
+    cfg.IntOpt('router_job_timeout', default=120,
+               help='seconds a router job may run before its result is dropped '
+                    'and its thread replaced'),
+    cfg.IntOpt('router_failures', default=3,
+               help='consecutive failed jobs after which a router is suspended'),
+    cfg.IntOpt('router_backoff', default=30,
+               help='seconds a failing router is first suspended, doubled on '
+                    'every further failure'),
+    cfg.IntOpt('router_max_backoff', default=600,
+               help='longest suspension of a failing router in seconds'),
+    cfg.IntOpt('rpc_workers', default=0,
+               help='rpc worker threads, 0 handles one message at a time'),
+    cfg.ListOpt('rpc_partition_keys', default=['route_id'],
+                help='message kwargs keeping rpc messages ordered, first found wins, '
+                     'messages without any share one worker, '
+                     'eg: route_id,subinterface_id,gic_id'),
+    cfg.ListOpt('rpc_lanes', default=[],
+                help='priority lanes as name:weight, each consumed from its own '
+                     '<topic>.<name> queue and served by weight on every rpc '
+                     'worker, eg: interactive:4,bulk:1,reconcile:1. empty '
+                     'consumes the topic queue only'),
+    cfg.BoolOpt('route_sharding', default=False,
+                help='share the routes of site_name with the other rosmanager '
+                     'instances on the topic, host must be unique'),
+    cfg.IntOpt('heartbeat_interval', default=10,
+               help='seconds between manager_heartbeat updates'),
+    cfg.IntOpt('manager_heartbeat_timeout', default=30,
+               help='seconds without heartbeat before a rosmanager loses its routes'),
+    cfg.IntOpt('shard_replicas', default=64,
+               help='ring points per rosmanager, must match the api'),
+    cfg.IntOpt('dedup_window_size', default=10000,
+               help='rpc request ids remembered to skip redeliveries, 0 disables'),
+    cfg.IntOpt('dedup_ttl', default=600,
+               help='seconds a rpc request id is remembered'),
+    cfg.StrOpt('dedup_state_file', default='',
+               help='keep the remembered request ids across restarts in this file'),
+    cfg.BoolOpt('trace_enabled', default=False,
+                help='continue the api traces and write their spans to trace_file'),
+    cfg.StrOpt('trace_file', default='/var/log/rosmanager/trace.log',
+               help='trace spans are appended to this file as json lines'),
 ]
 
 CONF = cfg.CONF
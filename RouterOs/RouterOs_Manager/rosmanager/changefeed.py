@@ -0,0 +1,73 @@
+"""
+    Cursor over the outbox (models.Change) of the router changes.
+
+    The api adds an outbox row per route in the transaction of every
+    change, ChangeFeed.poll() returns the routes with rows newer than the
+    last poll with one indexed range query, so push_config only reads the
+    pending rows of the routes that changed and an idle site costs one
+    empty select per tick.
+
+    seq is taken when a row is inserted, not when it commits: a slow
+    transaction may commit seq 5 after seq 6 was read. poll() therefore
+    reads again from the highest seq it had seen settle seconds ago and
+    skips the rows it already returned. reset() moves the cursor to the
+    newest row, for the full scans push_config still does now and then.
+"""
+
+__author__ = 'Hardy.zheng'
+
+import collections
+import time
+
+from oslo_log import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+
+class ChangeFeed(object):
+
+    def __init__(self, db_connection, settle=30, limit=1000):
+        self.db_connection = db_connection
+        self.settle = settle
+        self.limit = limit
+        # (poll time, highest seq seen by then), oldest first
+        self._marks = collections.deque()
+        # seqs above the oldest mark already returned
+        self._seen = set()
+        self.polls = 0
+        self.rows = 0
+
+    def reset(self):
+        """start after the newest outbox row, call before a full scan"""
+        self._marks = collections.deque([(time.time(), self.db_connection.last_change_seq())])
+        self._seen = set()
+
+    def poll(self, route_ids):
+        """ids of route_ids with changes since the last poll, None when
+        there are more than limit of them (do a full scan)
+        """
+        if not self._marks:
+            self.reset()
+            return None
+        now = time.time()
+        while len(self._marks) > 1 and self._marks[1][0] <= now - self.settle:
+            self._marks.popleft()
+        low = self._marks[0][1]
+        rows = self.db_connection.list_changes(low, list(route_ids), self.limit)
+        self.polls += 1
+        if len(rows) >= self.limit:
+            LOG.info('change feed: more than %d changes, full scan' % self.limit)
+            self.reset()
+            return None
+        routes = set()
+        top = max([low, self._marks[-1][1]] + [row.seq for row in rows])
+        for row in rows:
+            if row.seq in self._seen:
+                continue
+            self._seen.add(row.seq)
+            routes.add(row.route_id)
+            self.rows += 1
+        self._seen = set(seq for seq in self._seen if seq > low)
+        self._marks.append((now, top))
+        return routes
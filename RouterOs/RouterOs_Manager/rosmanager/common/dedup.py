@@ -0,0 +1,145 @@
+"""
+    Drop redelivered rpc messages.
+
+    The api stamps a request_id into the context of every cast and call
+    (firewallapi.rpc.stamp_context). DedupEndpoint remembers the ids it
+    handled in a DedupWindow, bounded by size (oldest ids go first) and
+    by ttl, and skips a message whose id is in the window. An id
+    is forgotten again when its handler raises, so a failed message can
+    still be retried. With state_file the window survives restarts.
+"""
+
+__author__ = 'Hardy.zheng'
+
+import collections
+import functools
+import json
+import os
+import threading
+import time
+
+from oslo_log import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+
+class DedupWindow(object):
+
+    def __init__(self, size=10000, ttl=600, state_file=None, sync_interval=5):
+        self.size = size
+        self.ttl = ttl
+        self.state_file = state_file
+        self.sync_interval = sync_interval
+        # request_id -> expire time, oldest first
+        self._ids = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._synced = time.time()
+        self._dirty = False
+        self.hits = 0
+        if state_file:
+            self.load()
+
+    def _expire(self, now):
+        while self._ids:
+            request_id, expire = next(iter(self._ids.items()))
+            if expire > now and len(self._ids) <= self.size:
+                break
+            del self._ids[request_id]
+
+    def check(self, request_id):
+        """record request_id, return False if it is already in the window"""
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            if request_id in self._ids:
+                self.hits += 1
+                return False
+            self._ids[request_id] = now + self.ttl
+            if len(self._ids) > self.size:
+                self._ids.popitem(last=False)
+            self._dirty = True
+            sync = self.state_file and now - self._synced >= self.sync_interval
+        if sync:
+            self.save()
+        return True
+
+    def forget(self, request_id):
+        with self._lock:
+            self._ids.pop(request_id, None)
+            self._dirty = True
+
+    def load(self):
+        try:
+            with open(self.state_file) as f:
+                entries = json.load(f)
+        except IOError:
+            return
+        except ValueError as e:
+            LOG.warning('ignore broken dedup state %s: %s' % (self.state_file, e))
+            return
+        now = time.time()
+        with self._lock:
+            for request_id, expire in sorted(entries.items(), key=lambda e: e[1]):
+                if expire > now:
+                    self._ids[request_id] = expire
+            self._expire(now)
+        LOG.info('loaded %d request ids from %s' % (len(self._ids), self.state_file))
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = dict(self._ids)
+            self._dirty = False
+            self._synced = time.time()
+        tmp = '%s.tmp' % self.state_file
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(entries, f)
+            os.rename(tmp, self.state_file)
+        except (IOError, OSError) as e:
+            LOG.warning('save dedup state %s failed: %s' % (self.state_file, e))
+
+    def __len__(self):
+        return len(self._ids)
+
+
+def _request_id(ctx):
+    if isinstance(ctx, dict):
+        return ctx.get('request_id')
+    return getattr(ctx, 'request_id', None)
+
+
+class DedupEndpoint(object):
+    """Proxy of a manager used as rpc endpoint, see module doc. Messages
+    without a request_id (older api) are always handled.
+    """
+
+    def __init__(self, manager, window):
+        self._manager = manager
+        self._window = window
+
+    def __getattr__(self, name):
+        attr = getattr(self._manager, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        return self._dedup(name, attr)
+
+    def _dedup(self, name, func):
+        window = self._window
+
+        @functools.wraps(func)
+        def dedup(ctx, **kwargs):
+            request_id = _request_id(ctx)
+            if request_id is None:
+                return func(ctx, **kwargs)
+            if not window.check(request_id):
+                LOG.info('skip duplicate %s request %s' % (name, request_id))
+                return None
+            try:
+                return func(ctx, **kwargs)
+            except Exception:
+                window.forget(request_id)
+                raise
+        return dedup
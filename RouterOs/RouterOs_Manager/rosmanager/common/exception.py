@@ -133,6 +133,39 @@ class LoginError(VspcException):
     pass
 
 
+class RouterOsError(VspcException):
+    """!trap reply of a routeros api command, category as sent by the
+    router (0 missing item, 1 bad argument, 2 interrupted, ...)
+    """
+
+    def __init__(self, message, category=None):
+        self.category = category
+        super(RouterOsError, self).__init__(message)
+
+
+class RouterOsConnectionError(VspcException):
+    """routeros api session lost, sent tells whether the command may have
+    reached the router
+    """
+
+    def __init__(self, message, sent=True):
+        self.sent = sent
+        super(RouterOsConnectionError, self).__init__(message)
+
+
+class RouterOsTimeout(RouterOsConnectionError):
+    pass
+
+
+class JobTimeout(VspcException):
+    pass
+
+
+class JobRejected(VspcException):
+    """job of a suspended key, or of a stopped scheduler"""
+    pass
+
+
 class MultipleKeys(VspcException):
     pass
 
@@ -164,6 +197,12 @@ class DBDeadlock(DBError):
         super(DBDeadlock, self).__init__(inner_exception)
 
 
+class DBConflict(DBError):
+    """A versioned row (see db_models) was changed by someone else, the
+    api or another rosmanager, since it was read. Read it again and retry.
+    """
+
+
 class DBInvalidUnicodeParameter(Exception):
     message = "Invalid Parameter: Unicode is not supported by the current database."
 
@@ -0,0 +1,407 @@
+"""
+    Partitioned worker pool for the rpc endpoints.
+
+    The rpc server keeps its "blocking" executor, it only hands messages to
+    PartitionedEndpoint which queues them on one of N workers picked from
+    the router (and optionally subinterface/gic) id of the message. Messages
+    on the same object run in arrival order on one worker, messages on
+    different objects run in parallel. Messages on no object share one
+    worker and keep their arrival order too.
+
+    With priority lanes the service runs one rpc server per lane topic,
+    each worker keeps a queue per lane and serves them by weight, so a
+    bulk job queued on a worker does not hold back the interactive
+    messages behind it.
+
+    RpcEndpoint keeps the other methods of the manager (periodic tasks,
+    recover) out of reach of the rpc server and of the proxies above it.
+
+    KeyedScheduler runs the per router jobs of the periodic tasks: one
+    ordered queue per key (route_id) on a bounded set of threads, so a
+    slow or unreachable router ties up at most one thread.
+"""
+
+__author__ = 'Hardy.zheng'
+
+import collections
+import sys
+import threading
+import time
+import zlib
+
+import six
+from six.moves import queue
+
+from oslo_log import log as logging
+
+from rosmanager.common import exception
+
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_LANE = 'interactive'
+
+
+def wait_result(func):
+    """mark an endpoint method whose caller expects the return value (rpc
+    call), the dispatcher waits for it instead of returning at once
+    """
+    func.wait_result = True
+    return func
+
+
+class _Result(object):
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._value = None
+        self._error = None
+
+    def set(self, value=None, error=None):
+        self._value, self._error = value, error
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def get(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise exception.JobTimeout('no result in %ss' % timeout)
+        if self._error is not None:
+            six.reraise(*self._error)
+        return self._value
+
+
+class _Worker(object):
+    """queues of one worker, one per lane, taken by smooth weighted round
+    robin over the lanes holding messages
+    """
+
+    def __init__(self, lanes):
+        self.weights = dict(lanes)
+        self.queues = dict((lane, collections.deque()) for lane in lanes)
+        self._current = dict((lane, 0) for lane in lanes)
+        self._cond = threading.Condition()
+        self._stopped = False
+
+    def put(self, lane, item):
+        with self._cond:
+            self.queues[lane].append(item)
+            self._cond.notify()
+
+    def take(self):
+        """next message, None once stopped and drained"""
+        with self._cond:
+            while True:
+                ready = [lane for lane, q in self.queues.items() if q]
+                if ready:
+                    break
+                if self._stopped:
+                    return None
+                self._cond.wait()
+            total = 0
+            best = None
+            for lane in ready:
+                self._current[lane] += self.weights[lane]
+                total += self.weights[lane]
+                if best is None or self._current[lane] > self._current[best]:
+                    best = lane
+            self._current[best] -= total
+            return self.queues[best].popleft()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+
+class PartitionedPool(object):
+    """lanes maps lane name -> weight; when several lanes of a worker hold
+    messages, a lane of weight 4 is served 4 times as often as one of 1
+    """
+
+    def __init__(self, workers=8, lanes=None):
+        self.workers = workers
+        self.lanes = dict(lanes or {DEFAULT_LANE: 1})
+        self._workers = [_Worker(self.lanes) for _ in range(workers)]
+        self._threads = []
+        for index, worker in enumerate(self._workers):
+            thread = threading.Thread(target=self._run, args=(worker,),
+                                      name='rpc-worker-%d' % index)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def partition(self, key):
+        if key is None:
+            # keyless messages keep their order on the first worker
+            return 0
+        return zlib.crc32(six.text_type(key).encode('utf-8')) % self.workers
+
+    def submit(self, key, func, *args, **kwargs):
+        return self.submit_lane(DEFAULT_LANE, key, func, *args, **kwargs)
+
+    def submit_lane(self, lane, key, func, *args, **kwargs):
+        if lane not in self.lanes:
+            lane = DEFAULT_LANE if DEFAULT_LANE in self.lanes else sorted(self.lanes)[0]
+        result = _Result()
+        self._workers[self.partition(key)].put(lane, (func, args, kwargs, result))
+        return result
+
+    def _run(self, worker):
+        while True:
+            item = worker.take()
+            if item is None:
+                return
+            func, args, kwargs, result = item
+            try:
+                result.set(func(*args, **kwargs))
+            except Exception:
+                LOG.exception('rpc worker: %s failed' % getattr(func, '__name__', func))
+                result.set(error=sys.exc_info())
+
+    def backlog(self, lane=None):
+        """queued messages per worker, of one lane or all"""
+        if lane is None:
+            return [sum(len(q) for q in w.queues.values()) for w in self._workers]
+        return [len(w.queues.get(lane, ())) for w in self._workers]
+
+    def stop(self):
+        for worker in self._workers:
+            worker.stop()
+        for thread in self._threads:
+            thread.join()
+
+
+class RpcEndpoint(object):
+    """Proxy of a manager used as rpc endpoint, only methods are served;
+    asking for another method of the manager raises AttributeError, which
+    the rpc dispatcher answers as an unknown method
+    """
+
+    def __init__(self, manager, methods):
+        self._manager = manager
+        self._methods = frozenset(methods)
+
+    def __getattr__(self, name):
+        attr = getattr(self._manager, name)
+        if callable(attr) and name not in self._methods:
+            raise AttributeError('%s is not a rpc method' % name)
+        return attr
+
+
+class PartitionedEndpoint(object):
+    """Proxy of a manager used as rpc endpoint, see module doc.
+
+    The partition key of a message is the first of keys found in its
+    kwargs, messages without any go to the first worker. Manager.batch
+    items are partitioned one by one, they may only name cast_methods.
+    Messages are queued on lane. Only methods marked wait_result are
+    waited for, the others return None at once and log an error if they
+    return a value.
+    """
+
+    def __init__(self, manager, pool, keys=('route_id',), lane=DEFAULT_LANE,
+                 cast_methods=()):
+        self._manager = manager
+        self._pool = pool
+        self._keys = tuple(keys)
+        self._lane = lane
+        self._cast_methods = frozenset(cast_methods)
+
+    def __getattr__(self, name):
+        attr = getattr(self._manager, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        if name == 'batch':
+            return self._batch
+        return self._dispatcher(name, attr)
+
+    def _key(self, kwargs):
+        for key in self._keys:
+            if kwargs.get(key) is not None:
+                return kwargs[key]
+        return None
+
+    def _dispatcher(self, name, func):
+        wait = getattr(func, 'wait_result', False)
+        if not wait:
+            func = self._unwaited(name, func)
+
+        def dispatch(ctx, **kwargs):
+            result = self._pool.submit_lane(self._lane, self._key(kwargs),
+                                            func, ctx, **kwargs)
+            if wait:
+                return result.get()
+        dispatch.__name__ = name
+        return dispatch
+
+    @staticmethod
+    def _unwaited(name, func):
+        # the rpc server already answered None, a value returned here is
+        # lost on a rpc call
+        def run(ctx, **kwargs):
+            value = func(ctx, **kwargs)
+            if value is not None:
+                LOG.error('rpc %s returned a value but is not marked '
+                          'wait_result, a rpc call of it got None' % name)
+            return value
+        run.__name__ = name
+        return run
+
+    def _batch(self, ctx, cast_method, items):
+        if cast_method not in self._cast_methods:
+            LOG.error('batch: refuse to dispatch %s' % cast_method)
+            return
+        func = getattr(self._manager, cast_method)
+        for item in items:
+            self._pool.submit_lane(self._lane, self._key(item['kwargs']), func,
+                                   item['context'], **item['kwargs'])
+
+
+class KeyedScheduler(object):
+    """Run jobs with one ordered queue per key on up to workers threads.
+
+    A key's jobs run one at a time in submit order, keys with queued jobs
+    take turns on the threads. A job running longer than timeout gets its
+    thread replaced, so the other keys keep their capacity while it hangs.
+    After failures consecutive failed jobs a key is suspended for backoff
+    seconds, doubled on every further failure up to max_backoff; the jobs
+    of a suspended key fail at once with JobRejected. Jobs waiting longer
+    than max_wait are dropped with JobTimeout, the next tick brings fresh
+    ones.
+    """
+
+    def __init__(self, workers=8, timeout=120, failures=3, backoff=30,
+                 max_backoff=600, max_wait=None):
+        self.workers = workers
+        self.timeout = timeout
+        self.failures = failures
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_wait = max_wait
+        # key -> deque of queued jobs, present while the key is scheduled
+        self._queues = {}
+        # key -> (start time, thread) of the running job
+        self._running = {}
+        self._failed = collections.defaultdict(int)
+        self._suspended = {}
+        self._stuck = set()
+        self._ready = queue.Queue()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._threads = 0
+        for _ in range(workers):
+            self._spawn()
+        self._watchdog = threading.Thread(target=self._watch, name='router-watchdog')
+        self._watchdog.daemon = True
+        self._watchdog.start()
+
+    def _spawn(self):
+        self._threads += 1
+        thread = threading.Thread(target=self._run,
+                                  name='router-worker-%d' % self._threads)
+        thread.daemon = True
+        thread.start()
+
+    def busy(self, key):
+        """whether key has jobs queued or running"""
+        return key in self._queues
+
+    def suspended(self, key):
+        until = self._suspended.get(key)
+        return until is not None and until > time.time()
+
+    def submit(self, key, func, *args, **kwargs):
+        result = _Result()
+        with self._lock:
+            if self._stopped.is_set():
+                raise exception.JobRejected('scheduler stopped')
+            if self.suspended(key):
+                result.set(error=(exception.JobRejected, exception.JobRejected(
+                    '%s suspended after %d failures' % (key, self._failed[key])), None))
+                return result
+            jobs = self._queues.get(key)
+            if jobs is None:
+                jobs = self._queues[key] = collections.deque()
+                self._ready.put(key)
+            jobs.append((func, args, kwargs, result, time.time()))
+        return result
+
+    def _run(self):
+        while True:
+            key = self._ready.get()
+            if key is None:
+                return
+            with self._lock:
+                func, args, kwargs, result, queued_at = self._queues[key].popleft()
+                self._running[key] = (time.time(), threading.current_thread())
+            ok = None
+            if self.suspended(key):
+                result.set(error=(exception.JobRejected, exception.JobRejected(
+                    '%s suspended after %d failures' % (key, self._failed[key])), None))
+            elif self.max_wait and time.time() - queued_at > self.max_wait:
+                result.set(error=(exception.JobTimeout, exception.JobTimeout(
+                    '%s job waited more than %ss' % (key, self.max_wait)), None))
+            else:
+                try:
+                    result.set(func(*args, **kwargs))
+                    ok = True
+                except Exception:
+                    LOG.exception('router job %s: %s failed' %
+                                  (key, getattr(func, '__name__', func)))
+                    result.set(error=sys.exc_info())
+                    ok = False
+            with self._lock:
+                del self._running[key]
+                if ok:
+                    self._failed.pop(key, None)
+                    self._suspended.pop(key, None)
+                elif ok is False:
+                    self._failed[key] += 1
+                    over = self._failed[key] - self.failures
+                    if over >= 0:
+                        backoff = min(self.max_backoff, self.backoff * 2 ** min(over, 16))
+                        self._suspended[key] = time.time() + backoff
+                        LOG.warning('router job %s: suspended for %ss after %d failures' %
+                                    (key, backoff, self._failed[key]))
+                if self._queues[key]:
+                    self._ready.put(key)
+                else:
+                    del self._queues[key]
+                thread = threading.current_thread()
+                if thread in self._stuck:
+                    # replaced while it hung
+                    self._stuck.discard(thread)
+                    self._threads -= 1
+                    return
+
+    def _watch(self):
+        while not self._stopped.wait(1):
+            now = time.time()
+            with self._lock:
+                for key, (started, thread) in list(self._running.items()):
+                    if now - started > self.timeout and thread not in self._stuck:
+                        LOG.warning('router job %s: running for %ds, replace its worker' %
+                                    (key, now - started))
+                        self._stuck.add(thread)
+                        self._spawn()
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            return {'threads': self._threads,
+                    'stuck': len(self._stuck),
+                    'queued': dict((key, len(jobs)) for key, jobs in self._queues.items()
+                                   if jobs),
+                    'running': dict((key, now - started)
+                                    for key, (started, thread) in self._running.items()),
+                    'suspended': dict((key, until - now)
+                                      for key, until in self._suspended.items()
+                                      if until > now)}
+
+    def stop(self):
+        self._stopped.set()
+        for _ in range(self._threads):
+            self._ready.put(None)
+        self._watchdog.join()
@@ -0,0 +1,84 @@
+"""
+    Consistent hashing of route ids over the live rosmanager instances.
+
+    Every instance is placed on the ring replicas times, a route belongs to
+    the first instance point following the hash of its id. When an instance
+    joins or stops heartbeating only the routes next to its points move.
+    The api and the managers must use the same replicas.
+"""
+
+__author__ = 'Hardy.zheng'
+
+import bisect
+import hashlib
+import threading
+import time
+
+import six
+from oslo_log import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+
+def _hash(key):
+    return int(hashlib.md5(six.text_type(key).encode('utf-8')).hexdigest()[:8], 16)
+
+
+class HashRing(object):
+
+    def __init__(self, nodes, replicas=64):
+        self.nodes = sorted(set(nodes))
+        self.replicas = replicas
+        points = []
+        for node in self.nodes:
+            for i in range(replicas):
+                points.append((_hash('%s-%d' % (node, i)), node))
+        points.sort()
+        self._keys = [point[0] for point in points]
+        self._nodes = [point[1] for point in points]
+
+    def get_node(self, key):
+        """return the node owning key, None on an empty ring"""
+        if not self._keys:
+            return None
+        index = bisect.bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._nodes[index]
+
+
+class ManagerRing(object):
+    """HashRing of the rosmanager instances alive for (topic, site_name),
+    rebuilt from the manager_heartbeat table at most every refresh seconds
+    """
+
+    def __init__(self, db_connection, topic, site_name, timeout=30,
+                 replicas=64, refresh=5):
+        self.db_connection = db_connection
+        self.topic = topic
+        self.site_name = site_name
+        self.timeout = timeout
+        self.replicas = replicas
+        self.refresh = refresh
+        self._ring = HashRing([], replicas)
+        self._loaded = 0
+        self._lock = threading.Lock()
+
+    def ring(self):
+        with self._lock:
+            if time.time() - self._loaded >= self.refresh:
+                self._loaded = time.time()
+                try:
+                    hosts = self.db_connection.list_live_manager(
+                        self.topic, self.site_name, self.timeout)
+                except Exception as e:
+                    # keep routing on the last known ring
+                    LOG.warning('load rosmanager heartbeats failed: %s' % e)
+                    return self._ring
+                if hosts != self._ring.nodes:
+                    LOG.info('rosmanager ring %s/%s: %s'
+                             % (self.topic, self.site_name, ', '.join(hosts)))
+                    self._ring = HashRing(hosts, self.replicas)
+            return self._ring
+
+    def get_host(self, route_id):
+        return self.ring().get_node(route_id)
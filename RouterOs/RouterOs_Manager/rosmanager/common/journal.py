@@ -0,0 +1,210 @@
+"""
+    Local write-ahead journal of the router operations.
+
+    Before a batch is sent to a router its operations are appended to the
+    journal and synced (begin + sync), once applied their outcomes are
+    appended (applied) and the batch is closed (commit). A batch found
+    open when the manager starts was cut short by a crash, Manager.recover
+    verifies it against the router.
+
+    Records are json lines prefixed with their crc32, a torn or corrupt
+    line is skipped on load. Only begin has to reach the disk before the
+    router is touched: a lost outcome or commit costs a verify at start,
+    not a wrong router. sync() is a group commit, writers waiting while a
+    fsync runs are all covered by the next one.
+
+    The journal is written in segments of segment_size bytes, a new one
+    each start. A segment is deleted once it and the segments before it
+    hold no open batch.
+"""
+
+__author__ = 'Hardy.zheng'
+
+import binascii
+import json
+import os
+import re
+import threading
+import uuid
+
+from oslo_log import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+_SEGMENT = re.compile(r'^journal-(\d{8})\.log$')
+
+
+def _encode(record):
+    payload = json.dumps(record, sort_keys=True, separators=(',', ':'))
+    return '%08x %s\n' % (binascii.crc32(payload) & 0xffffffff, payload)
+
+
+def _decode(line):
+    """record of line, None if it is torn or corrupt"""
+    crc, _, payload = line.rstrip('\n').partition(' ')
+    try:
+        if int(crc, 16) != binascii.crc32(payload) & 0xffffffff:
+            return None
+        return json.loads(payload)
+    except ValueError:
+        return None
+
+
+class Journal(object):
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024):
+        self.directory = directory
+        self.segment_size = segment_size
+        # batch id -> open batch, as returned by pending()
+        self._open = {}
+        # batch id -> segment of its begin record
+        self._segments = {}
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        # records appended and records known on disk
+        self._written = 0
+        self._synced = 0
+        self.fsyncs = 0
+        self.skipped = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        segments = self._list()
+        self._load(segments)
+        self._segment = (segments[-1] + 1) if segments else 1
+        self._file = self._create(self._segment)
+        self._trim()
+
+    def _path(self, segment):
+        return os.path.join(self.directory, 'journal-%08d.log' % segment)
+
+    def _list(self):
+        return sorted(int(match.group(1)) for match in
+                      (_SEGMENT.match(name) for name in os.listdir(self.directory))
+                      if match)
+
+    def _create(self, segment):
+        f = open(self._path(segment), 'ab')
+        # make the new name durable too
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        return f
+
+    def _load(self, segments):
+        for segment in segments:
+            with open(self._path(segment), 'rb') as f:
+                for line in f:
+                    record = _decode(line)
+                    if record is None:
+                        self.skipped += 1
+                        continue
+                    kind, batch_id = record.get('type'), record.get('id')
+                    if kind == 'begin':
+                        self._open[batch_id] = {
+                            'id': batch_id, 'task': record['task'],
+                            'route_id': record['route_id'], 'ops': record['ops'],
+                            'outcomes': None}
+                        self._segments[batch_id] = segment
+                    elif kind == 'applied' and batch_id in self._open:
+                        self._open[batch_id]['outcomes'] = record['outcomes']
+                    elif kind == 'commit':
+                        self._open.pop(batch_id, None)
+                        self._segments.pop(batch_id, None)
+        if self.skipped:
+            LOG.warning('journal %s: skipped %d torn records' %
+                        (self.directory, self.skipped))
+        if self._open:
+            LOG.info('journal %s: %d open batches' % (self.directory, len(self._open)))
+
+    def _append(self, record):
+        line = _encode(record)
+        with self._lock:
+            self._file.write(line)
+            self._written += 1
+            if self._file.tell() >= self.segment_size:
+                self._rotate()
+            return self._written
+
+    def _rotate(self):
+        # called with _lock held: the old segment goes to disk in full
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._synced = self._written
+        self._segment += 1
+        self._file = self._create(self._segment)
+        self._trim()
+
+    def _trim(self):
+        oldest = min(self._segments.values() or [self._segment])
+        for segment in self._list():
+            if segment >= oldest or segment >= self._segment:
+                break
+            try:
+                os.unlink(self._path(segment))
+            except OSError as e:
+                LOG.warning('journal: remove segment %d failed: %s' % (segment, e))
+
+    def begin(self, task, route_id, ops):
+        """open a batch of ops (push.Op.to_dict) for route_id, return its id.
+        sync() before the router is touched
+        """
+        batch_id = uuid.uuid4().hex
+        with self._lock:
+            self._segments[batch_id] = self._segment
+        self._append({'type': 'begin', 'id': batch_id, 'task': task,
+                      'route_id': route_id, 'ops': ops})
+        return batch_id
+
+    def applied(self, batch_id, outcomes):
+        """outcomes (push.Op.outcome) of the ops of batch_id, in order"""
+        self._append({'type': 'applied', 'id': batch_id, 'outcomes': outcomes})
+
+    def commit(self, batch_id):
+        self._append({'type': 'commit', 'id': batch_id})
+        with self._lock:
+            self._segments.pop(batch_id, None)
+            self._open.pop(batch_id, None)
+
+    def sync(self):
+        """make the records appended so far durable"""
+        with self._lock:
+            target = self._written
+        if self._synced >= target:
+            return
+        with self._sync_lock:
+            # a fsync run meanwhile may have covered target
+            if self._synced >= target:
+                return
+            with self._lock:
+                self._file.flush()
+                upto = self._written
+                # survives a rotation closing the file during the fsync
+                fd = os.dup(self._file.fileno())
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self._synced = max(self._synced, upto)
+            self.fsyncs += 1
+
+    def pending(self):
+        """the batches left open by the last run:
+        [{'id', 'task', 'route_id', 'ops', 'outcomes' (None if not applied)}]
+        """
+        with self._lock:
+            return list(self._open.values())
+
+    def stats(self):
+        with self._lock:
+            return {'segment': self._segment, 'open': len(self._segments),
+                    'records': self._written, 'fsyncs': self.fsyncs,
+                    'skipped': self.skipped}
+
+    def close(self):
+        self.sync()
+        with self._lock:
+            self._file.close()
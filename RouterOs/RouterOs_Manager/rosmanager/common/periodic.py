@@ -0,0 +1,182 @@
+"""
+    Periodic task scheduler of the manager.
+
+    PeriodicScheduler runs the methods of the manager decorated with
+    oslo_service periodic_task on a thread of its own instead of a
+    FixedIntervalLoopingCall, so RpcService.start returns. Every task has
+    its own interval (intervals, else its spacing, else the default), its
+    runs are spread by +-jitter of the interval, and the first run comes
+    within jitter of the interval so that managers started together do
+    not hit the db together. A task still running when it is due is
+    skipped, never run twice at once.
+
+    wake() makes a task due at once (after delay, to coalesce a burst of
+    rpc messages into one run), a task woken while running runs again
+    right after. WakeEndpoint wakes tasks after every rpc message the
+    manager handled, so new work is pushed within milliseconds instead of
+    at the next tick.
+"""
+
+__author__ = 'Hardy.zheng'
+
+import functools
+import random
+import threading
+import time
+
+from oslo_log import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+
+class _Task(object):
+
+    def __init__(self, name, func, interval):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.next_run = None
+        self.running = False
+        self.rerun = False
+        self.runs = 0
+        self.skipped = 0
+        self.woken = 0
+        self.last_duration = None
+
+
+class PeriodicScheduler(object):
+
+    def __init__(self, manager, default_interval=30, intervals=None,
+                 jitter=0.1, wake_delay=0.05, context=None):
+        self.jitter = jitter
+        self.wake_delay = wake_delay
+        self.context = context
+        self.tasks = {}
+        intervals = intervals or {}
+        for name in dir(manager):
+            func = getattr(manager, name, None)
+            if not getattr(func, '_periodic_task', False) or \
+                    not getattr(func, '_periodic_enabled', True):
+                continue
+            name = getattr(func, '_periodic_name', name).split('.')[-1]
+            interval = intervals.get(name)
+            if interval is None:
+                interval = getattr(func, '_periodic_spacing', 0) or default_interval
+            if interval <= 0:
+                LOG.info('periodic task %s disabled' % name)
+                continue
+            self.tasks[name] = _Task(name, func, float(interval))
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    def _spread(self, interval):
+        return interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def start(self):
+        now = time.time()
+        for task in self.tasks.values():
+            task.next_run = now + random.uniform(0, task.interval * max(self.jitter, 0.01))
+        self._thread = threading.Thread(target=self._loop, name='periodic-tasks')
+        self._thread.daemon = True
+        self._thread.start()
+        LOG.info('periodic tasks: %s' % ', '.join(
+            '%s every %ss' % (t.name, t.interval) for t in sorted(
+                self.tasks.values(), key=lambda t: t.name)))
+
+    def wake(self, name):
+        task = self.tasks.get(name)
+        if task is None:
+            return
+        with self._lock:
+            task.woken += 1
+            if task.running:
+                task.rerun = True
+                return
+            due = time.time() + self.wake_delay
+            if task.next_run is None or due < task.next_run:
+                task.next_run = due
+        self._event.set()
+
+    def _loop(self):
+        while not self._stopped:
+            now = time.time()
+            with self._lock:
+                for task in self.tasks.values():
+                    if task.next_run > now:
+                        continue
+                    task.next_run = now + self._spread(task.interval)
+                    if task.running:
+                        task.skipped += 1
+                        LOG.debug('periodic task %s still running, skipped' % task.name)
+                        continue
+                    task.running = True
+                    thread = threading.Thread(target=self._run, args=(task,),
+                                              name='periodic-%s' % task.name)
+                    thread.daemon = True
+                    thread.start()
+                wait = min([t.next_run for t in self.tasks.values()] or [now + 60]) - now
+            self._event.wait(max(0, wait))
+            self._event.clear()
+
+    def _run(self, task):
+        while True:
+            started = time.time()
+            try:
+                task.func(self.context)
+            except Exception:
+                LOG.exception('periodic task %s failed' % task.name)
+            with self._lock:
+                task.runs += 1
+                task.last_duration = time.time() - started
+                if not task.rerun or self._stopped:
+                    task.running = False
+                    return
+                task.rerun = False
+
+    def stats(self):
+        now = time.time()
+        return dict((task.name, {'interval': task.interval,
+                                 'running': task.running,
+                                 'next_run': task.next_run - now if task.next_run else None,
+                                 'runs': task.runs,
+                                 'skipped': task.skipped,
+                                 'woken': task.woken,
+                                 'last_duration': task.last_duration})
+                    for task in self.tasks.values())
+
+    def stop(self):
+        self._stopped = True
+        self._event.set()
+
+
+class WakeEndpoint(object):
+    """Proxy of a manager used as rpc endpoint, wakes tasks of the
+    scheduler once a message was handled, see module doc
+    """
+
+    def __init__(self, manager, scheduler, tasks):
+        self._manager = manager
+        self._scheduler = scheduler
+        self._tasks = tuple(tasks)
+
+    def __getattr__(self, name):
+        attr = getattr(self._manager, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        return self._wake(attr)
+
+    def _wake(self, func):
+        scheduler = self._scheduler
+        tasks = self._tasks
+
+        @functools.wraps(func)
+        def wake(ctx, **kwargs):
+            try:
+                return func(ctx, **kwargs)
+            finally:
+                for task in tasks:
+                    scheduler.wake(task)
+        return wake
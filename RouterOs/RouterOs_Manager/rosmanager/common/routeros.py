@@ -0,0 +1,447 @@
+"""
+    RouterOS API protocol client with persistent sessions per router.
+
+    A Connection is one logged in api session (tcp 8728). Every command is
+    sent with a .tag and a reader thread hands the tagged replies back to
+    the Reply of the command, so many commands can be in flight on one
+    socket: send() them all, then get() the replies.
+
+    RouterPool keeps up to size sessions to one router, picks the least
+    busy live session for a command and opens a new one when every session
+    has max_inflight commands pending or a session died. RouterPools holds
+    one RouterPool per (ip, port, username) and pings idle sessions every
+    keepalive seconds, broken ones are closed and reopened on next use.
+
+        pools = RouterPools.from_conf(CONF.routeros)
+        api = pools.get(route.ip, route.port, route.username, route.password)
+        replies = [api.send('/interface/vlan/add', name='vlan%d' % v,
+                            vlan_id=v, interface='ether1') for v in vlans]
+        for reply in replies:
+            reply.get()
+"""
+
+__author__ = 'Hardy.zheng'
+
+import binascii
+import hashlib
+import itertools
+import socket
+import struct
+import threading
+import time
+
+import six
+
+from oslo_log import log as logging
+
+from rosmanager.common import exception
+
+
+LOG = logging.getLogger(__name__)
+
+KEEPALIVE_COMMAND = '/system/identity/print'
+
+
+def encode_length(length):
+    if length < 0x80:
+        return struct.pack('!B', length)
+    if length < 0x4000:
+        return struct.pack('!H', length | 0x8000)
+    if length < 0x200000:
+        return struct.pack('!I', length | 0xC00000)[1:]
+    if length < 0x10000000:
+        return struct.pack('!I', length | 0xE0000000)
+    return b'\xf0' + struct.pack('!I', length)
+
+
+def encode_sentence(words):
+    data = []
+    for word in words:
+        if isinstance(word, six.text_type):
+            word = word.encode('utf-8')
+        data.append(encode_length(len(word)))
+        data.append(word)
+    data.append(b'\x00')
+    return b''.join(data)
+
+
+def read_length(read):
+    first = six.indexbytes(read(1), 0)
+    if first < 0x80:
+        return first
+    if first < 0xC0:
+        return ((first & 0x3F) << 8) + six.indexbytes(read(1), 0)
+    if first < 0xE0:
+        return ((first & 0x1F) << 16) + struct.unpack('!H', read(2))[0]
+    if first < 0xF0:
+        rest = read(3)
+        return ((first & 0x0F) << 24) + (struct.unpack('!H', rest[:2])[0] << 8) + \
+            six.indexbytes(rest, 2)
+    if first == 0xF0:
+        return struct.unpack('!I', read(4))[0]
+    raise exception.RouterOsConnectionError('bad word length 0x%x' % first)
+
+
+def read_sentence(read):
+    words = []
+    while True:
+        length = read_length(read)
+        if not length:
+            return words
+        words.append(read(length).decode('utf-8', 'replace'))
+
+
+def command_words(command, words, attrs):
+    """command words: attrs become =name=value, an underscore in a name
+    is sent as a dash (vlan_id -> vlan-id), words ('?name=x', '=.id=*1')
+    are sent as they are
+    """
+    sentence = [command]
+    for name, value in sorted(attrs.items()):
+        if isinstance(value, bool):
+            value = 'yes' if value else 'no'
+        sentence.append('=%s=%s' % (name.replace('_', '-'), value))
+    sentence.extend(words)
+    return sentence
+
+
+class Reply(object):
+    """replies of one tagged command: rows of !re, attributes of !done"""
+
+    def __init__(self, connection, tag, command):
+        self.connection = connection
+        self.tag = tag
+        self.command = command
+        self.rows = []
+        self.done = None
+        self.error = None
+        self._finished = threading.Event()
+
+    def feed(self, reply, attrs):
+        if reply == '!re':
+            self.rows.append(attrs)
+        elif reply == '!trap':
+            # !done follows a !trap
+            self.error = exception.RouterOsError(
+                '%s: %s' % (self.command, attrs.get('message', 'failed')),
+                attrs.get('category'))
+        elif reply == '!done':
+            self.done = attrs
+            self._finished.set()
+
+    def fail(self, error):
+        self.error = error
+        self._finished.set()
+
+    def finished(self):
+        return self._finished.is_set()
+
+    def get(self, timeout=None):
+        """rows of the command, raise its !trap or a lost session"""
+        if timeout is None:
+            timeout = self.connection.timeout
+        if not self._finished.wait(timeout):
+            self.connection.cancel(self)
+            raise exception.RouterOsTimeout(
+                '%s: no reply from %s in %ss' % (self.command, self.connection, timeout))
+        if self.error is not None:
+            raise self.error
+        return self.rows
+
+
+class Connection(object):
+
+    def __init__(self, host, port, username, password, timeout=30,
+                 connect_timeout=5):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.sock = None
+        self.alive = False
+        self.last_used = time.time()
+        self._tags = itertools.count(1)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._reader = None
+
+    def __str__(self):
+        return '%s@%s:%s' % (self.username, self.host, self.port)
+
+    def open(self):
+        try:
+            self.sock = socket.create_connection((self.host, self.port),
+                                                 self.connect_timeout)
+        except socket.error as e:
+            raise exception.RouterOsConnectionError(
+                'connect %s failed: %s' % (self, e), sent=False)
+        # replies are read by a thread, dead peers are found by keepalive
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.alive = True
+        self._reader = threading.Thread(target=self._read_loop,
+                                        name='routeros-%s' % self.host)
+        self._reader.daemon = True
+        self._reader.start()
+        try:
+            self.login()
+        except Exception:
+            self.close()
+            raise
+        LOG.debug('routeros session %s opened' % self)
+        return self
+
+    def login(self):
+        try:
+            reply = self.send('/login', name=self.username,
+                              password=self.password)
+            reply.get()
+            challenge = (reply.done or {}).get('ret')
+            if challenge:
+                # routeros before 6.43 answers with a md5 challenge
+                digest = hashlib.md5(b'\x00' + self.password.encode('utf-8') +
+                                     binascii.unhexlify(challenge)).hexdigest()
+                self.send('/login', name=self.username,
+                          response='00' + digest).get()
+        except exception.RouterOsError as e:
+            raise exception.LoginError('login %s failed: %s' % (self, e.msg))
+
+    def pending(self):
+        return len(self._pending)
+
+    def send(self, command, *words, **attrs):
+        """send command without waiting, return its Reply"""
+        if not self.alive:
+            raise exception.RouterOsConnectionError('%s is closed' % self, sent=False)
+        tag = str(next(self._tags))
+        reply = Reply(self, tag, command)
+        sentence = command_words(command, words, attrs)
+        sentence.append('.tag=%s' % tag)
+        with self._lock:
+            self._pending[tag] = reply
+        try:
+            with self._send_lock:
+                self.sock.sendall(encode_sentence(sentence))
+        except socket.error as e:
+            with self._lock:
+                self._pending.pop(tag, None)
+            self.close()
+            raise exception.RouterOsConnectionError(
+                'send to %s failed: %s' % (self, e), sent=False)
+        self.last_used = time.time()
+        return reply
+
+    def talk(self, command, *words, **attrs):
+        """send command and wait for its rows"""
+        return self.send(command, *words, **attrs).get()
+
+    def cancel(self, reply):
+        """stop a command that is still running on the router"""
+        with self._lock:
+            self._pending.pop(reply.tag, None)
+        if not self.alive:
+            return
+        try:
+            self.send('/cancel', tag=reply.tag)
+        except exception.RouterOsConnectionError:
+            pass
+
+    def _recv(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise exception.RouterOsConnectionError('%s closed by peer' % self)
+            data += chunk
+        return data
+
+    def _read_loop(self):
+        error = None
+        try:
+            while self.alive:
+                words = read_sentence(self._recv)
+                if not words:
+                    continue
+                reply, tag, attrs = words[0], None, {}
+                for word in words[1:]:
+                    if word.startswith('.tag='):
+                        tag = word[5:]
+                    elif word.startswith('='):
+                        name, _, value = word[1:].partition('=')
+                        attrs[name] = value
+                if reply == '!fatal':
+                    raise exception.RouterOsConnectionError(
+                        '%s: fatal %s' % (self, ' '.join(words[1:])))
+                with self._lock:
+                    pending = self._pending.get(tag)
+                    if reply == '!done':
+                        self._pending.pop(tag, None)
+                if pending is not None:
+                    pending.feed(reply, attrs)
+        except (socket.error, exception.RouterOsConnectionError) as e:
+            error = e
+        if self.alive:
+            LOG.warning('routeros session %s lost: %s' % (self, error))
+        self._shutdown(exception.RouterOsConnectionError(
+            'session %s lost: %s' % (self, error)))
+
+    def _shutdown(self, error):
+        self.alive = False
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for reply in pending.values():
+            reply.fail(error)
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+
+    def close(self):
+        if self.sock is None:
+            return
+        if self.alive:
+            self.alive = False
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        self._shutdown(exception.RouterOsConnectionError('%s closed' % self))
+
+
+class RouterPool(object):
+    """api sessions to one router, see module doc"""
+
+    def __init__(self, host, port, username, password, size=2,
+                 max_inflight=32, timeout=30, connect_timeout=5):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.size = size
+        self.max_inflight = max_inflight
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.connections = []
+        self.opened = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """least busy live session, opened on demand"""
+        with self._lock:
+            self.connections = [c for c in self.connections if c.alive]
+            idle = [c for c in self.connections if c.pending() < self.max_inflight]
+            if idle or len(self.connections) >= self.size:
+                return min(idle or self.connections, key=lambda c: c.pending())
+            connection = Connection(self.host, self.port, self.username,
+                                    self.password, self.timeout,
+                                    self.connect_timeout).open()
+            self.opened += 1
+            self.connections.append(connection)
+            return connection
+
+    def send(self, command, *words, **attrs):
+        """send on a pooled session; a command that never left is retried
+        once on a fresh session, one that may have reached the router is not
+        """
+        try:
+            return self.acquire().send(command, *words, **attrs)
+        except exception.RouterOsConnectionError as e:
+            if e.sent:
+                raise
+            return self.acquire().send(command, *words, **attrs)
+
+    def talk(self, command, *words, **attrs):
+        return self.send(command, *words, **attrs).get()
+
+    def keepalive(self, idle):
+        """ping the sessions unused for idle seconds, drop the broken ones"""
+        now = time.time()
+        for connection in list(self.connections):
+            if not connection.alive or now - connection.last_used < idle:
+                continue
+            try:
+                connection.send(KEEPALIVE_COMMAND).get(self.connect_timeout)
+            except exception.VspcException as e:
+                LOG.warning('routeros keepalive %s failed: %s' % (connection, e))
+                connection.close()
+
+    def close(self):
+        with self._lock:
+            connections, self.connections = self.connections, []
+        for connection in connections:
+            connection.close()
+
+    def stats(self):
+        live = [c for c in self.connections if c.alive]
+        return {'sessions': len(live),
+                'pending': sum(c.pending() for c in live),
+                'opened': self.opened}
+
+
+class RouterPools(object):
+    """one RouterPool per router, see module doc"""
+
+    def __init__(self, size=2, max_inflight=32, timeout=30,
+                 connect_timeout=5, keepalive=30):
+        self.size = size
+        self.max_inflight = max_inflight
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.keepalive = keepalive
+        self._pools = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        if keepalive > 0:
+            self._thread = threading.Thread(target=self._keepalive_loop,
+                                            name='routeros-keepalive')
+            self._thread.daemon = True
+            self._thread.start()
+
+    @classmethod
+    def from_conf(cls, conf):
+        """conf: the [routeros] group"""
+        return cls(size=conf.api_pool_size, max_inflight=conf.api_max_inflight,
+                   timeout=conf.api_timeout, connect_timeout=conf.api_connect_timeout,
+                   keepalive=conf.api_keepalive)
+
+    def get(self, host, port, username, password):
+        key = (host, int(port), username)
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is not None and pool.password != password:
+                # password changed, drop the sessions of the old one
+                pool.close()
+                pool = None
+            if pool is None:
+                pool = self._pools[key] = RouterPool(
+                    host, int(port), username, password, self.size,
+                    self.max_inflight, self.timeout, self.connect_timeout)
+            return pool
+
+    def for_route(self, route):
+        """pool of a db_models.Route"""
+        return self.get(route.ip, route.port, route.username, route.password)
+
+    def _keepalive_loop(self):
+        while not self._stopped.wait(self.keepalive / 2.0):
+            for pool in list(self._pools.values()):
+                try:
+                    pool.keepalive(self.keepalive)
+                except Exception as e:
+                    LOG.warning('routeros keepalive %s failed: %s' % (pool.host, e))
+
+    def stats(self):
+        return dict(('%s:%s' % (key[0], key[1]), pool.stats())
+                    for key, pool in list(self._pools.items()))
+
+    def close(self):
+        self._stopped.set()
+        with self._lock:
+            pools, self._pools = list(self._pools.values()), {}
+        for pool in pools:
+            pool.close()
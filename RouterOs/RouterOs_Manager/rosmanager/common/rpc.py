@@ -18,6 +18,8 @@ from oslo_config import cfg
 import oslo_messaging as messaging
 from osprofiler import profiler
 
+from rosmanager.common import serializer as rpc_serializer
+
 
 CONF = cfg.CONF
 TRANSPORT = None
@@ -96,7 +98,8 @@ def get_server(target, endpoints, serializer=None):
     # lead to unpredictable results.
     executor = "blocking"
 
-    serializer = messaging.JsonPayloadSerializer()
+    # reads json and msgpack payloads, replies in json
+    serializer = rpc_serializer.MsgpackSerializer(pack=False)
     return messaging.get_rpc_server(TRANSPORT,
                                     target,
                                     endpoints,
@@ -0,0 +1,110 @@
+"""
+    Rpc payload serializers.
+
+    The rabbit driver always json encodes the message envelope, so the
+    msgpack format packs each structured argument (dict, list, datetime,
+    uuid) and carries it base64 encoded under _MARKER, scalars are left
+    as they are. datetime and UUID values keep their type instead of
+    becoming strings, byte and text strings keep theirs too.
+
+    Rolling out: the msgpack format is sent with target version
+    MSGPACK_VERSION, managers older than that reject it, so keep
+    rpc_version_cap below it until every manager is upgraded. Upgraded
+    managers read both formats.
+"""
+
+__author__ = 'Hardy.zheng'
+
+import base64
+import datetime
+import struct
+import uuid
+
+import msgpack
+import oslo_messaging as messaging
+import six
+
+
+MSGPACK_VERSION = '1.1'
+
+_MARKER = '__msgpack__'
+_EXT_DATETIME = 1
+_EXT_UUID = 2
+# year, month, day, hour, minute, second, microsecond
+_DATETIME = struct.Struct('>HBBBBBI')
+_SCALARS = six.string_types + six.integer_types + (float, bool, type(None))
+
+
+def _default(obj):
+    if isinstance(obj, datetime.datetime):
+        if obj.tzinfo is not None:
+            obj = (obj - obj.utcoffset()).replace(tzinfo=None)
+        return msgpack.ExtType(_EXT_DATETIME, _DATETIME.pack(
+            obj.year, obj.month, obj.day, obj.hour, obj.minute, obj.second,
+            obj.microsecond))
+    if isinstance(obj, uuid.UUID):
+        return msgpack.ExtType(_EXT_UUID, obj.bytes)
+    raise TypeError('can not msgpack %r' % (obj,))
+
+
+def _ext_hook(code, data):
+    if code == _EXT_DATETIME:
+        return datetime.datetime(*_DATETIME.unpack(data))
+    if code == _EXT_UUID:
+        return uuid.UUID(bytes=data)
+    return msgpack.ExtType(code, data)
+
+
+def dumps(entity):
+    # py2 str goes as bin and comes back as str whatever its bytes,
+    # unicode as str
+    return msgpack.packb(entity, default=_default, use_bin_type=True)
+
+
+def loads(data):
+    return msgpack.unpackb(data, ext_hook=_ext_hook, raw=False)
+
+
+def is_packed(entity):
+    return isinstance(entity, dict) and len(entity) == 1 and _MARKER in entity
+
+
+class MsgpackSerializer(messaging.Serializer):
+    """Reads json and msgpack payloads, writes msgpack when pack is True,
+    otherwise json primitives like messaging.JsonPayloadSerializer (the
+    manager replies this way so callers of any version can read them).
+    """
+
+    def __init__(self, pack=True):
+        self.pack = pack
+        self._json = messaging.JsonPayloadSerializer()
+
+    def serialize_entity(self, ctxt, entity):
+        if not self.pack or isinstance(entity, _SCALARS):
+            return self._json.serialize_entity(ctxt, entity)
+        return {_MARKER: base64.b64encode(dumps(entity)).decode('ascii')}
+
+    def deserialize_entity(self, ctxt, entity):
+        if is_packed(entity):
+            return loads(base64.b64decode(entity[_MARKER]))
+        return entity
+
+    def serialize_context(self, ctxt):
+        return self._json.serialize_context(ctxt)
+
+    def deserialize_context(self, ctxt):
+        return self._json.deserialize_context(ctxt)
+
+
+_SERIALIZERS = {
+    'json': lambda: messaging.JsonPayloadSerializer(),
+    'msgpack': lambda: MsgpackSerializer(),
+}
+
+
+def get_serializer(name):
+    try:
+        return _SERIALIZERS[name]()
+    except KeyError:
+        raise ValueError('unknown rpc serializer %s, one of %s'
+                         % (name, ', '.join(sorted(_SERIALIZERS))))
@@ -0,0 +1,109 @@
+"""
+    Continue the api traces in rosmanager.
+
+    The api puts the ids of its active trace in the rpc context as
+    trace_info (firewallapi.rpc.stamp_context), TracingEndpoint resumes
+    that trace around the manager method so the 'rpc' spans of
+    profiler.trace_cls and the 'db' spans nest under the api request.
+    Spans go to a local file like on the api, see FileCollector.
+"""
+
+__author__ = 'Hardy.zheng'
+
+import functools
+import inspect
+import json
+import logging
+import logging.handlers
+import os
+import socket
+import time
+
+from osprofiler import notifier
+from osprofiler import profiler
+
+
+class FileCollector(object):
+    """osprofiler notifier appending json lines to a rotating file"""
+
+    def __init__(self, path, service, max_size=10, back_count=5):
+        self.service = service
+        self.host = socket.gethostname()
+        self.pid = os.getpid()
+        self.logger = logging.getLogger('%s.trace' % service)
+        if not self.logger.handlers:
+            handler = logging.handlers.RotatingFileHandler(
+                path, maxBytes=max_size * 1024 * 1024, backupCount=back_count)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self.logger.addHandler(handler)
+            self.logger.setLevel(logging.INFO)
+            self.logger.propagate = False
+
+    def __call__(self, info):
+        record = dict(info)
+        record['time'] = time.time()
+        record['service'] = self.service
+        record['host'] = self.host
+        record['pid'] = self.pid
+        self.logger.info(json.dumps(record, default=str))
+
+
+def setup(path, service, max_size=10, back_count=5):
+    notifier.set(FileCollector(path, service, max_size, back_count))
+
+
+def trace_methods(cls, name):
+    """trace the public methods defined on cls as name spans, arguments
+    are left out of the spans (they hold router passwords)
+    """
+    for attr, func in list(vars(cls).items()):
+        if attr.startswith('_') or not inspect.isfunction(func):
+            continue
+        if getattr(func, '_traced', False):
+            continue
+        traced = profiler.trace(name, hide_args=True)(func)
+        traced._traced = True
+        setattr(cls, attr, traced)
+
+
+def trace_engine(engine, name='db'):
+    """trace every sql statement of engine while a trace is active"""
+    from osprofiler import sqlalchemy as profiler_sqlalchemy
+    import sqlalchemy
+    profiler_sqlalchemy.add_tracing(sqlalchemy, engine, name)
+
+
+def _trace_info(ctx):
+    if isinstance(ctx, dict):
+        return ctx.get('trace_info')
+    return getattr(ctx, 'trace_info', None)
+
+
+class TracingEndpoint(object):
+    """Proxy of a manager used as rpc endpoint, see module doc. It must sit
+    inside the partitioned workers, the osprofiler state is per thread.
+    """
+
+    def __init__(self, manager):
+        self._manager = manager
+
+    def __getattr__(self, name):
+        attr = getattr(self._manager, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        return self._continue(attr)
+
+    def _continue(self, func):
+
+        @functools.wraps(func)
+        def traced(ctx, **kwargs):
+            info = _trace_info(ctx)
+            if not info:
+                return func(ctx, **kwargs)
+            profiler.init(info['hmac_key'], base_id=info['base_id'],
+                          parent_id=info['parent_id'])
+            try:
+                return func(ctx, **kwargs)
+            finally:
+                profiler.clean()
+        return traced
@@ -3,9 +3,13 @@ import six
 import uuid
 from sqlalchemy import Column
 from sqlalchemy import Integer
+from sqlalchemy import BigInteger
 from sqlalchemy import String
 from sqlalchemy import DateTime
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
+from sqlalchemy import BINARY
+from sqlalchemy.types import TypeDecorator
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relation
 from oslo_utils import timeutils
@@ -30,13 +34,57 @@ class _Base(object):
         for k, v in six.iteritems(values):
             setattr(self, k, v)
 
+
+class CompactUUID(TypeDecorator):
+    """UUID string id stored as BINARY(16) on MySQL.
+
+    Models and callers keep using the usual 36 char string ids, the value is
+    packed on bind and unpacked on load. Other dialects store the string as
+    given. Binding a value which is not a UUID raises, the lookups check
+    their ids with is_uuid first. The columns referring to a zone, site, pod
+    or cluster use it like the ids they refer to, template ids come from
+    other systems and stay strings.
+    """
+    impl = String(64)
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'mysql':
+            return dialect.type_descriptor(BINARY(16))
+        return dialect.type_descriptor(String(64))
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return value
+        # raises on a value which is not a UUID, it is never written mangled
+        packed = value if isinstance(value, uuid.UUID) else uuid.UUID(value)
+        if dialect.name == 'mysql':
+            return packed.bytes
+        return six.text_type(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None or dialect.name != 'mysql':
+            return value
+        return str(uuid.UUID(bytes=value))
+
+
+def is_uuid(value):
+    """whether value can be bound to a CompactUUID column"""
+    if isinstance(value, uuid.UUID):
+        return True
+    try:
+        uuid.UUID(value)
+    except (ValueError, TypeError, AttributeError):
+        return False
+    return True
+
+
 Base = declarative_base(cls=_Base)
 
 
 class Zone(Base):
     __tablename__ = 'zone'
 
-    zone_id = Column(String(64), primary_key=True)
+    zone_id = Column(CompactUUID(), primary_key=True)
     zone_name = Column(String(40), nullable=False)
 
     def __init__(self, name):
@@ -47,14 +95,14 @@ class Zone(Base):
 class Site(Base):
     __tablename__ = 'site'
 
-    site_id = Column(String(64), primary_key=True)
+    site_id = Column(CompactUUID(), primary_key=True)
     site_name = Column(String(40), nullable=False)
     create_time = Column(DateTime, nullable=True)
     vcenter_ip = Column(String(24), nullable=False)
     vcenter_port = Column(Integer, nullable=False)
     vcenter_username = Column(String(40), nullable=False)
     vcenter_password = Column(String(64), nullable=False)
-    zone_id = Column(String(64), ForeignKey('zone.zone_id'))
+    zone_id = Column(CompactUUID(), ForeignKey('zone.zone_id'))
     zone = relation("Zone", backref='site', lazy='select')
 
     def __init__(self, name, ip, port, username, password):
@@ -70,14 +118,14 @@ class Site(Base):
 class Pod(Base):
     __tablename__ = 'pod'
 
-    pod_id = Column(String(64), primary_key=True)
+    pod_id = Column(CompactUUID(), primary_key=True)
     pod_name = Column(String(40), nullable=False)
     create_time = Column(DateTime, nullable=True)
     total_cpu = Column(Integer, nullable=False)
     total_ram = Column(Integer, nullable=False)
     used_cpu = Column(Integer, nullable=False)
     used_ram = Column(Integer, nullable=False)
-    site_id = Column(String(64), ForeignKey('site.site_id'))
+    site_id = Column(CompactUUID(), ForeignKey('site.site_id'))
     site = relation("Site", backref='pod', lazy='select')
 
     def __init__(self, pod_name, tcpu, tram, ucpu, uram):
@@ -93,13 +141,13 @@ class Pod(Base):
 class Cluster(Base):
     __tablename__ = 'cluster'
 
-    cluster_id = Column(String(64), primary_key=True)
+    cluster_id = Column(CompactUUID(), primary_key=True)
     cluster_name = Column(String(40), nullable=False)
     total_cpu = Column(Integer, nullable=False)
     total_ram = Column(Integer, nullable=False)
     used_cpu = Column(Integer, nullable=False)
     used_ram = Column(Integer, nullable=False)
-    pod_id = Column(String(64), ForeignKey('pod.pod_id'))
+    pod_id = Column(CompactUUID(), ForeignKey('pod.pod_id'))
     pod = relation("Pod", backref='cluster', lazy='select')
 
     def __init__(self, name, tcpu, tram, ucpu, uram):
@@ -114,9 +162,9 @@ class Cluster(Base):
 class DataStore(Base):
     __tablename__ = 'datastore'
 
-    datastore_id = Column(String(64), primary_key=True)
+    datastore_id = Column(CompactUUID(), primary_key=True)
     datastore_name = Column(String(40), nullable=False)
-    cluster_id = Column(String(64), ForeignKey('cluster.cluster_id'))
+    cluster_id = Column(CompactUUID(), ForeignKey('cluster.cluster_id'))
     cluster = relation("Cluster", backref='datastore', lazy='select')
 
     def __init__(self, name):
@@ -173,7 +221,7 @@ class Templates(Base):
 class Route(Base):
     __tablename__ = 'route'
 
-    route_id = Column(String(64), primary_key=True)
+    route_id = Column(CompactUUID(), primary_key=True)
     route_name = Column(String(40), nullable=False)
     producer = Column(String(64), nullable=True)
     product_serial = Column(String(64), nullable=True)
@@ -182,7 +230,7 @@ class Route(Base):
     ip = Column(String(24), nullable=False)
     port = Column(Integer, nullable=False)
     create_time = Column(DateTime, nullable=True)
-    site_id = Column(String(64), ForeignKey('site.site_id'))
+    site_id = Column(CompactUUID(), ForeignKey('site.site_id'))
     site = relation("Site", backref='route', lazy='select')
 
     def __init__(self,
@@ -209,10 +257,10 @@ class Route(Base):
 class Interface(Base):
     __tablename__ = 'interface'
 
-    interface_id = Column(String(64), primary_key=True)
+    interface_id = Column(CompactUUID(), primary_key=True)
     interface_name = Column(String(64), nullable=True)
-    pod_id = Column(String(64), nullable=True)
-    route_id = Column(String(64), ForeignKey('route.route_id'))
+    pod_id = Column(CompactUUID(), nullable=True)
+    route_id = Column(CompactUUID(), ForeignKey('route.route_id'))
     route = relation("Route", backref='interface', lazy='select')
 
     def __init__(self, interface_name, pod_id):
@@ -224,7 +272,7 @@ class Interface(Base):
 class Subinterface(Base):
     __tablename__ = 'subinterface'
 
-    subinterface_id = Column(String(64), primary_key=True)
+    subinterface_id = Column(CompactUUID(), primary_key=True)
     subinterface_name = Column(String(64), nullable=False)
     vlan_id = Column(Integer, nullable=False)
     vlan_type = Column(String(16), nullable=True)
@@ -233,10 +281,13 @@ class Subinterface(Base):
     alloc_time = Column(DateTime, nullable=True)
     update_time = Column(DateTime, nullable=True)
     qos = Column(Integer)
-    app_id = Column(String(64), nullable=True)
-    gic_id = Column(String(64), nullable=True)
+    app_id = Column(CompactUUID(), nullable=True)
+    gic_id = Column(CompactUUID(), nullable=True)
     status = Column(String(24), nullable=True)
-    interface_id = Column(String(64), ForeignKey('interface.interface_id'))
+    interface_id = Column(CompactUUID(), ForeignKey('interface.interface_id'))
+    # row version, every flush updates it with 'WHERE version = :old'
+    version = Column(Integer, nullable=False, server_default='0')
+    __mapper_args__ = {'version_id_col': version}
     interface = relation("Interface", backref='subinterface', lazy='select')
 
     def __init__(self, id, name, vlan_id, portgroup_name):
@@ -256,7 +307,7 @@ class Network_Ipv4(Base):
     step = Column(String(24), nullable=False)
     # primary and secondary network flag in Switch
     level = Column(String(24), nullable=False)
-    subinterface_id = Column(String(64), ForeignKey('subinterface.subinterface_id'))
+    subinterface_id = Column(CompactUUID(), ForeignKey('subinterface.subinterface_id'))
     subinterface = relation("Subinterface", backref='network_ipv4', lazy='select')
 
     def __init__(self, network_num, network_address, level, step):
@@ -274,14 +325,14 @@ class Network_Ipv6(Base):
     network_address = Column(String(24), nullable=True)
     # "adding|deleting|ok"
     step = Column(String(24), nullable=False)
-    subinterface_id = Column(String(64), ForeignKey('subinterface.subinterface_id'))
+    subinterface_id = Column(CompactUUID(), ForeignKey('subinterface.subinterface_id'))
     subinterface = relation("Subinterface", backref='network_ipv6', lazy='select')
 
 
 class Gic(Base):
     __tablename__ = 'gic'
 
-    gic_id = Column(String(64), primary_key=True)
+    gic_id = Column(CompactUUID(), primary_key=True)
     group_name = Column(String(40), nullable=False)
     core_name = Column(String(40), nullable=False)
     edge_name = Column(String(40), nullable=False)
@@ -291,6 +342,8 @@ class Gic(Base):
     qos = Column(Integer, nullable=True)
     status = Column(String(16), nullable=True)
     customer_id = Column(String(64), nullable=True)
+    version = Column(Integer, nullable=False, server_default='0')
+    __mapper_args__ = {'version_id_col': version}
 
     def __init__(self, group_name, core_name, edge_name, evi_id, edge_sid):
         self.gic_id = str(uuid.uuid4())
@@ -304,12 +357,14 @@ class Gic(Base):
 class GicExtension(Base):
     __tablename__ = 'gicextension'
 
-    gicextension_id = Column(String(64), primary_key=True)
-    app_id = Column(String(64), nullable=False)
-    gic_id = Column(String(64), nullable=False)
-    subinterface_id = Column(String(64), nullable=False)
+    gicextension_id = Column(CompactUUID(), primary_key=True)
+    app_id = Column(CompactUUID(), nullable=False)
+    gic_id = Column(CompactUUID(), nullable=False)
+    subinterface_id = Column(CompactUUID(), nullable=False)
     status = Column(String(16), nullable=False)
     starttime = Column(DateTime, nullable=True)
+    version = Column(Integer, nullable=False, server_default='0')
+    __mapper_args__ = {'version_id_col': version}
 
     def __init__(self, gicextension_id, app_id, gic_id, subinterface_id, status):
         self.gicextension_id = gicextension_id
@@ -323,13 +378,13 @@ class GicExtension(Base):
 class App(Base):
     __tablename__ = 'app'
 
-    app_id = Column(String(64), primary_key=True)
+    app_id = Column(CompactUUID(), primary_key=True)
     customer_id = Column(String(64), nullable=False)
-    zone_id = Column(String(64), nullable=False)
-    site_id = Column(String(64), nullable=False)
+    zone_id = Column(CompactUUID(), nullable=False)
+    site_id = Column(CompactUUID(), nullable=False)
     app_type = Column(String(64), nullable=True)
     create_time = Column(DateTime, nullable=True)
-    pod_id = Column(String(64), ForeignKey('pod.pod_id'))
+    pod_id = Column(CompactUUID(), ForeignKey('pod.pod_id'))
     pod = relation("Pod", backref='app', lazy='select')
 
     def __init__(self, app_id, customer_id, zone_id, site_id, pod_id, app_type):
@@ -345,7 +400,7 @@ class App(Base):
 class Vm(Base):
     __tablename__ = 'vm'
 
-    vm_id = Column(String(64), primary_key=True)
+    vm_id = Column(CompactUUID(), primary_key=True)
     vm_name = Column(String(64), nullable=False)
     processing = Column(Integer, nullable=True)
     template_id = Column(String(64), nullable=False)
@@ -358,7 +413,9 @@ class Vm(Base):
     create_time = Column(DateTime, nullable=False)
     update_time = Column(DateTime, nullable=True)
     configure_step = Column(String(40), nullable=False)
-    app_id = Column(String(64), ForeignKey('app.app_id'))
+    app_id = Column(CompactUUID(), ForeignKey('app.app_id'))
+    version = Column(Integer, nullable=False, server_default='0')
+    __mapper_args__ = {'version_id_col': version}
     app = relation("App", backref='vm', lazy='select')
 
     def __init__(self,
@@ -390,10 +447,10 @@ class Vm(Base):
 class Flavor_Info(Base):
     __tablename__ = 'flavor_info'
 
-    flavor_id = Column(String(64), primary_key=True)
+    flavor_id = Column(CompactUUID(), primary_key=True)
     cpu = Column(Integer, nullable=False)
     ram = Column(Integer, nullable=False)
-    vm_id = Column(String(64), ForeignKey('vm.vm_id'))
+    vm_id = Column(CompactUUID(), ForeignKey('vm.vm_id'))
     vm = relation("Vm", backref='flavor_info', lazy='select')
 
     def __init__(self, cpu, ram):
@@ -408,7 +465,7 @@ class Disk(Base):
     id = Column(Integer, primary_key=True)
     size = Column(Integer, nullable=False)
     is_load = Column(Integer, nullable=False)
-    flavor_id = Column(String(64), ForeignKey('flavor_info.flavor_id'))
+    flavor_id = Column(CompactUUID(), ForeignKey('flavor_info.flavor_id'))
     flavor_info = relation("Flavor_Info", backref='disk', lazy='select')
 
     def __init__(self, size, is_load):
@@ -419,12 +476,12 @@ class Disk(Base):
 class Vm_Network_Info(Base):
     __tablename__ = 'vm_network_info'
 
-    nic_id = Column(String(64), primary_key=True)
-    subinterface_id = Column(String(64), nullable=False)
+    nic_id = Column(CompactUUID(), primary_key=True)
+    subinterface_id = Column(CompactUUID(), nullable=False)
     network_connect = Column(String(12), nullable=False)
     mac = Column(String(24), nullable=True)
     status = Column(String(12), nullable=True)
-    vm_id = Column(String(64), ForeignKey('vm.vm_id'))
+    vm_id = Column(CompactUUID(), ForeignKey('vm.vm_id'))
     vm = relation("Vm", backref='vm_network_info', lazy='select')
 
     def __init__(self, nic_id, subinterface_id, status, network_connect, vm_id):
@@ -443,7 +500,7 @@ class Vm_Ipv4(Base):
     mask = Column(String(24), nullable=False)
     gateway = Column(String(24), nullable=False)
     dns = Column(String(24), nullable=False)
-    nic_id = Column(String(64), ForeignKey('vm_network_info.nic_id'))
+    nic_id = Column(CompactUUID(), ForeignKey('vm_network_info.nic_id'))
     nic = relation("Vm_Network_Info", backref='vm_ipv4', lazy='select')
 
     def __init__(self, ip, mask, gateway, dns):
@@ -458,7 +515,7 @@ class Vm_Ipv6(Base):
 
     id = Column(Integer, primary_key=True)
     ip = Column(String(24), nullable=True)
-    nic_id = Column(String(64), ForeignKey('vm_network_info.nic_id'))
+    nic_id = Column(CompactUUID(), ForeignKey('vm_network_info.nic_id'))
     nic = relation("Vm_Network_Info", backref='vm_ipv6', lazy='select')
 
     def __init__(self, ip):
@@ -468,14 +525,14 @@ class Vm_Ipv6(Base):
 class Vm_Os_Info(Base):
     __tablename__ = 'vm_os_info'
 
-    vm_os_id = Column(String(64), primary_key=True)
+    vm_os_id = Column(CompactUUID(), primary_key=True)
     hostname = Column(String(64), nullable=True)
     os_type = Column(String(64), nullable=False)
     os_version = Column(String(64), nullable=False)
     os_bit = Column(Integer, nullable=False)
     username = Column(String(64), nullable=False)
     password = Column(String(64), nullable=False)
-    vm_id = Column(String(64), ForeignKey('vm.vm_id'))
+    vm_id = Column(CompactUUID(), ForeignKey('vm.vm_id'))
     vm = relation("Vm", backref='vm_os_info', lazy='select')
 
     def __init__(self, hostname, os_type, os_version, os_bit, username, password):
@@ -490,11 +547,14 @@ class Vm_Os_Info(Base):
 
 class Action(Base):
     __tablename__ = 'action'
-
-    action_id = Column(String(64), primary_key=True)
-    app_id = Column(String(64), nullable=False)
-    vm_id = Column(String(64), nullable=False)
-    nic_id = Column(String(64), nullable=True)
+    __table_args__ = (Index('ix_action_status_action', 'status', 'action'),
+                      Index('ix_action_trigger_time', 'trigger_time'),
+                      _Base.__table_args__)
+
+    action_id = Column(CompactUUID(), primary_key=True)
+    app_id = Column(CompactUUID(), nullable=False)
+    vm_id = Column(CompactUUID(), nullable=False)
+    nic_id = Column(CompactUUID(), nullable=True)
     action = Column(String(16), nullable=False)
     trigger_time = Column(DateTime, nullable=False)
     status = Column(String(16), nullable=False)
@@ -509,13 +569,33 @@ class Action(Base):
         self.trigger_time = timeutils.utcnow()
 
 
+class ActionHistory(Base):
+    """Finished actions moved out of 'action' by Connection.archive_action.
+
+    trigger_time is part of the primary key so the table can be RANGE
+    partitioned on it, see tools/action_archive.py.
+    """
+    __tablename__ = 'action_history'
+    __table_args__ = (Index('ix_action_history_app_id', 'app_id'),
+                      Index('ix_action_history_vm_id', 'vm_id'),
+                      _Base.__table_args__)
+
+    action_id = Column(CompactUUID(), primary_key=True)
+    app_id = Column(CompactUUID(), nullable=False)
+    vm_id = Column(CompactUUID(), nullable=False)
+    nic_id = Column(CompactUUID(), nullable=True)
+    action = Column(String(16), nullable=False)
+    trigger_time = Column(DateTime, primary_key=True)
+    status = Column(String(16), nullable=False)
+
+
 class Vspc_Info(Base):
     __tablename__ = 'vspc_info'
 
-    vspc_id = Column(String(64), primary_key=True)
-    site_id = Column(String(64), nullable=False)
-    pod_id = Column(String(64), nullable=False)
-    cluster_id = Column(String(64), nullable=False)
+    vspc_id = Column(CompactUUID(), primary_key=True)
+    site_id = Column(CompactUUID(), nullable=False)
+    pod_id = Column(CompactUUID(), nullable=False)
+    cluster_id = Column(CompactUUID(), nullable=False)
     vspc_server_ip = Column(String(24), nullable=False)
     is_enable = Column(Integer, nullable=False)
 
@@ -531,15 +611,15 @@ class Vspc_Info(Base):
 class Serial_Connection(Base):
     __tablename__ = 'serial_connection'
 
-    connection_id = Column(String(64), primary_key=True)
-    site_id = Column(String(64), nullable=False)
-    pod_id = Column(String(64), nullable=False)
-    cluster_id = Column(String(64), nullable=False)
+    connection_id = Column(CompactUUID(), primary_key=True)
+    site_id = Column(CompactUUID(), nullable=False)
+    pod_id = Column(CompactUUID(), nullable=False)
+    cluster_id = Column(CompactUUID(), nullable=False)
     vm_name = Column(String(64), nullable=False)
     vspc_server_ip = Column(String(24), nullable=False)
     port = Column(Integer, nullable=False)
     is_connected = Column(Integer, nullable=False)
-    vspc_id = Column(String(64), ForeignKey('vspc_info.vspc_id'))
+    vspc_id = Column(CompactUUID(), ForeignKey('vspc_info.vspc_id'))
     vspc = relation("Vspc_Info", backref='serial_connection')
 
     def __init__(self,
@@ -561,3 +641,69 @@ class Serial_Connection(Base):
         self.port = port
         self.is_connected = is_connected
         self.vspc_id = vspc_id
+
+
+class ManagerHeartbeat(Base):
+    """Liveness of the rosmanager instances, the instances alive for a
+    (topic, site_name) share its routes on a consistent hash ring.
+    """
+    __tablename__ = 'manager_heartbeat'
+    __table_args__ = (Index('ix_manager_heartbeat_site', 'topic', 'site_name'),
+                      _Base.__table_args__)
+
+    host = Column(String(255), primary_key=True)
+    topic = Column(String(255), primary_key=True)
+    site_name = Column(String(40), nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+    def __init__(self, host, topic, site_name, updated_at):
+        self.host = host
+        self.topic = topic
+        self.site_name = site_name
+        self.updated_at = updated_at
+
+
+class GicPush(Base):
+    """Routes an updating gic's qos was pushed to. With route sharding
+    several rosmanagers push one gic, the one completing the last of its
+    routes sets it ok, see Connection.finish_push.
+    """
+    __tablename__ = 'gic_push'
+
+    gic_id = Column(CompactUUID(), primary_key=True)
+    route_id = Column(CompactUUID(), primary_key=True)
+    version = Column(Integer, nullable=False)
+
+    def __init__(self, gic_id, route_id, version):
+        self.gic_id = gic_id
+        self.route_id = route_id
+        self.version = version
+
+
+class Change(Base):
+    """Outbox of the router changes. The api adds a row per route of the
+    subinterface, ipv4, gic or gicextension it changes in the same
+    transaction (a site wide row, route_id None, for a nic). seq only
+    grows, a rosmanager reads the rows of its routes after the last seq it
+    saw instead of polling the status columns, see Connection.list_changes.
+    """
+    __tablename__ = 'outbox'
+    __table_args__ = (Index('ix_outbox_route_seq', 'route_id', 'seq'),
+                      Index('ix_outbox_site_seq', 'site_name', 'seq'),
+                      Index('ix_outbox_created_at', 'created_at'),
+                      _Base.__table_args__)
+
+    seq = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True,
+                 autoincrement=True)
+    object_type = Column(String(16), nullable=False)
+    object_id = Column(String(64), nullable=False)
+    route_id = Column(CompactUUID(), nullable=True)
+    site_name = Column(String(40), nullable=True)
+    created_at = Column(DateTime, nullable=False)
+
+    def __init__(self, object_type, object_id, route_id, site_name):
+        self.object_type = object_type
+        self.object_id = str(object_id)
+        self.route_id = route_id
+        self.site_name = site_name
+        self.created_at = timeutils.utcnow()
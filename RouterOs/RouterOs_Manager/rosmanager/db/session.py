@@ -7,6 +7,7 @@
 __author__ = 'hardy.Zheng'
 
 import uuid
+import datetime
 import functools
 import logging
 import re
@@ -15,13 +16,15 @@ import six
 import sqlalchemy.orm
 
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.orm.exc import StaleDataError
 from sqlalchemy import exc as sqla_exc
 from sqlalchemy import or_
+from sqlalchemy import func
 from sqlalchemy.sql.expression import literal_column
 from sqlalchemy.orm import joinedload_all
 from sqlalchemy.orm import subqueryload_all
 from oslo_utils import timeutils
-from rosmanager.common import db_models as models
+from rosmanager.db import db_models as models
 from rosmanager.common import exception as exc
 
 
@@ -132,6 +135,10 @@ def _wrap_db_error(f):
             # unique constraint, from error message.
             _raise_if_duplicate_entry_error(e, self.bind.dialect.name)
             raise exc.DBError(e)
+        # NOTE: raised by the ORM when the 'WHERE version = :old' of a
+        # versioned row (see db_models) matched nothing at flush time.
+        except StaleDataError as e:
+            raise exc.DBConflict(e)
         except Exception as e:
             # LOG.exception(_LE('DB exception wrapped.'))
             raise exc.DBError(e)
@@ -297,12 +304,14 @@ def create_engine(sql_connection, sqlite_fk=False, mysql_sql_mode=None,
     else:
         logger.setLevel(logging.WARNING)
 
-    if max_pool_size is not None:
-        engine_args['pool_size'] = max_pool_size
-    if max_overflow is not None:
-        engine_args['max_overflow'] = max_overflow
-    if pool_timeout is not None:
-        engine_args['pool_timeout'] = pool_timeout
+    # sqlite (tools/bench_push.py) runs on NullPool which rejects these
+    if not sql_connection.startswith('sqlite'):
+        if max_pool_size is not None:
+            engine_args['pool_size'] = max_pool_size
+        if max_overflow is not None:
+            engine_args['max_overflow'] = max_overflow
+        if pool_timeout is not None:
+            engine_args['pool_timeout'] = pool_timeout
 
     engine = sqlalchemy.create_engine(sql_connection, **engine_args)
 
@@ -653,6 +662,8 @@ class Connection(EngineFacade):
             session.close()
 
     def get_app(self, app_id):
+        if not models.is_uuid(app_id):
+            return None
         try:
             app = None
             session = self.engine.get_session()
@@ -680,6 +691,8 @@ class Connection(EngineFacade):
             session.close()
 
     def get_site_from_app(self, app_id):
+        if not models.is_uuid(app_id):
+            return None
         try:
             session = self.engine.get_session()
             app = session.query(models.App).\
@@ -763,6 +776,8 @@ class Connection(EngineFacade):
             session.close()
 
     def get_nic(self, nic_id):
+        if not models.is_uuid(nic_id):
+            return None
         try:
             nic = None
             session = self.engine.get_session()
@@ -830,6 +845,8 @@ class Connection(EngineFacade):
             raise exc.NoResultFound('not found nic')
 
     def get_subinterface(self, subinterface_id):
+        if not models.is_uuid(subinterface_id):
+            return None
         try:
             subinterface = None
             session = self.engine.get_session()
@@ -1081,6 +1098,8 @@ class Connection(EngineFacade):
             raise exc.DBError(str(e))
 
     def get_gic(self, gic_id):
+        if not models.is_uuid(gic_id):
+            return None
         try:
             gic = None
             session = self.engine.get_session()
@@ -1147,6 +1166,8 @@ class Connection(EngineFacade):
             raise exc.NoResultFound(message)
 
     def get_gicextension(self, gicextension_id):
+        if not models.is_uuid(gicextension_id):
+            return None
         try:
             gicextension = None
             session = self.engine.get_session()
@@ -1309,6 +1330,8 @@ class Connection(EngineFacade):
             raise exc.NoResultFound('not found gicextension_id')
 
     def get_action(self, action_id):
+        if not models.is_uuid(action_id):
+            return None
         try:
             action = None
             session = self.engine.get_session()
@@ -1454,6 +1477,8 @@ class Connection(EngineFacade):
             raise exc.DBError(str(e))
 
     def get_vspc(self, vspc_id):
+        if not models.is_uuid(vspc_id):
+            return None
         try:
             vspc = None
             session = self.engine.get_session()
@@ -1585,6 +1610,8 @@ class Connection(EngineFacade):
             raise exc.NoResultFound('not found vm')
 
     def get_vm(self, vm_id):
+        if not models.is_uuid(vm_id):
+            return None
         try:
             vm = None
             session = self.engine.get_session()
@@ -1902,3 +1929,356 @@ class Connection(EngineFacade):
             session.commit()
         except NoResultFound:
             raise exc.NoResultFound('not found nic')
+
+    def report_manager(self, host, topic, site_name):
+        """
+        refresh the heartbeat of a rosmanager instance, see
+        models.ManagerHeartbeat
+        """
+        session = self.engine.get_session()
+        try:
+            values = {'site_name': site_name,
+                      'updated_at': timeutils.utcnow()}
+            count = session.query(models.ManagerHeartbeat).\
+                filter(models.ManagerHeartbeat.host == host).\
+                filter(models.ManagerHeartbeat.topic == topic).\
+                update(values, synchronize_session=False)
+            if not count:
+                session.add(models.ManagerHeartbeat(host, topic, site_name,
+                                                    values['updated_at']))
+            session.commit()
+        except sqla_exc.SQLAlchemyError as e:
+            raise exc.DBError(e)
+        finally:
+            session.close()
+
+    def list_live_manager(self, topic, site_name, timeout):
+        """
+        hosts of the rosmanager instances of topic and site_name which
+        reported in the last timeout seconds, sorted
+        """
+        since = timeutils.utcnow() - datetime.timedelta(seconds=timeout)
+        session = self.engine.get_session()
+        try:
+            query = session.query(models.ManagerHeartbeat.host).\
+                filter(models.ManagerHeartbeat.topic == topic).\
+                filter(models.ManagerHeartbeat.site_name == site_name).\
+                filter(models.ManagerHeartbeat.updated_at >= since)
+            return sorted(row.host for row in query)
+        except sqla_exc.SQLAlchemyError as e:
+            raise exc.DBError(e)
+        finally:
+            session.close()
+
+    def list_changes(self, after, route_ids, limit=1000):
+        """
+        (seq, object_type, object_id, route_id) of the outbox rows of
+        route_ids after seq `after`, oldest first, at most limit, see
+        models.Change
+        """
+        if not route_ids:
+            return []
+        Change = models.Change
+        try:
+            session = self.engine.get_session()
+            query = session.query(Change.seq, Change.object_type,
+                                  Change.object_id, Change.route_id).\
+                filter(Change.route_id.in_(route_ids)).\
+                filter(Change.seq > after).\
+                order_by(Change.seq).limit(limit)
+            return query.all()
+        except sqla_exc.SQLAlchemyError as e:
+            raise exc.DBError(e)
+        finally:
+            session.close()
+
+    def last_change_seq(self):
+        """seq of the latest outbox row, 0 if empty"""
+        try:
+            session = self.engine.get_session()
+            return session.query(func.max(models.Change.seq)).scalar() or 0
+        except sqla_exc.SQLAlchemyError as e:
+            raise exc.DBError(e)
+        finally:
+            session.close()
+
+    def purge_changes(self, before):
+        """
+        drop the outbox rows created before datetime before. the newest
+        row stays: mysql restarts seq after the highest one left, the
+        cursors of the managers must not see seq go back
+        """
+        try:
+            session = self.engine.get_session()
+            last = session.query(func.max(models.Change.seq)).scalar() or 0
+            count = session.query(models.Change).\
+                filter(models.Change.created_at < before).\
+                filter(models.Change.seq < last).\
+                delete(synchronize_session=False)
+            session.commit()
+            return count
+        except sqla_exc.SQLAlchemyError as e:
+            raise exc.DBError(e)
+        finally:
+            session.close()
+
+    def list_pending_changes(self, route_ids):
+        """
+        router work waiting on route_ids, collected in one pass:
+            {route_id: {'subinterfaces': [(Subinterface, interface_name)],
+                        'ipv4s': [(Network_Ipv4, Subinterface)],
+                        'gicextensions': [(GicExtension, Subinterface, Gic)],
+                        'gics': [(Gic, Subinterface)]}}
+        subinterfaces are the adding and deleting ones, ipv4s and
+        gicextensions the adding and deleting ones plus all of the
+        deleting subinterfaces, gics the updating ones with their ok and
+        adding subinterfaces (the qos set merges into a pending queue add).
+        gic_routes maps every updating gic to all the routes of those
+        subinterfaces, returned as (pending, gic_routes)
+        """
+        pending = dict((route_id, {'subinterfaces': [], 'ipv4s': [],
+                                   'gicextensions': [], 'gics': []})
+                       for route_id in route_ids)
+        gic_routes = {}
+        if not route_ids:
+            return pending, gic_routes
+        working = ('adding', 'deleting')
+        Sub = models.Subinterface
+        Iface = models.Interface
+        try:
+            session = self.engine.get_session()
+            query = session.query(Sub, Iface.interface_name, Iface.route_id).\
+                join(Iface, Sub.interface_id == Iface.interface_id).\
+                filter(Iface.route_id.in_(route_ids)).\
+                filter(Sub.status.in_(working))
+            for sub, interface_name, route_id in query:
+                pending[route_id]['subinterfaces'].append((sub, interface_name))
+
+            query = session.query(models.Network_Ipv4, Sub, Iface.route_id).\
+                join(Sub, models.Network_Ipv4.subinterface_id == Sub.subinterface_id).\
+                join(Iface, Sub.interface_id == Iface.interface_id).\
+                filter(Iface.route_id.in_(route_ids)).\
+                filter(or_(models.Network_Ipv4.step.in_(working),
+                           Sub.status == 'deleting'))
+            for ipv4, sub, route_id in query:
+                pending[route_id]['ipv4s'].append((ipv4, sub))
+
+            query = session.query(models.GicExtension, Sub, models.Gic, Iface.route_id).\
+                join(Sub, models.GicExtension.subinterface_id == Sub.subinterface_id).\
+                join(models.Gic, models.GicExtension.gic_id == models.Gic.gic_id).\
+                join(Iface, Sub.interface_id == Iface.interface_id).\
+                filter(Iface.route_id.in_(route_ids)).\
+                filter(or_(models.GicExtension.status.in_(working),
+                           Sub.status == 'deleting'))
+            for gic_ex, sub, gic, route_id in query:
+                pending[route_id]['gicextensions'].append((gic_ex, sub, gic))
+
+            query = session.query(models.Gic, Sub, Iface.route_id).\
+                join(Sub, Sub.gic_id == models.Gic.gic_id).\
+                join(Iface, Sub.interface_id == Iface.interface_id).\
+                filter(models.Gic.status == 'updating')
+            for gic, sub, route_id in query:
+                if sub.status not in ('ok', 'adding'):
+                    continue
+                gic_routes.setdefault(gic.gic_id, set()).add(route_id)
+                if route_id in pending:
+                    pending[route_id]['gics'].append((gic, sub))
+            return pending, gic_routes
+        except sqla_exc.SQLAlchemyError as e:
+            raise exc.DBError(e)
+        finally:
+            session.close()
+
+    def finish_push(self, done):
+        """
+        write back the rows a config push applied, in one transaction:
+            done = {'subinterface_ok': [subinterface_id],
+                    'subinterface_free': [subinterface_id],
+                    'ipv4_ok': [id], 'ipv4_delete': [id],
+                    'gicextension_ok': [gicextension_id],
+                    'gicextension_delete': [gicextension_id],
+                    'gic_pushed': {gic_id: (version, [route_id])}}
+        a row only moves on while it still has the status the push read,
+        changes made by the api meanwhile are left for the next push. a gic
+        is set ok once every route of it got the qos of version, whichever
+        rosmanager pushed it
+        """
+        Sub = models.Subinterface
+        Ipv4 = models.Network_Ipv4
+        GicEx = models.GicExtension
+        counts = {}
+
+        def _ids(name):
+            return list(done.get(name) or ())
+
+        try:
+            session = self.engine.get_session()
+            ids = _ids('subinterface_ok')
+            if ids:
+                counts['subinterface_ok'] = session.query(Sub).\
+                    filter(Sub.subinterface_id.in_(ids)).\
+                    filter(Sub.status == 'adding').\
+                    update({'status': 'ok', 'version': Sub.version + 1},
+                           synchronize_session=False)
+            ids = _ids('subinterface_free')
+            if ids:
+                freed = [row.subinterface_id for row in
+                         session.query(Sub.subinterface_id).
+                         filter(Sub.subinterface_id.in_(ids)).
+                         filter(Sub.status == 'deleting')]
+                if freed:
+                    session.query(Ipv4).\
+                        filter(Ipv4.subinterface_id.in_(freed)).\
+                        delete(synchronize_session=False)
+                    session.query(models.Network_Ipv6).\
+                        filter(models.Network_Ipv6.subinterface_id.in_(freed)).\
+                        delete(synchronize_session=False)
+                    session.query(GicEx).\
+                        filter(GicEx.subinterface_id.in_(freed)).\
+                        delete(synchronize_session=False)
+                    session.query(Sub).\
+                        filter(Sub.subinterface_id.in_(freed)).\
+                        update({'vlan_type': None, 'alloc_time': None,
+                                'qos': None, 'app_id': None,
+                                'gic_id': None, 'status': None,
+                                'version': Sub.version + 1},
+                               synchronize_session=False)
+                counts['subinterface_free'] = len(freed)
+            ids = _ids('ipv4_ok')
+            if ids:
+                counts['ipv4_ok'] = session.query(Ipv4).\
+                    filter(Ipv4.id.in_(ids)).\
+                    filter(Ipv4.step == 'adding').\
+                    update({'step': 'ok'}, synchronize_session=False)
+            ids = _ids('ipv4_delete')
+            if ids:
+                counts['ipv4_delete'] = session.query(Ipv4).\
+                    filter(Ipv4.id.in_(ids)).\
+                    filter(Ipv4.step == 'deleting').\
+                    delete(synchronize_session=False)
+            ids = _ids('gicextension_ok')
+            if ids:
+                counts['gicextension_ok'] = session.query(GicEx).\
+                    filter(GicEx.gicextension_id.in_(ids)).\
+                    filter(GicEx.status == 'adding').\
+                    update({'status': 'ok', 'version': GicEx.version + 1},
+                           synchronize_session=False)
+            ids = _ids('gicextension_delete')
+            if ids:
+                counts['gicextension_delete'] = session.query(GicEx).\
+                    filter(GicEx.gicextension_id.in_(ids)).\
+                    filter(GicEx.status == 'deleting').\
+                    delete(synchronize_session=False)
+            pushed = done.get('gic_pushed') or {}
+            if pushed:
+                counts['gic_ok'] = self._finish_gics(session, pushed)
+            session.commit()
+            return counts
+        except sqla_exc.SQLAlchemyError as e:
+            raise exc.DBError(e)
+        finally:
+            session.close()
+
+    def _finish_gics(self, session, pushed):
+        """record the routes of pushed, set ok the gics all routes of which
+        are recorded at the version read, return how many
+        """
+        GicPush = models.GicPush
+        Gic = models.Gic
+        for gic_id, (version, route_ids) in pushed.items():
+            session.query(GicPush).\
+                filter(GicPush.gic_id == gic_id).\
+                filter(GicPush.route_id.in_(list(route_ids))).\
+                delete(synchronize_session=False)
+            session.add_all([GicPush(gic_id, route_id, version)
+                             for route_id in route_ids])
+        session.flush()
+        routes = self._gic_routes(session, list(pushed))
+        count = 0
+        for gic_id, (version, route_ids) in pushed.items():
+            recorded = set(row.route_id for row in
+                           session.query(GicPush.route_id).
+                           filter(GicPush.gic_id == gic_id).
+                           filter(GicPush.version == version))
+            if not routes.get(gic_id, set()) <= recorded:
+                continue
+            updated = session.query(Gic).\
+                filter(Gic.gic_id == gic_id).\
+                filter(Gic.status == 'updating').\
+                filter(Gic.version == version).\
+                update({'status': 'ok', 'version': Gic.version + 1},
+                       synchronize_session=False)
+            if updated:
+                session.query(GicPush).\
+                    filter(GicPush.gic_id == gic_id).\
+                    delete(synchronize_session=False)
+                count += updated
+        return count
+
+    def _gic_routes(self, session, gic_ids):
+        """{gic_id: set(route_id)} the routes of the ok and adding
+        subinterfaces of gic_ids
+        """
+        Sub = models.Subinterface
+        Iface = models.Interface
+        out = {}
+        if not gic_ids:
+            return out
+        query = session.query(Sub.gic_id, Iface.route_id).\
+            join(Iface, Sub.interface_id == Iface.interface_id).\
+            filter(Sub.gic_id.in_(gic_ids)).\
+            filter(Sub.status.in_(('ok', 'adding'))).\
+            distinct()
+        for gic_id, route_id in query:
+            out.setdefault(gic_id, set()).add(route_id)
+        return out
+
+    def list_route_config(self, route_ids):
+        """
+        config of route_ids as the db wants it, for the reconciler:
+            {route_id: {'subinterfaces': [(Subinterface, interface_name, gic_qos)],
+                        'ipv4s': [(Network_Ipv4, subinterface_name)],
+                        'gicextensions': [(GicExtension, subinterface_name, group_name)]}}
+        all the subinterfaces, allocated or free, the ipv4s and gicextensions
+        not being deleted
+        """
+        config = dict((route_id, {'subinterfaces': [], 'ipv4s': [],
+                                  'gicextensions': []})
+                      for route_id in route_ids)
+        if not route_ids:
+            return config
+        Sub = models.Subinterface
+        Iface = models.Interface
+        try:
+            session = self.engine.get_session()
+            query = session.query(Sub, Iface.interface_name, Iface.route_id,
+                                  models.Gic.qos).\
+                join(Iface, Sub.interface_id == Iface.interface_id).\
+                outerjoin(models.Gic, Sub.gic_id == models.Gic.gic_id).\
+                filter(Iface.route_id.in_(route_ids))
+            for sub, interface_name, route_id, gic_qos in query:
+                config[route_id]['subinterfaces'].append((sub, interface_name, gic_qos))
+
+            query = session.query(models.Network_Ipv4, Sub.subinterface_name,
+                                  Iface.route_id).\
+                join(Sub, models.Network_Ipv4.subinterface_id == Sub.subinterface_id).\
+                join(Iface, Sub.interface_id == Iface.interface_id).\
+                filter(Iface.route_id.in_(route_ids)).\
+                filter(models.Network_Ipv4.step != 'deleting')
+            for ipv4, sub_name, route_id in query:
+                config[route_id]['ipv4s'].append((ipv4, sub_name))
+
+            query = session.query(models.GicExtension, Sub.subinterface_name,
+                                  models.Gic.group_name, Iface.route_id).\
+                join(Sub, models.GicExtension.subinterface_id == Sub.subinterface_id).\
+                join(models.Gic, models.GicExtension.gic_id == models.Gic.gic_id).\
+                join(Iface, Sub.interface_id == Iface.interface_id).\
+                filter(Iface.route_id.in_(route_ids)).\
+                filter(models.GicExtension.status != 'deleting')
+            for gic_ex, sub_name, group_name, route_id in query:
+                config[route_id]['gicextensions'].append((gic_ex, sub_name, group_name))
+            return config
+        except sqla_exc.SQLAlchemyError as e:
+            raise exc.DBError(e)
+        finally:
+            session.close()
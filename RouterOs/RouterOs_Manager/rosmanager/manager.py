@@ -2,29 +2,351 @@
 
 __author__ = 'Hardy.zheng'
 
+import datetime
+import functools
+import time
 
 from oslo_log import log as logging
 import oslo_messaging as messaging
 from oslo_service import periodic_task
 
-import rosmanager
 from rosmanager import cfg
+from rosmanager import changefeed
+from rosmanager import push
+from rosmanager import reconcile
 from rosmanager.common.context import RouterOsContext
+from rosmanager.common import executor
+from rosmanager.common.executor import wait_result
+from rosmanager.common import exception
+from rosmanager.common import journal
+from rosmanager.common import routeros
+from rosmanager.db.session import Connection
 
 LOG = logging.getLogger(__name__)
 CONF = cfg.CONF
-rpc_version = rosmanager.__version__
+# 1.1: accepts msgpack payloads, see common/serializer.py
+rpc_version = '1.1'
 
 
 class Manager(periodic_task.PeriodicTasks):
+    """
+    rpc endpoint of the rosmanager. with rpc_workers the methods run on
+    the partitioned pool of common/executor.py and return to the server
+    at once: unmarked ones answer a call with None, a method whose return
+    value a rpc call expects has to be marked @wait_result and holds the
+    rpc server until it is done. cast targets (add, the batch items) stay
+    unmarked, a call needing their result gets a call-only method of its
+    own, like test. only rpc_methods are served, the periodic tasks and
+    recover run on the service's own threads
+    """
 
     target = messaging.Target(version=rpc_version)
+    rpc_methods = ('test', 'add', 'batch')
+    # the methods a batch may name, see batch()
+    cast_methods = ('add',)
+    # rpc server name and hashring.ManagerRing of this instance's site,
+    # set by RpcService when route_sharding is on
+    host = None
+    ring = None
 
     def __init__(self):
-        # super(Manager, self).__init__(CONF)
+        super(Manager, self).__init__(CONF)
         self.admin_context = RouterOsContext()
+        self.db_connection = Connection(CONF.mysql.engine)
+        # persistent api sessions to the routers, see common/routeros.py
+        self.routeros = routeros.RouterPools.from_conf(CONF.routeros)
+        # route_id -> reconcile.Snapshot
+        self.snapshots = {}
+        # per router jobs of the periodic tasks
+        self.scheduler = executor.KeyedScheduler(
+            CONF.router_workers, timeout=CONF.router_job_timeout,
+            failures=CONF.router_failures, backoff=CONF.router_backoff,
+            max_backoff=CONF.router_max_backoff)
+        # write-ahead journal of the router operations, see recover()
+        self.journal = None
+        if CONF.journal_dir:
+            self.journal = journal.Journal(
+                CONF.journal_dir, CONF.journal_segment_size * 1024 * 1024)
+        # outbox cursor of push_config, see changefeed.py
+        self.changes = None
+        if CONF.outbox_enabled:
+            self.changes = changefeed.ChangeFeed(self.db_connection,
+                                                 settle=CONF.outbox_settle)
+        self._full_scan_at = 0
+        # routes push_config has to look at again next tick
+        self._retry_routes = set()
+        self._owned_routes = set()
         LOG.info('Manager init ok')
 
+    def owns_route(self, route_id):
+        """
+        whether route_id is in this instance's slice, periodic work should
+        skip the routes of the other instances
+        """
+        if self.ring is None:
+            return True
+        owner = self.ring.get_host(route_id)
+        return owner is None or owner == self.host
+
+    @periodic_task.periodic_task
+    def push_config(self, context):
+        """
+        push the pending changes of this instance's routes, one batch and
+        one api session per router, then write back the done rows at once,
+        see push.py. with outbox_enabled only the routes with new outbox
+        rows are read
+        """
+        if not CONF.config_push:
+            return
+        site = self.db_connection.get_site(CONF.site_name)
+        if site is None:
+            LOG.warning('push_config: not found site %s' % CONF.site_name)
+            return
+        routes = [route for route in site.route if self.owns_route(route.route_id)]
+        dirty = self._dirty_routes(set(route.route_id for route in routes))
+        if dirty is not None:
+            routes = [route for route in routes if route.route_id in dirty]
+            if not routes:
+                return
+        owned = set(route.route_id for route in routes)
+        pending, _ = self.db_connection.list_pending_changes(list(owned))
+        # the version of every updating gic as read, finish_push sets it ok
+        # once all its routes, here or on other instances, got that qos
+        gic_versions = dict((gic.gic_id, gic.version) for work in pending.values()
+                            for gic, sub in work['gics'])
+        jobs = self._submit_routes('push_config', routes, self._push_route,
+                                   pending)
+        # busy, failed or timed out routes are read again next tick
+        self._retry_routes = set(owned)
+        done = {}
+        # gic_id -> routes its qos was pushed to
+        gic_pushed = {}
+        for route, (batch, failed) in self._wait_routes('push_config', jobs):
+            if not failed:
+                self._retry_routes.discard(route.route_id)
+            if batch is None:
+                continue
+            route_done = push.done(batch, failed)
+            for gic_id in route_done.pop('gic_ok', []):
+                gic_pushed.setdefault(gic_id, set()).add(route.route_id)
+            for name, ids in route_done.items():
+                done.setdefault(name, []).extend(ids)
+            LOG.debug('push_config: route %s %d ops, %d cancelled, %d rows failed' %
+                      (route.route_name, len(batch), batch.cancelled, len(failed)))
+        done['gic_pushed'] = dict((gic_id, (gic_versions[gic_id], pushed))
+                                  for gic_id, pushed in gic_pushed.items())
+        if any(done.values()):
+            LOG.info('push_config: %s' % self.db_connection.finish_push(done))
+
+    def _dirty_routes(self, owned):
+        """
+        the ids of owned which may have pending changes, None for all of
+        them: the outbox is off, the change feed overflowed or a full scan
+        is due (every outbox_full_scan seconds, catches what the feed
+        missed)
+        """
+        new = owned - self._owned_routes
+        self._owned_routes = owned
+        if self.changes is None:
+            return None
+        now = time.time()
+        if now - self._full_scan_at >= CONF.outbox_full_scan:
+            self._full_scan_at = now
+            # rows committed from here on are in the next poll
+            self.changes.reset()
+            return None
+        dirty = self.changes.poll(owned)
+        if dirty is None:
+            self._full_scan_at = now
+            return None
+        # routes just taken over from another instance are read in full
+        return (dirty | self._retry_routes | new) & owned
+
+    @periodic_task.periodic_task(spacing=3600)
+    def purge_changes(self, context):
+        """drop the outbox rows older than outbox_retention"""
+        if CONF.outbox_retention <= 0:
+            return
+        before = datetime.datetime.utcnow() - \
+            datetime.timedelta(seconds=CONF.outbox_retention)
+        count = self.db_connection.purge_changes(before)
+        if count:
+            LOG.info('purge_changes: %d outbox rows dropped' % count)
+
+    def recover(self):
+        """
+        verify the batches the journal holds open against the routers, at
+        start before the periodic tasks run: operations whose outcome was
+        lost are looked up on the router, push operations found missing are
+        applied again and the rows done are written back. the batches of a
+        route which cannot be reached are dropped: push_config pushes their
+        rows again from the db, a later replay could add back what the db
+        freed meanwhile
+        """
+        if self.journal is None:
+            return
+        batches = self.journal.pending()
+        if not batches:
+            return
+        site = self.db_connection.get_site(CONF.site_name)
+        routes = dict((route.route_id, route) for route in site.route) if site else {}
+        done = {}
+        replayed = []
+        for entry in batches:
+            route = routes.get(entry['route_id'])
+            if route is None:
+                LOG.warning('journal: route %s of batch %s is gone, dropped' %
+                            (entry['route_id'], entry['id']))
+                self.journal.commit(entry['id'])
+                continue
+            try:
+                route_done = self._replay(route, entry)
+            except Exception as e:
+                LOG.warning('journal: replay of batch %s on route %s failed, '
+                            'dropped: %s' % (entry['id'], route.route_name, e))
+                self.journal.commit(entry['id'])
+                continue
+            for name, ids in route_done.items():
+                done.setdefault(name, []).extend(ids)
+            replayed.append(entry['id'])
+        if any(done.values()):
+            LOG.info('journal: %s' % self.db_connection.finish_push(done))
+        for batch_id in replayed:
+            self.journal.commit(batch_id)
+        self.journal.sync()
+
+    def _replay(self, route, entry):
+        """finish_push argument of the rows of one open batch"""
+        api = self.routeros.for_route(route).acquire()
+        ops = [push.Op.from_dict(data) for data in entry['ops']]
+        unknown = ops
+        if entry['outcomes'] is not None:
+            for op, outcome in zip(ops, entry['outcomes']):
+                op.ids = outcome['ids']
+                op.result = outcome['result']
+                op.error = outcome['error']
+            unknown = []
+        missing = [op for op, applied in zip(unknown, push.verify(api, unknown))
+                   if not applied]
+        LOG.info('journal: batch %s (%s) on route %s, %d ops, %d unsure, %d missing' %
+                 (entry['id'], entry['task'], route.route_name, len(ops),
+                  len(unknown), len(missing)))
+        if entry['task'] != 'push_config':
+            # reconcile works out its delta again, the snapshots start empty
+            return {}
+        batch = push.Batch()
+        for op in missing:
+            batch.add(push.Op.from_dict(op.to_dict()))
+        failed = push.apply(api, batch) if len(batch) else set()
+        failed.update(row for op in ops if op.error is not None for row in op.rows)
+        batch.rows.update(row for op in ops for row in op.rows)
+        route_done = push.done(batch, failed)
+        # whether a gic is done depends on all of its routes, push_config
+        # sets its qos again
+        route_done.pop('gic_ok', None)
+        return route_done
+
+    @periodic_task.periodic_task
+    def reconcile_routes(self, context):
+        """
+        bring this instance's routes in line with the db, only the delta
+        is applied, see reconcile.py. runs every reconcile_interval
+        """
+        site = self.db_connection.get_site(CONF.site_name)
+        if site is None:
+            LOG.warning('reconcile: not found site %s' % CONF.site_name)
+            return
+        routes = [route for route in site.route if self.owns_route(route.route_id)]
+        config = self.db_connection.list_route_config(
+            [route.route_id for route in routes])
+        jobs = self._submit_routes('reconcile', routes, self._reconcile_route,
+                                   config)
+        for route, batch in self._wait_routes('reconcile', jobs):
+            if len(batch):
+                LOG.info('reconcile: route %s applied %d ops' % (route.route_name, len(batch)))
+
+    def _submit_routes(self, task, routes, func, data):
+        """queue func(route, data[route_id]) on the router scheduler, a
+        route still busy with an earlier job is left for the next tick
+        """
+        jobs = []
+        for route in routes:
+            if self.scheduler.busy(route.route_id):
+                LOG.info('%s: route %s still busy, skipped' % (task, route.route_name))
+                continue
+            jobs.append((route, self.scheduler.submit(
+                route.route_id, func, route, data[route.route_id])))
+        return jobs
+
+    def _wait_routes(self, task, jobs):
+        """(route, result) of the jobs done within router_job_timeout"""
+        deadline = time.time() + CONF.router_job_timeout
+        for route, job in jobs:
+            try:
+                yield route, job.get(max(0, deadline - time.time()))
+            except exception.JobTimeout:
+                LOG.warning('%s: route %s not done in %ss, result dropped' %
+                            (task, route.route_name, CONF.router_job_timeout))
+            except Exception as e:
+                LOG.warning('%s: route %s failed: %s' % (task, route.route_name, e))
+
+    def _push_route(self, route, pending):
+        batch = push.compile_route(pending)
+        if not batch.rows:
+            return None, None
+        failed = self._apply(route, 'push_config',
+                             self.routeros.for_route(route).acquire(), batch)
+        return batch, failed
+
+    def _reconcile_route(self, route, config):
+        snapshot = self.snapshots.get(route.route_id)
+        if snapshot is None:
+            snapshot = self.snapshots[route.route_id] = \
+                reconcile.Snapshot(CONF.reconcile_max_age)
+        return reconcile.reconcile(self.routeros.for_route(route).acquire(),
+                                   snapshot, config,
+                                   functools.partial(self._apply, route, 'reconcile'))
+
+    def _apply(self, route, task, api, batch):
+        """push.apply with the batch journaled: its operations are on disk
+        before the router is touched, their outcomes after, then the batch
+        is closed by the worker applying it, whether or not push_config
+        still waits for the result. rows left pending in the db are pushed
+        again next tick
+        """
+        if self.journal is None:
+            return push.apply(api, batch)
+        ops = [op for action, path, level in batch.levels() for op in level]
+        batch_id = self.journal.begin(task, route.route_id,
+                                      [op.to_dict() for op in ops])
+        self.journal.sync()
+        try:
+            failed = push.apply(api, batch)
+        except Exception:
+            # the rows stay pending, the next tick pushes them again
+            self.journal.commit(batch_id)
+            raise
+        self.journal.applied(batch_id, [op.outcome() for op in ops])
+        self.journal.commit(batch_id)
+        return failed
+
+    def batch(self, ctx, cast_method, items):
+        """
+        unpack the casts coalesced by the api CoalescingClient,
+        items: [{'context': ctx, 'kwargs': kwargs}, ...], cast_method
+        one of cast_methods
+        """
+        if cast_method not in self.cast_methods:
+            LOG.error('batch: refuse to dispatch %s' % cast_method)
+            return
+        func = getattr(self, cast_method)
+        for item in items:
+            try:
+                func(item['context'], **item['kwargs'])
+            except Exception as e:
+                LOG.exception('batch: %s failed: %s' % (cast_method, e))
+
+    @wait_result
     def test(self, ctx, **kwargs):
         print '*' * 10, 'test'
         print ctx
@@ -36,4 +358,3 @@ class Manager(periodic_task.PeriodicTasks):
         LOG.info('********* add: ')
         LOG.info('**** ctx : %s' % ctx)
         LOG.info('**** kwargs : %s' % kwargs)
-        return kwargs
@@ -0,0 +1,380 @@
+"""
+    Coalesced configuration push, one batch per router per tick.
+
+    compile_route() turns the pending rows of one router (see
+    Connection.list_pending_changes) into a Batch of RouterOS operations
+    keyed by the object they touch. An operation superseded by a later one
+    on the same object is dropped: sets are merged into a pending add or
+    set, a remove replaces a pending add or set. An add is not cancelled
+    out by the remove, a retried add may have reached the router on a
+    reply that was lost.
+
+    apply() sends the batch on one pooled api session level by level,
+    removals first (bridge ports, queues, addresses, vlans) then additions
+    in the opposite order, and pipelines the operations of a level.
+    An addition the router refuses is looked up by its IDENTITY attrs and
+    counts as done when the item is there, so a push failing halfway is
+    simply retried next tick; a lost session fails the operations still
+    unanswered, not the batch. The rows whose operations
+    all succeeded (or were cancelled) are returned by done() for the
+    manager to write back with one Connection.finish_push.
+
+    verify() tells whether operations whose outcome was lost (see
+    common/journal.py) show on the router.
+"""
+
+__author__ = 'Hardy.zheng'
+
+from oslo_log import log as logging
+
+from rosmanager.common import exception
+
+
+LOG = logging.getLogger(__name__)
+
+VLAN = '/interface/vlan'
+ADDRESS = '/ip/address'
+QUEUE = '/queue/simple'
+PORT = '/interface/bridge/port'
+
+# attrs telling the item an add creates
+IDENTITY = {
+    VLAN: ('name',),
+    ADDRESS: ('address', 'interface'),
+    QUEUE: ('name',),
+    PORT: ('interface',),
+}
+
+# (action, path) in the order they are applied
+LEVELS = (
+    ('remove', PORT),
+    ('remove', QUEUE),
+    ('remove', ADDRESS),
+    ('remove', VLAN),
+    ('add', VLAN),
+    ('set', VLAN),
+    ('add', ADDRESS),
+    ('add', QUEUE),
+    ('set', QUEUE),
+    ('add', PORT),
+    ('set', PORT),
+)
+
+
+class Op(object):
+    """one routeros operation; set and remove act on ids or else on the
+    items query finds, rows are the (kind, id, state) db rows it completes.
+    apply() leaves the .id an add created in result, the failure in error
+    """
+
+    def __init__(self, action, path, key, attrs=None, query=None, row=None,
+                 ids=None):
+        self.action = action
+        self.path = path
+        self.key = key
+        self.attrs = dict(attrs or {})
+        self.query = dict(query or {})
+        self.ids = list(ids or [])
+        self.rows = [row] if row else []
+        self.result = None
+        self.error = None
+
+    def __repr__(self):
+        return '<Op %s %s %s>' % (self.action, self.path, self.key)
+
+    def to_dict(self):
+        """the planned operation, for the journal"""
+        return {'action': self.action, 'path': self.path, 'key': self.key,
+                'attrs': self.attrs, 'query': self.query, 'ids': self.ids,
+                'rows': self.rows}
+
+    @classmethod
+    def from_dict(cls, data):
+        op = cls(data['action'], data['path'], tuple(data['key']),
+                 attrs=data['attrs'], query=data['query'], ids=data['ids'])
+        op.rows = [tuple(row) for row in data['rows']]
+        return op
+
+    def outcome(self):
+        return {'ids': self.ids, 'result': self.result, 'error': self.error}
+
+
+class Batch(object):
+
+    def __init__(self):
+        # key -> ops still to apply, in order
+        self._ops = {}
+        self.rows = set()
+        self.cancelled = 0
+
+    def add(self, op):
+        self.rows.update(op.rows)
+        ops = self._ops.setdefault(op.key, [])
+        last = ops[-1] if ops else None
+        if last is None or last.action == 'remove' and op.action == 'add':
+            ops.append(op)
+        elif last.action == 'remove' and op.action == 'set':
+            # nothing left to set
+            last.rows.extend(op.rows)
+            self.cancelled += 1
+        elif op.action == 'set':
+            last.attrs.update(op.attrs)
+            last.rows.extend(op.rows)
+            self.cancelled += 1
+        else:
+            # the later add or remove wins, it completes the rows of both
+            op.rows.extend(last.rows)
+            ops[-1] = op
+            self.cancelled += 1
+
+    def levels(self):
+        """[(action, path, [Op])] in apply order, empty levels left out"""
+        ops = [op for key_ops in self._ops.values() for op in key_ops]
+        out = []
+        for action, path in LEVELS:
+            level = sorted((op for op in ops if op.action == action and op.path == path),
+                           key=lambda op: op.key)
+            if level:
+                out.append((action, path, level))
+        return out
+
+    def __len__(self):
+        return sum(len(ops) for ops in self._ops.values())
+
+
+def max_limit(qos):
+    """simple queue max-limit of qos Mbit"""
+    return '%dM/%dM' % (qos, qos)
+
+
+def compile_route(pending):
+    """Batch of one router's pending rows"""
+    batch = Batch()
+    deleting = set()
+    # adds first: what they are superseded by comes later
+    for sub, interface_name in pending['subinterfaces']:
+        name = sub.subinterface_name
+        if sub.status == 'deleting':
+            deleting.add(sub.subinterface_id)
+            continue
+        row = ('subinterface', sub.subinterface_id, 'adding')
+        batch.add(Op('add', VLAN, ('vlan', name), row=row,
+                     attrs={'name': name, 'vlan_id': sub.vlan_id,
+                            'interface': interface_name}))
+        if sub.qos:
+            batch.add(Op('add', QUEUE, ('queue', name), row=row,
+                         attrs={'name': name, 'target': name,
+                                'max_limit': max_limit(sub.qos)}))
+    for ipv4, sub in pending['ipv4s']:
+        if ipv4.step == 'adding':
+            batch.add(Op('add', ADDRESS,
+                         ('address', sub.subinterface_name, ipv4.network_num),
+                         attrs={'address': ipv4.network_num,
+                                'interface': sub.subinterface_name},
+                         row=('ipv4', ipv4.id, 'adding')))
+    for gic_ex, sub, gic in pending['gicextensions']:
+        if gic_ex.status == 'adding':
+            batch.add(Op('add', PORT, ('port', sub.subinterface_name),
+                         attrs={'bridge': gic.group_name,
+                                'interface': sub.subinterface_name},
+                         row=('gicextension', gic_ex.gicextension_id, 'adding')))
+    for gic, sub in pending['gics']:
+        if gic.qos:
+            name = sub.subinterface_name
+            batch.add(Op('set', QUEUE, ('queue', name), query={'name': name},
+                         attrs={'max_limit': max_limit(gic.qos)},
+                         row=('gic', gic.gic_id, 'updating')))
+
+    # then the removals; those of a deleting subinterface complete its row
+    # too, it is not freed while something is left on its vlan
+    for gic_ex, sub, gic in pending['gicextensions']:
+        if gic_ex.status == 'deleting' or sub.subinterface_id in deleting:
+            op = Op('remove', PORT, ('port', sub.subinterface_name),
+                    query={'interface': sub.subinterface_name})
+            if gic_ex.status == 'deleting':
+                op.rows.append(('gicextension', gic_ex.gicextension_id, 'deleting'))
+            if sub.subinterface_id in deleting:
+                op.rows.append(('subinterface', sub.subinterface_id, 'deleting'))
+            batch.add(op)
+    for ipv4, sub in pending['ipv4s']:
+        if ipv4.step == 'deleting' or sub.subinterface_id in deleting:
+            op = Op('remove', ADDRESS,
+                    ('address', sub.subinterface_name, ipv4.network_num),
+                    query={'address': ipv4.network_num,
+                           'interface': sub.subinterface_name})
+            if ipv4.step == 'deleting':
+                op.rows.append(('ipv4', ipv4.id, 'deleting'))
+            if sub.subinterface_id in deleting:
+                op.rows.append(('subinterface', sub.subinterface_id, 'deleting'))
+            batch.add(op)
+    for sub, interface_name in pending['subinterfaces']:
+        if sub.subinterface_id not in deleting:
+            continue
+        name = sub.subinterface_name
+        row = ('subinterface', sub.subinterface_id, 'deleting')
+        batch.add(Op('remove', QUEUE, ('queue', name), query={'name': name}, row=row))
+        batch.add(Op('remove', VLAN, ('vlan', name), query={'name': name}, row=row))
+    return batch
+
+
+_SUFFIXES = {'k': 1000, 'M': 1000 ** 2, 'G': 1000 ** 3}
+
+
+def _rate(value):
+    """'10M/10M' and '10000000/10000000' compare equal"""
+    rates = []
+    for part in str(value).split('/'):
+        part = part.strip()
+        scale = _SUFFIXES.get(part[-1:], 1)
+        if scale != 1:
+            part = part[:-1]
+        try:
+            rates.append(int(float(part) * scale))
+        except ValueError:
+            rates.append(part)
+    return tuple(rates)
+
+
+_NORMALIZE = {'max-limit': _rate}
+
+
+def same_value(name, desired, actual):
+    """whether attribute name (vlan_id or vlan-id form) has its desired
+    value as printed by the router
+    """
+    normalize = _NORMALIZE.get(name.replace('_', '-'), str)
+    return normalize(desired) == normalize(actual)
+
+
+def _query_words(query):
+    return ['?%s=%s' % (name.replace('_', '-'), value)
+            for name, value in sorted(query.items())]
+
+
+def _op_query(op):
+    if op.ids:
+        return {'.id': op.ids[0]} if len(op.ids) == 1 else None
+    if op.action == 'add':
+        return dict((name, op.attrs[name]) for name in IDENTITY[op.path])
+    return op.query
+
+
+def verify(api, ops):
+    """whether each of ops shows on the router, for the ops whose outcome
+    was lost: the item of an add is there, the items of a remove are gone,
+    the items of a set have its attrs
+    """
+    lookups = []
+    for op in ops:
+        query = _op_query(op)
+        if query is None:
+            # several ids, look at all of the table
+            lookups.append(api.send('%s/print' % op.path))
+        else:
+            lookups.append(api.send('%s/print' % op.path, *_query_words(query)))
+    applied = []
+    for op, lookup in zip(ops, lookups):
+        rows = lookup.get()
+        if op.ids and _op_query(op) is None:
+            rows = [row for row in rows if row.get('.id') in op.ids]
+        if op.action == 'remove':
+            applied.append(not rows)
+        elif op.action == 'add':
+            applied.append(bool(rows))
+        else:
+            applied.append(bool(rows) and all(
+                same_value(name, value, row.get(name.replace('_', '-')))
+                for row in rows for name, value in op.attrs.items()))
+    return applied
+
+
+def apply(api, batch):
+    """apply batch on api (a routeros.Connection), return the failed rows"""
+    failed = set()
+    # ops answered by the router, or with nothing to do
+    answered = set()
+
+    def _failed(op, error):
+        LOG.warning('push %s %s %s failed: %s' % (op.action, op.path, op.key, error))
+        op.error = error
+        failed.update(op.rows)
+
+    levels = batch.levels()
+    try:
+        for action, path, ops in levels:
+            if action == 'add':
+                replies = [(op, api.send('%s/add' % path, **op.attrs)) for op in ops]
+                trapped = []
+                for op, reply in replies:
+                    try:
+                        reply.get()
+                        op.result = (reply.done or {}).get('ret')
+                        answered.add(op)
+                    except exception.RouterOsError as e:
+                        trapped.append((op, e.msg))
+                # a retried push finds the item the last one added, whatever
+                # the router says about it: look it up
+                lookups = [(op, error, api.send('%s/print' % path, '=.proplist=.id',
+                                                *_query_words(_op_query(op))))
+                           for op, error in trapped]
+                for op, error, lookup in lookups:
+                    try:
+                        rows = lookup.get()
+                    except exception.RouterOsError as e:
+                        rows, error = [], '%s, lookup: %s' % (error, e.msg)
+                    if rows:
+                        op.result = rows[0].get('.id')
+                    else:
+                        _failed(op, error)
+                    answered.add(op)
+                continue
+
+            # set and remove without ids find their items first
+            lookups = [(op, api.send('%s/print' % path, '=.proplist=.id',
+                                     *_query_words(op.query)))
+                       for op in ops if not op.ids]
+            for op, lookup in lookups:
+                try:
+                    op.ids = [row['.id'] for row in lookup.get()]
+                except exception.RouterOsError as e:
+                    _failed(op, e.msg)
+                    continue
+                if not op.ids and action == 'set':
+                    _failed(op, 'not found')
+            replies = []
+            for op in ops:
+                # no ids: lookup failed, or nothing left to remove
+                if op.ids and op.error is None:
+                    replies.append((op, api.send('%s/%s' % (path, action),
+                                                 numbers=','.join(op.ids), **op.attrs)))
+                else:
+                    answered.add(op)
+            for op, reply in replies:
+                try:
+                    reply.get()
+                except exception.RouterOsError as e:
+                    _failed(op, e.msg)
+                answered.add(op)
+    except exception.RouterOsConnectionError as e:
+        # what the router answered stays done, the rest is pushed again
+        # next tick
+        for action, path, ops in levels:
+            for op in ops:
+                if op not in answered and op.error is None:
+                    _failed(op, e.msg)
+    return failed
+
+
+def done(batch, failed):
+    """finish_push argument of the rows of batch which did not fail"""
+    out = {}
+    names = {('subinterface', 'adding'): 'subinterface_ok',
+             ('subinterface', 'deleting'): 'subinterface_free',
+             ('ipv4', 'adding'): 'ipv4_ok',
+             ('ipv4', 'deleting'): 'ipv4_delete',
+             ('gicextension', 'adding'): 'gicextension_ok',
+             ('gicextension', 'deleting'): 'gicextension_delete',
+             ('gic', 'updating'): 'gic_ok'}
+    for kind, row_id, state in batch.rows - failed:
+        out.setdefault(names[(kind, state)], []).append(row_id)
+    return out
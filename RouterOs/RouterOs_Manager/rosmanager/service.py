@@ -1,4 +1,6 @@
 # yes
+import socket
+
 import oslo_messaging as messaging
 from oslo_log import log as logging
 from oslo_service import service
@@ -6,6 +8,11 @@ from oslo_service import loopingcall
 from oslo_utils import importutils
 from osprofiler import profiler
 from rosmanager.common import rpc
+from rosmanager.common import dedup
+from rosmanager.common import executor
+from rosmanager.common import hashring
+from rosmanager.common import periodic
+from rosmanager.common import tracing
 from rosmanager import cfg
 
 
@@ -23,6 +30,9 @@ class RpcService(service.Service):
         super(RpcService, self).__init__()
         LOG.info('********* self.host %s' % CONF.host)
         self.host = host or CONF.host
+        if CONF.route_sharding and self.host == '0.0.0.0':
+            # the host is the rpc server name the api routes casts to
+            self.host = socket.gethostname()
         self.binary = binary or 'rosmanager'
         self.topic = topic
         _manager = importutils.import_object(manager)
@@ -40,18 +50,104 @@ class RpcService(service.Service):
         if not hasattr(self.manager_impl, 'target'):
             self.manager_impl.target = target
 
-        endpoints = [self.manager_impl]
+        self.pool = None
+        self.dedup = None
+        self.periodic = None
+        endpoint = executor.RpcEndpoint(self.manager_impl,
+                                        self.manager_impl.rpc_methods)
+        if CONF.report_interval > 0:
+            intervals = {'reconcile_routes': CONF.reconcile_interval}
+            intervals.update((name, float(value)) for name, value
+                             in CONF.periodic_intervals.items())
+            self.periodic = periodic.PeriodicScheduler(
+                self.manager_impl, default_interval=CONF.report_interval,
+                intervals=intervals, jitter=CONF.periodic_jitter,
+                wake_delay=CONF.periodic_wake_delay / 1000.0)
+            if CONF.periodic_wake_tasks:
+                endpoint = periodic.WakeEndpoint(endpoint, self.periodic,
+                                                 CONF.periodic_wake_tasks)
+        if CONF.trace_enabled:
+            from rosmanager.db.session import Connection
+            tracing.setup(CONF.trace_file, self.binary)
+            tracing.trace_methods(Connection, 'db')
+            endpoint = tracing.TracingEndpoint(endpoint)
+        if CONF.dedup_window_size > 0:
+            self.dedup = dedup.DedupWindow(CONF.dedup_window_size,
+                                           CONF.dedup_ttl,
+                                           CONF.dedup_state_file or None)
+            endpoint = dedup.DedupEndpoint(endpoint, self.dedup)
+        lanes = self._lanes()
+        self.lane_servers = []
+        if CONF.rpc_workers > 0 or lanes:
+            self.pool = executor.PartitionedPool(max(CONF.rpc_workers, 1),
+                                                 lanes or None)
+            for lane in lanes:
+                lane_target = messaging.Target(
+                    topic='%s.%s' % (self.topic, lane), server=self.host,
+                    version=self.rpc_api_version)
+                lane_endpoint = executor.PartitionedEndpoint(
+                    endpoint, self.pool, CONF.rpc_partition_keys, lane,
+                    self.manager_impl.cast_methods)
+                self.lane_servers.append(
+                    rpc.get_server(lane_target, [lane_endpoint]))
+            # the plain topic keeps serving older apis, on the default lane
+            endpoint = executor.PartitionedEndpoint(
+                endpoint, self.pool, CONF.rpc_partition_keys,
+                cast_methods=self.manager_impl.cast_methods)
+        endpoints = [endpoint]
         self.rpcserver = rpc.get_server(target, endpoints)
         self.rpcserver.start()
+        for server in self.lane_servers:
+            server.start()
+
+        self.heartbeat = None
+        if CONF.route_sharding:
+            self._start_heartbeat()
+
+        # finish what the last run left on the routers before pushing more
+        try:
+            self.manager_impl.recover()
+        except Exception:
+            LOG.exception('journal recovery failed')
+
+        # runs on its own thread, start() returns
+        if self.periodic is not None:
+            self.periodic.start()
+
+    def _lanes(self):
+        """rpc_lanes as {name: weight}"""
+        lanes = {}
+        for lane in CONF.rpc_lanes:
+            name, _, weight = lane.partition(':')
+            try:
+                lanes[name.strip()] = max(1, int(weight or 1))
+            except ValueError:
+                raise ValueError('bad rpc_lanes entry %s, expect name:weight' % lane)
+        if lanes and executor.DEFAULT_LANE not in lanes:
+            raise ValueError('rpc_lanes needs the %s lane' % executor.DEFAULT_LANE)
+        return lanes
+
+    def _start_heartbeat(self):
+        from rosmanager.db.session import Connection
+        db_connection = Connection(CONF.mysql.engine)
+        self.manager_impl.host = self.host
+        self.manager_impl.ring = hashring.ManagerRing(
+            db_connection, self.topic, CONF.site_name,
+            timeout=CONF.manager_heartbeat_timeout,
+            replicas=CONF.shard_replicas,
+            refresh=CONF.heartbeat_interval)
+
+        def _report():
+            try:
+                db_connection.report_manager(self.host, self.topic,
+                                             CONF.site_name)
+            except Exception as e:
+                LOG.warning('report heartbeat failed: %s' % e)
 
-        # TODO(hub-cap): Currently the context is none... do we _need_ it here?
-        report_interval = CONF.report_interval
-        if report_interval > 0:
-            pulse = loopingcall.FixedIntervalLoopingCall(
-                self.manager_impl.run_periodic_tasks, context=None)
-            pulse.start(interval=report_interval,
-                        initial_delay=report_interval)
-            pulse.wait()
+        _report()
+        self.heartbeat = loopingcall.FixedIntervalLoopingCall(_report)
+        self.heartbeat.start(interval=CONF.heartbeat_interval,
+                             initial_delay=CONF.heartbeat_interval)
 
     def stop(self):
         # Try to shut the connection down, but if we get any sort of
@@ -61,5 +157,24 @@ class RpcService(service.Service):
         except Exception:
             LOG.info("Failed to stop RPC server before shutdown. ")
             pass
+        for server in getattr(self, 'lane_servers', []):
+            try:
+                server.stop()
+            except Exception:
+                LOG.info("Failed to stop lane RPC server before shutdown. ")
+        if getattr(self, 'periodic', None) is not None:
+            self.periodic.stop()
+        if getattr(self, 'heartbeat', None) is not None:
+            self.heartbeat.stop()
+        if getattr(self, 'pool', None) is not None:
+            self.pool.stop()
+        if getattr(self.manager_impl, 'scheduler', None) is not None:
+            self.manager_impl.scheduler.stop()
+        if getattr(self.manager_impl, 'journal', None) is not None:
+            self.manager_impl.journal.close()
+        if getattr(self.manager_impl, 'routeros', None) is not None:
+            self.manager_impl.routeros.close()
+        if getattr(self, 'dedup', None) is not None and self.dedup.state_file:
+            self.dedup.save()
 
         super(RpcService, self).stop()
@@ -20,7 +20,8 @@ setup(
         'oslo.service>=0.10.0',
         'netaddr>=0.5.0',
         'stevedore>=0.14',
-        'anyjson>=0.3.3'],
+        'anyjson>=0.3.3',
+        'msgpack>=0.5.2'],
     packages=find_packages(),
     scripts=['routeros-manager'],
     data_files=[('/etc/init.d', ['etc/init.d/routeros_manager']),
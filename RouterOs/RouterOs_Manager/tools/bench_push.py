@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+#
+# Push vlan and qos churn through Manager.push_config against simulated
+# routers (tools/ros_simulator.py) and report the commands per second,
+# the batch sizes and the apply latency.
+#
+#   python tools/bench_push.py --routers 4 --vlans 256 --churn 32 --latency 2
+#   python tools/bench_push.py --failure-rate 0.02 --drop-rate 0.005
+#
+# Every round changes the db the way the api does (subinterfaces
+# allocated with an address and a qos, some joined to a gic, ok ones
+# deleted or given another address, gic qos updated), then runs one
+# push_config tick. Rows failed by injected errors are pushed again by the
+# next rounds, after the last one the remaining rows are drained and the
+# routers are diffed against the db (reconcile.diff), drift should be 0.
+# A gic row is done once all the queues of its subinterfaces were set in
+# one tick, with high failure rates some may be left pending.
+#
+# The default engine is a sqlite file under /tmp, the tables are created
+# and filled by the script, do not point it at a production database.
+
+__author__ = 'Hardy.zheng'
+
+import datetime
+import random
+import time
+import uuid
+from optparse import OptionParser
+
+from rosmanager import cfg
+from rosmanager import manager
+from rosmanager import reconcile
+from rosmanager.db import db_models as models
+
+import ros_simulator
+
+
+CONF = cfg.CONF
+SITE = 'bench'
+INTERFACE = 'ether1'
+
+parser = OptionParser()
+parser.add_option("-e", "--engine", dest="engine",
+                  default='sqlite:////tmp/rosmanager_bench.db',
+                  help="sqlalchemy engine url")
+parser.add_option("-r", "--routers", dest="routers", type="int", default=4,
+                  help="simulated routers")
+parser.add_option("-v", "--vlans", dest="vlans", type="int", default=256,
+                  help="subinterfaces per router")
+parser.add_option("-g", "--gics", dest="gics", type="int", default=4,
+                  help="gics (bridges) shared by the routers")
+parser.add_option("-n", "--rounds", dest="rounds", type="int", default=20,
+                  help="push_config ticks with churn")
+parser.add_option("-c", "--churn", dest="churn", type="int", default=32,
+                  help="changes per router per round")
+parser.add_option("-l", "--latency", dest="latency", type="float", default=1,
+                  help="ms per router command")
+parser.add_option("-j", "--jitter", dest="jitter", type="float", default=0,
+                  help="+- ms on the latency")
+parser.add_option("-f", "--failure-rate", dest="failure_rate", type="float",
+                  default=0, help="share of the write commands that trap")
+parser.add_option("-d", "--drop-rate", dest="drop_rate", type="float", default=0,
+                  help="share of the write commands whose session is dropped")
+parser.add_option("-m", "--max-connections", dest="max_connections", type="int",
+                  default=0, help="api sessions per router, 0 is unlimited")
+parser.add_option("--pool-size", dest="pool_size", type="int", default=2,
+                  help="[routeros] api_pool_size")
+parser.add_option("--max-inflight", dest="max_inflight", type="int", default=32,
+                  help="[routeros] api_max_inflight")
+parser.add_option("-s", "--seed", dest="seed", type="int", default=1)
+
+
+def setup_conf(options):
+    cfg.parse_args([])
+    CONF.set_override('engine', options.engine, group='mysql')
+    CONF.set_override('api_pool_size', options.pool_size, group='routeros')
+    CONF.set_override('api_max_inflight', options.max_inflight, group='routeros')
+    CONF.set_override('api_keepalive', 0, group='routeros')
+    CONF.set_override('site_name', SITE)
+    CONF.set_override('config_push', True)
+    CONF.set_override('router_workers', options.routers)
+    # injected failures must not suspend the routers
+    CONF.set_override('router_failures', 1 << 20)
+    CONF.set_override('journal_dir', '')
+    CONF.set_override('outbox_enabled', False)
+
+
+def populate(engine, options, simulators):
+    models.Base.metadata.drop_all(engine)
+    models.Base.metadata.create_all(engine)
+    now = datetime.datetime.utcnow()
+    site_id = str(uuid.uuid4())
+    engine.execute(models.Site.__table__.insert(),
+                   [dict(site_id=site_id, site_name=SITE, create_time=now,
+                         vcenter_ip='127.0.0.1', vcenter_port=443,
+                         vcenter_username='admin', vcenter_password='admin')])
+    gics = [dict(gic_id=str(uuid.uuid4()), group_name='gic-%d' % i,
+                 core_name='core-%d' % i, edge_name='edge-%d' % i, evi_id=i,
+                 edge_sid=i, qos=10, status='ok', customer_id='c1')
+            for i in range(options.gics)]
+    if gics:
+        engine.execute(models.Gic.__table__.insert(), gics)
+    interfaces = []
+    for n, simulator in enumerate(simulators):
+        route_id = str(uuid.uuid4())
+        interface_id = str(uuid.uuid4())
+        engine.execute(models.Route.__table__.insert(),
+                       [dict(route_id=route_id, route_name='r%d' % n,
+                             username=simulator.username,
+                             password=simulator.password, ip=simulator.host,
+                             port=simulator.port, site_id=site_id, create_time=now)])
+        engine.execute(models.Interface.__table__.insert(),
+                       [dict(interface_id=interface_id, interface_name=INTERFACE,
+                             route_id=route_id)])
+        engine.execute(models.Subinterface.__table__.insert(),
+                       [dict(subinterface_id=str(uuid.uuid4()),
+                             subinterface_name='vlan%d' % (100 + i),
+                             vlan_id=100 + i, portgroup_name='pg%d' % i,
+                             interface_id=interface_id)
+                        for i in range(options.vlans)])
+        interfaces.append(interface_id)
+    return interfaces, [gic['gic_id'] for gic in gics]
+
+
+class Churn(object):
+    """db writes as the api makes them"""
+
+    def __init__(self, engine, interfaces, gics):
+        self.engine = engine
+        self.interfaces = interfaces
+        self.gics = gics
+        # the queue of a gic subinterface has the qos of the gic
+        self.gic_qos = dict((gic_id, 10) for gic_id in gics)
+        self.networks = 0
+        self.counts = {}
+
+    def _network(self):
+        self.networks += 1
+        return '10.%d.%d.1/24' % (self.networks // 256 % 256, self.networks % 256)
+
+    def _count(self, name):
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def run(self, changes):
+        sub = models.Subinterface.__table__
+        ipv4 = models.Network_Ipv4.__table__
+        gic_ex = models.GicExtension.__table__
+        now = datetime.datetime.utcnow()
+        for interface_id in self.interfaces:
+            rows = self.engine.execute(
+                sub.select().where(sub.c.interface_id == interface_id)).fetchall()
+            free = [row for row in rows if row.status is None]
+            ok = [row for row in rows if row.status == 'ok']
+            for _ in range(changes):
+                kind = random.choice(('alloc', 'alloc', 'delete', 'address'))
+                if kind == 'alloc' and free or not ok:
+                    if not free:
+                        break
+                    row = free.pop(random.randrange(len(free)))
+                    gic_id = random.choice(self.gics) if self.gics and \
+                        random.random() < 0.25 else None
+                    self.engine.execute(
+                        sub.update().where(sub.c.subinterface_id == row.subinterface_id).
+                        values(app_id=str(uuid.uuid4()), alloc_time=now,
+                               vlan_type='gic' if gic_id else 'public',
+                               qos=self.gic_qos[gic_id] if gic_id else
+                               random.choice((10, 20, 50, 100)),
+                               gic_id=gic_id, status='adding',
+                               version=sub.c.version + 1))
+                    self.engine.execute(ipv4.insert(), [dict(
+                        network_num=self._network(), network_address='',
+                        level='primary', step='adding',
+                        subinterface_id=row.subinterface_id)])
+                    if gic_id:
+                        self.engine.execute(gic_ex.insert(), [dict(
+                            gicextension_id=str(uuid.uuid4()), app_id=str(uuid.uuid4()),
+                            gic_id=gic_id, subinterface_id=row.subinterface_id,
+                            status='adding', starttime=now)])
+                    self._count('alloc')
+                    continue
+                row = ok.pop(random.randrange(len(ok)))
+                if kind == 'delete':
+                    self.engine.execute(
+                        sub.update().where(sub.c.subinterface_id == row.subinterface_id).
+                        values(status='deleting', version=sub.c.version + 1))
+                    self._count('delete')
+                else:
+                    self.engine.execute(ipv4.insert(), [dict(
+                        network_num=self._network(), network_address='',
+                        level='secondary', step='adding',
+                        subinterface_id=row.subinterface_id)])
+                    self._count('address')
+        if self.gics:
+            gic = models.Gic.__table__
+            gic_id = random.choice(self.gics)
+            self.gic_qos[gic_id] = random.choice((10, 20, 50, 100))
+            self.engine.execute(
+                gic.update().where(gic.c.gic_id == gic_id).
+                values(qos=self.gic_qos[gic_id], status='updating',
+                       version=gic.c.version + 1))
+            self._count('gic qos')
+
+
+def pending(conn, route_ids):
+    work, gic_routes = conn.list_pending_changes(route_ids)
+    return sum(len(rows) for route in work.values() for rows in route.values()) + \
+        len(gic_routes)
+
+
+def percentile(values, share):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+def main():
+    (options, args) = parser.parse_args()
+    random.seed(options.seed)
+    setup_conf(options)
+    simulators = []
+    for _ in range(options.routers):
+        device = ros_simulator.Device([INTERFACE],
+                                      ['gic-%d' % i for i in range(options.gics)])
+        simulator = ros_simulator.Simulator(
+            device=device, latency=options.latency / 1000.0,
+            jitter=options.jitter / 1000.0, failure_rate=options.failure_rate,
+            drop_rate=options.drop_rate, max_connections=options.max_connections)
+        simulator.start()
+        simulators.append(simulator)
+
+    mgr = manager.Manager()
+    conn = mgr.db_connection
+    interfaces, gics = populate(conn.engine.get_engine(), options, simulators)
+    route_ids = [route.route_id for route in conn.get_site(SITE).route]
+    churn = Churn(conn.engine.get_engine(), interfaces, gics)
+
+    # (ops, seconds) of every batch applied
+    batches = []
+    apply = mgr._apply
+
+    def _apply(route, task, api, batch):
+        start = time.time()
+        try:
+            return apply(route, task, api, batch)
+        finally:
+            batches.append((len(batch), time.time() - start))
+    mgr._apply = _apply
+
+    ticks = []
+    commands = 0
+
+    def tick():
+        before = sum(s.counts['commands'] for s in simulators)
+        start = time.time()
+        mgr.push_config(mgr.admin_context)
+        ticks.append(time.time() - start)
+        return sum(s.counts['commands'] for s in simulators) - before
+
+    for _ in range(options.rounds):
+        churn.run(options.churn)
+        commands += tick()
+    drain = 0
+    while pending(conn, route_ids) and drain < 10:
+        commands += tick()
+        drain += 1
+    left = pending(conn, route_ids)
+
+    config = conn.list_route_config(route_ids)
+    drift = 0
+    for route in conn.get_site(SITE).route:
+        api = mgr.routeros.for_route(route).acquire()
+        snapshot = reconcile.Snapshot()
+        snapshot.refresh(api)
+        desired, managed = reconcile.desired_state(config[route.route_id])
+        drift += len(reconcile.diff(desired, managed, snapshot))
+
+    mgr.scheduler.stop()
+    mgr.routeros.close()
+    stats = [simulator.stats() for simulator in simulators]
+    for simulator in simulators:
+        simulator.stop()
+
+    sizes = [ops for ops, seconds in batches]
+    latencies = [seconds * 1000 for ops, seconds in batches]
+    busy = sum(ticks)
+    print 'routers %d, vlans %d, rounds %d (+%d drain), latency %.1fms' % (
+        options.routers, options.vlans, options.rounds, drain, options.latency)
+    print 'churn            %s' % ', '.join('%s %d' % item for item in sorted(churn.counts.items()))
+    print 'commands         %d in %.2fs of push, %.0f/s' % (
+        commands, busy, commands / busy if busy else 0)
+    print 'batches          %d, ops %d, size p50 %d p95 %d max %d' % (
+        len(sizes), sum(sizes), percentile(sizes, 0.5), percentile(sizes, 0.95),
+        max(sizes or [0]))
+    print 'apply latency    p50 %.1fms p95 %.1fms max %.1fms' % (
+        percentile(latencies, 0.5), percentile(latencies, 0.95), max(latencies or [0]))
+    print 'tick latency     p50 %.1fms p95 %.1fms max %.1fms' % (
+        percentile(ticks, 0.5) * 1000, percentile(ticks, 0.95) * 1000,
+        max(ticks or [0]) * 1000)
+    print 'sessions         %d opened, %d refused, peak %d per router' % (
+        sum(s.get('sessions', 0) for s in stats), sum(s.get('refused', 0) for s in stats),
+        max(s.get('peak_sessions', 0) for s in stats))
+    print 'injected         %d failed, %d dropped' % (
+        sum(s.get('failed', 0) for s in stats), sum(s.get('dropped', 0) for s in stats))
+    print 'left pending     %d rows, drift %d ops' % (left, drift)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+#
+# Stand-in RouterOS API server (tcp 8728 protocol) for load and latency
+# tests of rosmanager without MikroTik hardware.
+#
+#   python tools/ros_simulator.py --port 18728 --latency 5 --failure-rate 0.01
+#
+# Every Simulator keeps an in-memory device: ethernet interfaces, vlans,
+# bridges, bridge ports, ip addresses and simple queues. add checks the
+# unique key of its table and the interfaces it refers to, set and remove
+# take =numbers= or =.id=, print answers ?name=value queries, .proplist
+# and count-only. Commands of one api session run in order, each after
+# latency (+-jitter) seconds, replies carry the .tag of their command and
+# /cancel stops a command still queued.
+#
+# failure_rate makes a write command trap, drop_rate closes the session
+# right after a write was applied (the client never learns its outcome),
+# a session beyond max_connections gets !fatal. Simulator.stats() counts
+# the commands per verb, sessions and injected failures.
+
+__author__ = 'Hardy.zheng'
+
+import binascii
+import collections
+import hashlib
+import os
+import random
+import socket
+import threading
+import time
+from optparse import OptionParser
+
+from rosmanager.common import exception
+from rosmanager.common import routeros
+
+
+# path -> unique key of an item
+TABLES = collections.OrderedDict([
+    ('/interface/ethernet', ('name',)),
+    ('/interface/vlan', ('name',)),
+    ('/interface/bridge', ('name',)),
+    ('/interface/bridge/port', ('interface',)),
+    ('/ip/address', ('address', 'interface')),
+    ('/queue/simple', ('name',)),
+])
+
+# path -> attrs naming an interface that must exist
+REFERENCES = {
+    '/interface/vlan': ('interface',),
+    '/interface/bridge/port': ('interface', 'bridge'),
+    '/ip/address': ('interface',),
+    '/queue/simple': ('target',),
+}
+
+# tables whose items are interfaces
+INTERFACES = ('/interface/ethernet', '/interface/vlan', '/interface/bridge')
+
+DEFAULTS = {
+    '/interface/vlan': {'mtu': '1500', 'disabled': 'false'},
+    '/queue/simple': {'max-limit': '0/0', 'disabled': 'false'},
+    '/ip/address': {'disabled': 'false'},
+}
+
+
+class Trap(Exception):
+
+    def __init__(self, message, category=None):
+        super(Trap, self).__init__(message)
+        self.message = message
+        self.category = category
+
+
+class Device(object):
+    """in-memory configuration of one router"""
+
+    def __init__(self, interfaces=('ether1', 'ether2'), bridges=()):
+        self.tables = dict((path, collections.OrderedDict()) for path in TABLES)
+        self._ids = iter(xrange(1, 1 << 31))
+        self._lock = threading.Lock()
+        for name in interfaces:
+            self.add('/interface/ethernet', {'name': name})
+        for name in bridges:
+            self.add('/interface/bridge', {'name': name})
+
+    def _interface_names(self):
+        return set(item['name'] for path in INTERFACES
+                   for item in self.tables[path].values())
+
+    def _find(self, path, numbers):
+        table = self.tables[path]
+        key = TABLES[path][0]
+        ids = []
+        for number in numbers.split(','):
+            if number in table:
+                ids.append(number)
+                continue
+            named = [item_id for item_id, item in table.items()
+                     if item.get(key) == number]
+            if not named:
+                raise Trap('no such item', '0')
+            ids.extend(named)
+        return ids
+
+    def _check(self, path, item, item_id=None):
+        key = tuple(item.get(name) for name in TABLES[path])
+        for other_id, other in self.tables[path].items():
+            if other_id != item_id and \
+                    tuple(other.get(name) for name in TABLES[path]) == key:
+                raise Trap('failure: already have such %s' % TABLES[path][0])
+        names = self._interface_names()
+        for name in REFERENCES.get(path, ()):
+            if name in item and item[name] not in names:
+                raise Trap('input does not match any value of %s' % name, '1')
+
+    def add(self, path, attrs):
+        with self._lock:
+            item = dict(DEFAULTS.get(path, {}))
+            item.update(attrs)
+            self._check(path, item)
+            item['.id'] = '*%X' % next(self._ids)
+            self.tables[path][item['.id']] = item
+            return item['.id']
+
+    def set(self, path, numbers, attrs):
+        with self._lock:
+            for item_id in self._find(path, numbers):
+                item = dict(self.tables[path][item_id], **attrs)
+                self._check(path, item, item_id)
+                self.tables[path][item_id] = item
+
+    def remove(self, path, numbers):
+        with self._lock:
+            for item_id in self._find(path, numbers):
+                del self.tables[path][item_id]
+
+    def print_(self, path, query):
+        with self._lock:
+            return [dict(item) for item in self.tables[path].values()
+                    if all(item.get(name) == value for name, value in query.items())]
+
+    def count(self):
+        return dict((path, len(table)) for path, table in self.tables.items())
+
+
+class _Session(object):
+    """one api session: a reader thread queues the commands, a worker
+    thread runs them in order
+    """
+
+    def __init__(self, simulator, sock):
+        self.simulator = simulator
+        self.sock = sock
+        self.logged_in = False
+        self.challenge = None
+        self.queue = collections.deque()
+        self.cancelled = set()
+        self.alive = True
+        self._ready = threading.Condition(threading.Lock())
+        self._send_lock = threading.Lock()
+
+    def start(self):
+        for target in (self._read_loop, self._work_loop):
+            thread = threading.Thread(target=target, name='ros-simulator')
+            thread.daemon = True
+            thread.start()
+
+    def _recv(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise exception.RouterOsConnectionError('closed by peer')
+            data += chunk
+        return data
+
+    def _read_loop(self):
+        try:
+            while self.alive:
+                words = routeros.read_sentence(self._recv)
+                if not words:
+                    continue
+                command, tag, attrs, query = words[0], None, {}, {}
+                for word in words[1:]:
+                    if word.startswith('.tag='):
+                        tag = word[5:]
+                    elif word.startswith('='):
+                        name, _, value = word[1:].partition('=')
+                        attrs[name] = value
+                    elif word.startswith('?'):
+                        name, _, value = word[1:].partition('=')
+                        query[name] = value
+                if command == '/cancel':
+                    # answered at once, not queued behind what it cancels
+                    self.cancelled.add(attrs.get('tag'))
+                    self.reply(tag, [('!done', {})])
+                    continue
+                with self._ready:
+                    self.queue.append((command, tag, attrs, query))
+                    self._ready.notify()
+        except (socket.error, exception.RouterOsConnectionError):
+            pass
+        self.close()
+
+    def _work_loop(self):
+        while self.alive:
+            with self._ready:
+                while self.alive and not self.queue:
+                    self._ready.wait()
+                if not self.alive:
+                    return
+                command, tag, attrs, query = self.queue.popleft()
+            if tag in self.cancelled:
+                self.cancelled.discard(tag)
+                self.reply(tag, [('!trap', {'category': '2', 'message': 'interrupted'}),
+                                 ('!done', {})])
+                continue
+            self.simulator.wait()
+            try:
+                sentences, drop = self.simulator.run(self, command, attrs, query)
+            except Trap as e:
+                trap = {'message': e.message}
+                if e.category is not None:
+                    trap['category'] = e.category
+                sentences, drop = [('!trap', trap), ('!done', {})], False
+            if drop:
+                self.close()
+                return
+            self.reply(tag, sentences)
+
+    def reply(self, tag, sentences):
+        data = []
+        for reply, attrs in sentences:
+            words = [reply] + ['=%s=%s' % item for item in sorted(attrs.items())]
+            if tag is not None:
+                words.append('.tag=%s' % tag)
+            data.append(routeros.encode_sentence(words))
+        try:
+            with self._send_lock:
+                self.sock.sendall(b''.join(data))
+        except socket.error:
+            self.close()
+
+    def close(self):
+        if not self.alive:
+            return
+        self.alive = False
+        with self._ready:
+            self._ready.notify_all()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+        self.simulator.closed(self)
+
+
+class Simulator(object):
+
+    def __init__(self, host='127.0.0.1', port=0, username='admin',
+                 password='admin', device=None, latency=0.0, jitter=0.0,
+                 failure_rate=0.0, drop_rate=0.0, max_connections=0,
+                 legacy_login=False):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.device = device or Device()
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.drop_rate = drop_rate
+        self.max_connections = max_connections
+        self.legacy_login = legacy_login
+        self.sessions = set()
+        self.counts = collections.Counter()
+        self._lock = threading.Lock()
+        self._sock = None
+        self._stopped = False
+
+    def start(self):
+        """listen and accept in a thread, return the (host, port) bound"""
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((self.host, self.port))
+        self._sock.listen(128)
+        self.port = self._sock.getsockname()[1]
+        thread = threading.Thread(target=self._accept_loop,
+                                  name='ros-simulator-%s' % self.port)
+        thread.daemon = True
+        thread.start()
+        return self.host, self.port
+
+    def _accept_loop(self):
+        while not self._stopped:
+            try:
+                sock, _ = self._sock.accept()
+            except socket.error:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            session = _Session(self, sock)
+            with self._lock:
+                full = self.max_connections and \
+                    len(self.sessions) >= self.max_connections
+                if not full:
+                    self.sessions.add(session)
+                    self.counts['sessions'] += 1
+                    self.counts['peak_sessions'] = max(self.counts['peak_sessions'],
+                                                       len(self.sessions))
+            if full:
+                self.counts['refused'] += 1
+                session.reply(None, [('!fatal', {'message': 'too many connections'})])
+                session.close()
+                continue
+            session.start()
+
+    def closed(self, session):
+        with self._lock:
+            self.sessions.discard(session)
+
+    def wait(self):
+        if self.latency or self.jitter:
+            time.sleep(max(0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+    def _login(self, session, attrs):
+        if session.challenge is not None and 'response' in attrs:
+            digest = hashlib.md5(b'\x00' + self.password.encode('utf-8') +
+                                 session.challenge).hexdigest()
+            if attrs.get('name') != self.username or attrs['response'] != '00' + digest:
+                raise Trap('cannot log in')
+            session.logged_in = True
+            return [('!done', {})]
+        if self.legacy_login:
+            session.challenge = os.urandom(16)
+            return [('!done', {'ret': binascii.hexlify(session.challenge)})]
+        if attrs.get('name') != self.username or attrs.get('password') != self.password:
+            raise Trap('invalid user name or password (6)')
+        session.logged_in = True
+        return [('!done', {})]
+
+    def run(self, session, command, attrs, query):
+        """(reply sentences, whether to drop the session) of one command"""
+        path, _, verb = command.rpartition('/')
+        self.counts[str(verb)] += 1
+        self.counts['commands'] += 1
+        if command == '/login':
+            return self._login(session, attrs), False
+        if not session.logged_in:
+            raise Trap('not logged in')
+        if command == '/system/identity/print':
+            return [('!re', {'name': 'simulator'}), ('!done', {})], False
+        if command == '/quit':
+            return [('!fatal', {'message': 'session terminated on request'})], True
+        if path not in TABLES:
+            raise Trap('no such command prefix', '0')
+        if verb == 'print':
+            return self._print(path, attrs, query), False
+        if verb not in ('add', 'set', 'remove'):
+            raise Trap('no such command', '0')
+        if self.failure_rate and random.random() < self.failure_rate:
+            self.counts['failed'] += 1
+            raise Trap('simulated failure')
+        numbers = attrs.pop('numbers', None) or attrs.pop('.id', None)
+        done = {}
+        if verb == 'add':
+            done['ret'] = self.device.add(path, attrs)
+        elif numbers is None:
+            raise Trap('missing value(s) of argument(s) numbers', '0')
+        elif verb == 'set':
+            self.device.set(path, numbers, attrs)
+        else:
+            self.device.remove(path, numbers)
+        if self.drop_rate and random.random() < self.drop_rate:
+            # applied, but the reply never leaves
+            self.counts['dropped'] += 1
+            return [], True
+        return [('!done', done)], False
+
+    def _print(self, path, attrs, query):
+        items = self.device.print_(path, query)
+        if 'count-only' in attrs:
+            return [('!done', {'ret': str(len(items))})]
+        proplist = attrs.get('.proplist')
+        if proplist:
+            names = proplist.split(',')
+            items = [dict((name, item[name]) for name in names if name in item)
+                     for item in items]
+        return [('!re', item) for item in items] + [('!done', {})]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counts)
+            stats['open_sessions'] = len(self.sessions)
+        stats['items'] = self.device.count()
+        return stats
+
+    def stop(self):
+        self._stopped = True
+        if self._sock is not None:
+            self._sock.close()
+        with self._lock:
+            sessions = list(self.sessions)
+        for session in sessions:
+            session.close()
+
+
+parser = OptionParser()
+parser.add_option("--host", dest="host", default='127.0.0.1')
+parser.add_option("-p", "--port", dest="port", type="int", default=8728)
+parser.add_option("-u", "--username", dest="username", default='admin')
+parser.add_option("-P", "--password", dest="password", default='admin')
+parser.add_option("-i", "--interfaces", dest="interfaces", default='ether1,ether2',
+                  help="ethernet interfaces of the device")
+parser.add_option("-b", "--bridges", dest="bridges", default='',
+                  help="bridges of the device, the gic group names")
+parser.add_option("-l", "--latency", dest="latency", type="float", default=0,
+                  help="ms per command")
+parser.add_option("-j", "--jitter", dest="jitter", type="float", default=0,
+                  help="+- ms on the latency")
+parser.add_option("-f", "--failure-rate", dest="failure_rate", type="float",
+                  default=0, help="share of the write commands that trap")
+parser.add_option("-d", "--drop-rate", dest="drop_rate", type="float", default=0,
+                  help="share of the write commands whose session is dropped "
+                       "once applied")
+parser.add_option("-m", "--max-connections", dest="max_connections", type="int",
+                  default=0, help="api sessions at once, 0 is unlimited")
+parser.add_option("--legacy-login", dest="legacy_login", action="store_true",
+                  default=False, help="md5 challenge login of routeros < 6.43")
+
+
+def main():
+    (options, args) = parser.parse_args()
+    device = Device([name for name in options.interfaces.split(',') if name],
+                    [name for name in options.bridges.split(',') if name])
+    simulator = Simulator(options.host, options.port, options.username,
+                          options.password, device, options.latency / 1000.0,
+                          options.jitter / 1000.0, options.failure_rate,
+                          options.drop_rate, options.max_connections,
+                          options.legacy_login)
+    host, port = simulator.start()
+    print 'routeros simulator on %s:%d' % (host, port)
+    try:
+        while True:
+            time.sleep(10)
+            print simulator.stats()
+    except KeyboardInterrupt:
+        simulator.stop()
+
+
+if __name__ == '__main__':
+    main()